@@ -0,0 +1,158 @@
+import json
+import os
+import pytest
+import subprocess
+import time
+
+from varifier import batch, vcf_evaluate
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "batch")
+vcf_evaluate_data_dir = os.path.join(this_dir, "data", "vcf_evaluate")
+
+
+def test_load_manifest():
+    got = batch.load_manifest(os.path.join(data_dir, "load_manifest.tsv"))
+    assert got == [
+        {
+            "name": "sample1",
+            "vcf": "s1.vcf",
+            "vcf_fasta": "ref.fa",
+            "truth_fasta": "truth.fa",
+            "truth_vcf": None,
+            "ref_mask": None,
+            "truth_mask": None,
+            "mem_gb": None,
+        },
+        {
+            "name": "sample2",
+            "vcf": "s2.vcf",
+            "vcf_fasta": "ref.fa",
+            "truth_fasta": "truth.fa",
+            "truth_vcf": None,
+            "ref_mask": None,
+            "truth_mask": "mask.bed",
+            "mem_gb": 8.0,
+        },
+    ]
+
+    with pytest.raises(RuntimeError):
+        batch.load_manifest(os.path.join(data_dir, "load_manifest.missing_column.tsv"))
+
+
+def _write_start_and_end_times(filename, sleep_time):
+    start = time.time()
+    time.sleep(sleep_time)
+    with open(filename, "w") as f:
+        print(start, time.time(), file=f)
+
+
+def _fail():
+    raise ValueError("Failed")
+
+
+def test_truth_key():
+    tmp_files = {x: f"tmp.batch.truth_key.{x}" for x in ("ref.fa", "truth.fa")}
+    for filename in tmp_files.values():
+        with open(filename, "w") as f:
+            print(">seq", "ACGT", sep="\n", file=f)
+    row = {
+        "vcf_fasta": tmp_files["ref.fa"],
+        "truth_fasta": tmp_files["truth.fa"],
+        "truth_mask": None,
+    }
+    key = batch._truth_key(row, 100, None)
+    assert batch._truth_key(row, 100, None) == key
+    assert batch._truth_key(row, 50, None) != key
+    assert batch._truth_key(row, 100, 10) != key
+    assert batch._truth_key(row, 100, None, bgzip_output=True) != key
+
+    # Changing a FASTA file, but keeping the same name, changes the key
+    with open(tmp_files["truth.fa"], "w") as f:
+        print(">seq", "ACGTT", sep="\n", file=f)
+    assert batch._truth_key(row, 100, None) != key
+    for filename in tmp_files.values():
+        os.unlink(filename)
+
+
+def test_run_jobs():
+    tmp_dir = "tmp.batch.run_jobs"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    os.mkdir(tmp_dir)
+    times_file = lambda x: os.path.join(tmp_dir, x)
+    jobs = [
+        batch.Job("a", _write_start_and_end_times, (times_file("a"), 0.5), cpus=2),
+        batch.Job("b", _write_start_and_end_times, (times_file("b"), 0.5), mem_gb=3),
+        batch.Job(
+            "c", _write_start_and_end_times, (times_file("c"), 0), depends_on=["a"]
+        ),
+        batch.Job("d", _fail, (), cpus=1),
+        batch.Job(
+            "e", _write_start_and_end_times, (times_file("e"), 0), depends_on=["d"]
+        ),
+    ]
+    got = batch.run_jobs(jobs, 2, max_mem_gb=4)
+    assert got["a"] is None
+    assert got["b"] is None
+    assert got["c"] is None
+    assert isinstance(got["d"], ValueError)
+    assert isinstance(got["e"], RuntimeError)
+    assert not os.path.exists(times_file("e"))
+
+    times = {}
+    for name in "a", "b", "c":
+        with open(times_file(name)) as f:
+            times[name] = [float(x) for x in f.read().split()]
+    # a uses all the cpus, so b has to wait until a has finished.
+    # c depends on a, so has to start after a has finished
+    assert times["b"][0] >= times["a"][1]
+    assert times["c"][0] >= times["a"][1]
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
+
+
+def test_evaluate_manifest():
+    truth_fasta = os.path.join(vcf_evaluate_data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(vcf_evaluate_data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(vcf_evaluate_data_dir, "evaluate_vcf.to_eval.vcf")
+    truth_vcf = os.path.join(vcf_evaluate_data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_dir = "tmp.batch.evaluate_manifest"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    os.mkdir(tmp_dir)
+    manifest = os.path.join(tmp_dir, "manifest.tsv")
+    with open(manifest, "w") as f:
+        print("name", "vcf", "vcf_fasta", "truth_fasta", "truth_vcf", sep="\t", file=f)
+        for name in "s1", "s2":
+            print(name, vcf_to_eval, ref_fasta, truth_fasta, truth_vcf, sep="\t", file=f)
+        print("s3", "not_a_file", ref_fasta, truth_fasta, truth_vcf, sep="\t", file=f)
+
+    outdir = os.path.join(tmp_dir, "out")
+    got = batch.evaluate_manifest(manifest, outdir, max_cpus=2)
+    assert got["s1"] is None
+    assert got["s2"] is None
+    assert got["s3"] is not None
+    json_files = {
+        x: os.path.join(outdir, "evaluations", x, "summary_stats.json")
+        for x in ("s1", "s2")
+    }
+    with open(json_files["s1"]) as f:
+        stats = json.load(f)
+    with open(json_files["s2"]) as f:
+        assert json.load(f) == stats
+    with open(os.path.join(outdir, "summary_stats.tsv")) as f:
+        assert [x.split("\t")[0] for x in f] == ["Name", "s1", "s2"]
+
+    # summary_stats.json is written last, and not left half written
+    assert not os.path.exists(f"{json_files['s1']}.tmp")
+
+    # Running again should skip the finished rows, and only redo s3, and s2
+    # which looks like it was interrupted before writing summary_stats.json
+    os.utime(json_files["s1"], (0, 0))
+    os.unlink(json_files["s2"])
+    got = batch.evaluate_manifest(manifest, outdir, max_cpus=2)
+    assert got["s1"] is None
+    assert got["s2"] is None
+    assert got["s3"] is not None
+    assert os.path.getmtime(json_files["s1"]) == 0
+    with open(json_files["s2"]) as f:
+        assert json.load(f) == stats
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
@@ -12,6 +12,18 @@ def test_needleman_wunsch():
     assert aln1 == expect1
     assert aln2 == expect2
 
+    # Needs the band to be made wider to find the deletion
+    seq1 = "ACGTTGACCAGTAGCAGTCCATGCAGGATCCATTTGACGTAGCATCAG"
+    seq2 = "ACGTTGACCAGTAGCAGTCCATGCAGGATCCCTCAG"
+    expect1 = "ACGTTGACCAGTAGCAGTCCATGCAGGATCCATTTGACGTAGCATCAG"
+    expect2 = "ACGTTGACCAGTAGCAGTCCATGCAGGATC------------CCTCAG"
+    for band_width in 1, 4, 100:
+        aln1, aln2 = edit_distance._needleman_wunsch(
+            seq1, seq2, band_width=band_width
+        )
+        assert aln1 == expect1
+        assert aln2 == expect2
+
 
 def test_edit_distance_from_aln_strings():
     assert edit_distance.edit_distance_from_aln_strings("A", "A") == 0
@@ -32,9 +44,23 @@ def test_edit_distance_from_aln_strings():
     assert edit_distance.edit_distance_from_aln_strings("AGT--ACTG-", "A--TCAC-GG") == 3
 
 
+def test_closed_form_edit_distance():
+    assert edit_distance._closed_form_edit_distance("ACGT", "ACGT") == 0
+    assert edit_distance._closed_form_edit_distance("ACGT", "AGGA") == 2
+    assert edit_distance._closed_form_edit_distance("AAAAAA", "CCCCCC") is None
+    assert edit_distance._closed_form_edit_distance("ACGT", "ACGGT") == 1
+    assert edit_distance._closed_form_edit_distance("ACGTTTTG", "AG") == 1
+    assert edit_distance._closed_form_edit_distance("A", "") == 1
+    assert edit_distance._closed_form_edit_distance("ACGT", "AGGGT") is None
+
+
 def test_edit_distance_between_seqs():
-    edit_distance.edit_distance_between_seqs("A", "A") == 0
-    edit_distance.edit_distance_between_seqs("A", "C") == 1
-    edit_distance.edit_distance_between_seqs("AG", "ACG") == 1
-    edit_distance.edit_distance_between_seqs("AGTGCAT", "ACGTGCGT") == 2
-    edit_distance.edit_distance_between_seqs("AGTGCAT", "AGCCTGCAT") == 1
+    assert edit_distance.edit_distance_between_seqs("A", "A") == 0
+    assert edit_distance.edit_distance_between_seqs("A", "C") == 1
+    assert edit_distance.edit_distance_between_seqs("AG", "ACG") == 1
+    assert edit_distance.edit_distance_between_seqs("AGTGCAT", "ACGTGCGT") == 2
+    assert edit_distance.edit_distance_between_seqs("AGTGCAT", "AGCCTGCAT") == 1
+    assert edit_distance.edit_distance_between_seqs("AAAAAA", "CCCCCC") == 6
+    hits = edit_distance.edit_distance_between_seqs.cache_info().hits
+    assert edit_distance.edit_distance_between_seqs("AGTGCAT", "ACGTGCGT") == 2
+    assert edit_distance.edit_distance_between_seqs.cache_info().hits == hits + 1
@@ -0,0 +1,57 @@
+import os
+import pytest
+
+from varifier import genome, index_cache, utils
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "genome")
+
+
+def test_genome():
+    fasta = os.path.join(data_dir, "genome.fa")
+    g = genome.load(fasta)
+    assert genome.load(g) is g
+    assert genome.fasta_file(g) == fasta
+    assert genome.fasta_file(fasta) == fasta
+    assert list(g.seqs.keys()) == ["seq1", "seq2"]
+    assert g.seqs["seq1"].seq == "ACGTACGTACGT"
+    assert g.seqs is g.seqs
+    assert g.checksum == index_cache.fasta_checksum(fasta)
+    assert g.identity == genome.Genome(fasta).identity
+    assert g.identity[0] == os.path.abspath(fasta)
+
+    made = []
+
+    def make_mapper():
+        made.append(1)
+        return len(made)
+
+    assert g.mapper("key1", make_mapper) == 1
+    assert g.mapper("key1", make_mapper) == 1
+    assert g.mapper("key2", make_mapper) == 2
+    assert len(made) == 2
+
+
+def test_genome_in_memory():
+    seqs = {"seq1": "ACGT"}
+    g = genome.Genome(None, seqs=seqs)
+    assert g.fasta_file is None
+    assert genome.load(g) is g
+    assert g.seqs is seqs
+    assert g.checksum == index_cache.seqs_checksum(seqs)
+    assert g.identity == g.identity
+    assert g.identity != genome.Genome(None, seqs=seqs).identity
+
+
+def test_evaluation_context():
+    fasta = os.path.join(data_dir, "genome.fa")
+    context = genome.EvaluationContext(fasta)
+    assert context.ref.fasta_file == fasta
+    assert context.truth is None
+    assert context.truth_mask is None
+
+    truth = genome.Genome(fasta)
+    mask = os.path.join(data_dir, "mask.bed")
+    context = genome.EvaluationContext(fasta, truth, truth_mask_bed_file=mask)
+    assert context.truth is truth
+    assert context.truth_mask == {"seq1": utils.IntervalMask([(2, 4)])}
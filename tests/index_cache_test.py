@@ -0,0 +1,79 @@
+import os
+import pytest
+import shutil
+import subprocess
+
+import mappy
+
+from varifier import index_cache
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "index_cache")
+
+
+def test_fasta_checksum():
+    fasta = os.path.join(data_dir, "cached_index.fa")
+    tmp_fasta = "tmp.fasta_checksum.fa"
+    shutil.copyfile(fasta, tmp_fasta)
+    assert index_cache.fasta_checksum(fasta) == index_cache.fasta_checksum(tmp_fasta)
+    with open(tmp_fasta, "a") as f:
+        print("A", file=f)
+    assert index_cache.fasta_checksum(fasta) != index_cache.fasta_checksum(tmp_fasta)
+    os.unlink(tmp_fasta)
+
+
+def test_seqs_checksum():
+    seqs = {"seq1": "ACGT", "seq2": "AC"}
+    assert index_cache.seqs_checksum(seqs) == index_cache.seqs_checksum(dict(seqs))
+    assert index_cache.seqs_checksum(seqs) != index_cache.seqs_checksum(
+        {"seq1": "ACGT", "seq2": "AG"}
+    )
+    assert index_cache.seqs_checksum(seqs) != index_cache.seqs_checksum(
+        {"seq1": "ACGTAC"}
+    )
+
+
+def test_cached_index():
+    fasta = os.path.join(data_dir, "cached_index.fa")
+    tmp_dir = "tmp.cached_index"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    got_index = index_cache.cached_index(fasta, tmp_dir, 15, 10, "sr")
+    expect_index = index_cache.index_filename(fasta, tmp_dir, 15, 10, "sr")
+    assert got_index == expect_index
+    assert os.listdir(tmp_dir) == [os.path.basename(expect_index)]
+    aligner = mappy.Aligner(fn_idx_in=got_index, preset="sr")
+    assert aligner.seq_names == ["seq1", "seq2"]
+    assert (aligner.k, aligner.w) == (15, 10)
+
+    # Using the index again should not remake it
+    os.utime(got_index, (0, 0))
+    assert index_cache.cached_index(fasta, tmp_dir, 15, 10, "sr") == got_index
+    assert os.path.getmtime(got_index) > 0
+
+    # Different k means a different index
+    other_index = index_cache.cached_index(fasta, tmp_dir, 17, 10, "sr")
+    assert other_index != got_index
+    assert len(os.listdir(tmp_dir)) == 2
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
+
+
+def test_evict():
+    tmp_dir = "tmp.evict"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    os.mkdir(tmp_dir)
+    for i in range(4):
+        filename = os.path.join(tmp_dir, f"{i}.mmi")
+        with open(filename, "w") as f:
+            print("x" * 9, file=f)
+        os.utime(filename, (i, i))
+    not_an_index = os.path.join(tmp_dir, "foo")
+    with open(not_an_index, "w") as f:
+        print("x" * 99, file=f)
+
+    index_cache.evict(tmp_dir, 40)
+    assert sorted(os.listdir(tmp_dir)) == ["0.mmi", "1.mmi", "2.mmi", "3.mmi", "foo"]
+    index_cache.evict(tmp_dir, 25, keep=os.path.join(tmp_dir, "0.mmi"))
+    assert sorted(os.listdir(tmp_dir)) == ["0.mmi", "3.mmi", "foo"]
+    index_cache.evict(tmp_dir, 0)
+    assert os.listdir(tmp_dir) == ["foo"]
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
@@ -1,8 +1,11 @@
 import filecmp
 import os
 import pytest
+import shutil
 
-from varifier import probe_mapping
+import mappy
+
+from varifier import genome, probe_mapping, utils
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "probe_mapping")
@@ -40,7 +43,7 @@ def test_annotate_vcf_with_probe_mapping():
     tmp_vcf_revcomp = f"{tmp_vcf}.revcomp"
     tmp_map = "tmp.probe_mapping.annotate_vcf_with_probe_mapping.map"
     clean_files((tmp_vcf, tmp_vcf_revcomp, tmp_map))
-    truth_mask = {"truth":{80, 81, 82}}
+    truth_mask = {"truth": utils.IntervalMask([(80, 83)])}
     probe_mapping.annotate_vcf_with_probe_mapping(
         vcf_in,
         vcf_ref_fa,
@@ -67,3 +70,153 @@ def test_annotate_vcf_with_probe_mapping():
     assert filecmp.cmp(tmp_vcf, expect_vcf, shallow=False)
     assert filecmp.cmp(tmp_vcf_revcomp, expect_rev_vcf, shallow=False)
     clean_files((tmp_vcf, tmp_vcf_revcomp, tmp_map))
+
+
+def test_annotate_vcf_with_probe_mapping_threads_and_processes():
+    # Using more than one thread or process should give exactly the same
+    # output files as using one thread, including the debug mapping file
+    vcf_ref_fa = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.ref.fa")
+    vcf_in = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.in.vcf")
+    truth_ref_fa = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.truth.fa")
+    tmp_vcf = "tmp.probe_mapping.annotate_vcf_with_probe_mapping_threads.vcf"
+    tmp_vcf_threads = f"{tmp_vcf}.threads"
+    tmp_map = f"{tmp_vcf}.map"
+    tmp_map_threads = f"{tmp_vcf_threads}.map"
+    tmp_files = (tmp_vcf, tmp_vcf_threads, tmp_map, tmp_map_threads)
+    clean_files(tmp_files)
+    truth_mask = {"truth": utils.IntervalMask([(80, 83)])}
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        vcf_in,
+        vcf_ref_fa,
+        truth_ref_fa,
+        100,
+        tmp_vcf,
+        map_outfile=tmp_map,
+        use_fail_conflict=True,
+        truth_mask=truth_mask,
+    )
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        vcf_in,
+        vcf_ref_fa,
+        truth_ref_fa,
+        100,
+        tmp_vcf_threads,
+        map_outfile=tmp_map_threads,
+        use_fail_conflict=True,
+        truth_mask=truth_mask,
+        threads=3,
+    )
+    assert filecmp.cmp(tmp_vcf, tmp_vcf_threads, shallow=False)
+    assert filecmp.cmp(tmp_map, tmp_map_threads, shallow=False)
+    clean_files((tmp_vcf_threads, tmp_map_threads))
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        vcf_in,
+        vcf_ref_fa,
+        truth_ref_fa,
+        100,
+        tmp_vcf_threads,
+        map_outfile=tmp_map_threads,
+        use_fail_conflict=True,
+        truth_mask=truth_mask,
+        threads=2,
+        processes=2,
+        debug=True,
+    )
+    assert filecmp.cmp(tmp_vcf, tmp_vcf_threads, shallow=False)
+    assert filecmp.cmp(tmp_map, tmp_map_threads, shallow=False)
+    # The truth genome is indexed once, for all the processes to load
+    assert os.path.exists(f"{tmp_vcf_threads}.shards/truth.mmi")
+    shutil.rmtree(f"{tmp_vcf_threads}.shards")
+    clean_files((tmp_vcf_threads, tmp_map_threads, f"{tmp_vcf_threads}.debug.vcf"))
+
+    # A truth genome that is only in memory is written to a file and
+    # indexed once, instead of being sent to each process
+    truth_seqs = {k: v.seq for k, v in utils.file_to_dict_of_seqs(truth_ref_fa).items()}
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        vcf_in,
+        vcf_ref_fa,
+        genome.Genome(None, seqs=truth_seqs),
+        100,
+        tmp_vcf_threads,
+        map_outfile=tmp_map_threads,
+        use_fail_conflict=True,
+        truth_mask=truth_mask,
+        processes=2,
+        debug=True,
+    )
+    assert filecmp.cmp(tmp_vcf, tmp_vcf_threads, shallow=False)
+    assert filecmp.cmp(tmp_map, tmp_map_threads, shallow=False)
+    assert os.path.exists(f"{tmp_vcf_threads}.shards/truth.fa")
+    assert os.path.exists(f"{tmp_vcf_threads}.shards/truth.mmi")
+    shutil.rmtree(f"{tmp_vcf_threads}.shards")
+    clean_files(tmp_files + (f"{tmp_vcf_threads}.debug.vcf",))
+
+
+def test_make_mapper_from_seqs():
+    fasta = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.truth.fa")
+    seqs = {k: v.seq for k, v in utils.file_to_dict_of_seqs(fasta).items()}
+    file_mapper = probe_mapping._make_mapper(fasta)
+    probes = [seqs["truth"][100:301], mappy.revcomp(seqs["truth"][150:351])]
+    expect = [[str(x) for x in file_mapper.map(p, MD=True)] for p in probes]
+    assert all(len(x) > 0 for x in expect)
+
+    # One sequence is indexed in memory, but hits still have the real name
+    mapper = probe_mapping._make_mapper_from_seqs(seqs)
+    got = [list(mapper.map(p, MD=True)) for p in probes]
+    assert [[str(x) for x in hits] for hits in got] == expect
+    assert {x.ctg for hits in got for x in hits} == {"truth"}
+
+    # More than one sequence is indexed via a temporary file
+    seqs["other"] = "A" * 100
+    mapper = probe_mapping._make_mapper_from_seqs(seqs)
+    got = [[str(x) for x in mapper.map(p, MD=True)] for p in probes]
+    assert got == expect
+
+
+def test_probe_hit_cache():
+    cache = probe_mapping.ProbeHitCache(max_size=2)
+    assert cache.hit_rate() == 0
+    assert cache.get("a") is None
+    cache.add("a", (1,))
+    cache.add("b", (2,))
+    assert cache.get("a") == (1,)
+    # b is now the least recently used, so gets evicted
+    cache.add("c", (3,))
+    assert cache.get("b") is None
+    assert cache.get("a") == (1,)
+    assert cache.get("c") == (3,)
+    assert cache.lookups == 5
+    assert cache.found == 3
+    assert cache.hit_rate() == 0.6
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.lookups == 1
+
+
+def test_annotate_vcf_with_probe_mapping_uses_probe_hit_cache():
+    # Running again should get all the probe hits from the cache, and make
+    # the same output files
+    vcf_ref_fa = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.ref.fa")
+    vcf_in = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.in.vcf")
+    truth_ref_fa = os.path.join(data_dir, "annotate_vcf_with_probe_mapping.truth.fa")
+    tmp_vcf = "tmp.probe_mapping.annotate_vcf_with_probe_mapping_cache.vcf"
+    tmp_vcf_cached = f"{tmp_vcf}.cached"
+    tmp_map = f"{tmp_vcf}.map"
+    tmp_map_cached = f"{tmp_vcf_cached}.map"
+    tmp_files = (tmp_vcf, tmp_vcf_cached, tmp_map, tmp_map_cached)
+    clean_files(tmp_files)
+    probe_mapping.probe_hit_cache.clear()
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        vcf_in, vcf_ref_fa, truth_ref_fa, 100, tmp_vcf, map_outfile=tmp_map
+    )
+    lookups = probe_mapping.probe_hit_cache.lookups
+    assert lookups > 0
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        vcf_in, vcf_ref_fa, truth_ref_fa, 100, tmp_vcf_cached, map_outfile=tmp_map_cached
+    )
+    assert probe_mapping.probe_hit_cache.lookups == 2 * lookups
+    assert probe_mapping.probe_hit_cache.found >= lookups
+    assert filecmp.cmp(tmp_vcf, tmp_vcf_cached, shallow=False)
+    assert filecmp.cmp(tmp_map, tmp_map_cached, shallow=False)
+    probe_mapping.probe_hit_cache.clear()
+    clean_files(tmp_files)
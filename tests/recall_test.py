@@ -1,4 +1,5 @@
 import filecmp
+import io
 import os
 import pytest
 import subprocess
@@ -54,9 +55,63 @@ def test_apply_variants_to_genome():
     expect_fasta = os.path.join(data_dir, "apply_variants_to_genome.expect.fa")
     tmp_fasta = "tmp.apply_variants_to_genome.fa"
     subprocess.check_output(f"rm -f {tmp_fasta}", shell=True)
-    recall.apply_variants_to_genome(ref_fasta, vcf_file, tmp_fasta)
+    tmp_offsets = "tmp.apply_variants_to_genome.offsets.tsv"
+    recall.apply_variants_to_genome(
+        ref_fasta, vcf_file, tmp_fasta, offsets_tsv=tmp_offsets
+    )
     assert filecmp.cmp(tmp_fasta, expect_fasta, shallow=False)
+    expect_offsets = os.path.join(
+        data_dir, "apply_variants_to_genome.expect.offsets.tsv"
+    )
+    assert filecmp.cmp(tmp_offsets, expect_offsets, shallow=False)
     os.unlink(tmp_fasta)
+    os.unlink(tmp_offsets)
+
+    # Same again, but writing to memory
+    out = io.StringIO()
+    recall.apply_variants_to_genome(ref_fasta, vcf_file, out)
+    with open(expect_fasta) as f:
+        assert out.getvalue() == f.read()
+
+
+def test_mutated_genome():
+    ref_fasta = os.path.join(data_dir, "apply_variants_to_genome.ref.fa")
+    vcf_file = os.path.join(data_dir, "apply_variants_to_genome.vcf")
+    expect_fasta = os.path.join(data_dir, "apply_variants_to_genome.expect.fa")
+    got = recall.mutated_genome(ref_fasta, vcf_file)
+    assert got.fasta_file is None
+    expect = utils.file_to_dict_of_seqs(expect_fasta)
+    assert got.seqs == {k: v.seq for k, v in expect.items()}
+
+    # The offsets are the same as those from apply_variants_to_genome()
+    offsets = {}
+    recall.mutated_genome(ref_fasta, vcf_file, offsets=offsets)
+    tmp_offsets = "tmp.mutated_genome.offsets.tsv"
+    recall._write_offsets_tsv(offsets, tmp_offsets)
+    expect_offsets = os.path.join(
+        data_dir, "apply_variants_to_genome.expect.offsets.tsv"
+    )
+    assert filecmp.cmp(tmp_offsets, expect_offsets, shallow=False)
+    os.unlink(tmp_offsets)
+
+
+def test_truth_records_changed_by_filtering():
+    vcf_file = os.path.join(data_dir, "truth_records_changed_by_filtering.vcf")
+    changed = recall._truth_records_changed_by_filtering(vcf_file, 10)
+
+    def record(chrom, pos):
+        return vcf_record.VcfRecord(f"{chrom}\t{pos}\t.\tT\tG\t.\tPASS\t.\tGT\t1/1")
+
+    assert not changed(record("ref1", 42))
+    assert not changed(record("ref2", 89))
+    assert changed(record("ref2", 90))
+    assert changed(record("ref2", 101))
+    assert changed(record("ref2", 114))
+    assert not changed(record("ref2", 115))
+    assert not changed(record("ref2", 201))
+    assert changed(record("ref3", 1))
+    assert not changed(record("ref4", 42))
+    assert not changed(record("ref5", 42))
 
 
 def test_get_recall():
@@ -74,9 +129,17 @@ def test_get_recall():
     assert utils.vcf_records_are_the_same(got_vcf_filtered, expect_vcf_filtered)
     subprocess.check_output(f"rm -r {tmp_out}", shell=True)
 
+    # Only remapping the truth variants affected by non-PASS calls should
+    # give the same result
+    got_vcf_all, got_vcf_filtered = recall.get_recall(
+        ref_fasta, vcf_to_test, tmp_out, 100, debug=True, truth_fasta=truth_fasta, incremental_filt=True,
+    )
+    assert utils.vcf_records_are_the_same(got_vcf_all, expect_vcf_all)
+    assert utils.vcf_records_are_the_same(got_vcf_filtered, expect_vcf_filtered)
+    subprocess.check_output(f"rm -r {tmp_out}", shell=True)
+
     # Same again, but with a mask that removes a few variants
-    mask = {"truth": set(list(range(320, 391)))}
-    mask["truth"].add(180)
+    mask = {"truth": utils.IntervalMask([(320, 391), (180, 181)])}
     got_vcf_all, got_vcf_filtered = recall.get_recall(
         ref_fasta, vcf_to_test, tmp_out, 100, debug=True, truth_fasta=truth_fasta, truth_mask=mask,
     )
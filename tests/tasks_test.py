@@ -22,6 +22,12 @@ def test_make_truth_vcf():
     options.snps_only = False
     options.output_probes = False
     options.detailed_VCF = False
+    options.threads = 1
+    options.processes = 1
+    options.index_cache_dir = None
+    options.index_cache_max_gb = None
+    options.bgzip_output = False
+    options.regions = None
     subprocess.check_output(f"rm -rf {options.outdir}", shell=True)
     tasks.make_truth_vcf.run(options)
     got_vcf = os.path.join(options.outdir, "04.truth.vcf")
@@ -50,6 +56,15 @@ def test_vcf_eval():
     options.truth_mask = None
     options.use_ref_calls = False
     options.max_recall_ref_len = None
+    options.threads = 1
+    options.processes = 1
+    options.index_cache_dir = None
+    options.index_cache_max_gb = None
+    options.incremental_filt = False
+    options.bgzip_output = False
+    options.regions = None
+    options.shard = None
+    options.curve_by = None
     subprocess.check_output(f"rm -rf {options.outdir}", shell=True)
     tasks.vcf_eval.run(options)
     expect_json = os.path.join(data_dir, "vcf_eval.expect.summary_stats.json")
@@ -62,3 +77,94 @@ def test_vcf_eval():
     expect_json = os.path.join(data_dir, "vcf_eval.expect.masked.summary_stats.json")
     assert filecmp.cmp(expect_json, got_json, shallow=False)
     subprocess.check_output(f"rm -r {options.outdir}", shell=True)
+
+
+def test_merge_eval():
+    options = mock.Mock()
+    options.vcf_in = os.path.join(data_dir, "vcf_eval.to_eval.vcf")
+    options.vcf_fasta = os.path.join(data_dir, "vcf_eval.ref.fa")
+    options.truth_fasta = os.path.join(data_dir, "vcf_eval.truth.fa")
+    options.flank_length = 100
+    options.truth_vcf = os.path.join(data_dir, "make_truth_vcf.expect.vcf")
+    options.debug = False
+    options.force = True
+    options.ref_mask = None
+    options.truth_mask = None
+    options.use_ref_calls = False
+    options.max_recall_ref_len = None
+    options.threads = 1
+    options.processes = 1
+    options.index_cache_dir = None
+    options.index_cache_max_gb = None
+    options.incremental_filt = False
+    options.bgzip_output = False
+    options.regions = None
+    options.shard = None
+    options.curve_by = None
+    options.outdir = "tmp.tasks.merge_eval.no_shards"
+    tasks.vcf_eval.run(options)
+    expect_json = os.path.join(options.outdir, "summary_stats.json")
+
+    shard_dirs = []
+    for shard in "1/2", "2/2":
+        options.shard = shard
+        options.outdir = f"tmp.tasks.merge_eval.shard.{shard[0]}"
+        tasks.vcf_eval.run(options)
+        shard_dirs.append(options.outdir)
+
+    merge_options = mock.Mock()
+    merge_options.outdir = "tmp.tasks.merge_eval.out"
+    merge_options.shard_dirs = shard_dirs
+    merge_options.force = True
+    merge_options.curve_by = None
+    tasks.merge_eval.run(merge_options)
+    got_json = os.path.join(merge_options.outdir, "summary_stats.json")
+    assert filecmp.cmp(expect_json, got_json, shallow=False)
+
+    summarise_options = mock.Mock()
+    summarise_options.eval_dir = merge_options.outdir
+    summarise_options.outfile = "tmp.tasks.merge_eval.summarise.json"
+    summarise_options.filter = None
+    summarise_options.calls_filter = None
+    summarise_options.regions = None
+    summarise_options.mask = None
+    tasks.summarise.run(summarise_options)
+    assert filecmp.cmp(expect_json, summarise_options.outfile, shallow=False)
+    subprocess.check_output("rm -r tmp.tasks.merge_eval.*", shell=True)
+
+
+def test_vcf_eval_multi():
+    options = mock.Mock()
+    options.vcf_in = [
+        os.path.join(data_dir, "vcf_eval.to_eval.vcf"),
+        os.path.join(data_dir, "vcf_eval.to_eval.vcf"),
+    ]
+    options.vcf_fasta = os.path.join(data_dir, "vcf_eval.ref.fa")
+    options.truth_fasta = os.path.join(data_dir, "vcf_eval.truth.fa")
+    options.flank_length = 100
+    options.outdir = "tmp.tasks.vcf_eval_multi"
+    options.names = "caller1,caller2"
+    options.truth_vcf = os.path.join(data_dir, "make_truth_vcf.expect.vcf")
+    options.debug = False
+    options.force = True
+    options.ref_mask = None
+    options.truth_mask = None
+    options.use_ref_calls = False
+    options.max_recall_ref_len = None
+    options.parallel = 2
+    options.threads = 1
+    options.processes = 1
+    options.index_cache_dir = None
+    options.index_cache_max_gb = None
+    options.incremental_filt = True
+    options.bgzip_output = True
+    options.regions = None
+    tasks.vcf_eval_multi.run(options)
+    with open(os.path.join(options.outdir, "summary_stats.tsv")) as f:
+        names = [x.split("\t")[0] for x in f]
+    assert names == ["Name", "caller1", "caller2"]
+    caller_dir = os.path.join(options.outdir, "callers", "caller1")
+    assert os.path.exists(os.path.join(caller_dir, "precision.vcf.gz.tbi"))
+    recall_vcf = "recall/ALL/02.truth.probe_mapped_to_mutated_genome.vcf.gz.tbi"
+    assert os.path.exists(os.path.join(caller_dir, recall_vcf))
+    subprocess.check_output(f"rm -r {options.outdir}", shell=True)
@@ -5,7 +5,7 @@ import subprocess
 
 from cluster_vcf_records import vcf_file_read
 
-from varifier import truth_variant_finding, utils
+from varifier import truth_variant_finding, utils, vcf_shards
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "truth_variant_finding")
@@ -124,13 +124,25 @@ def test_make_truth_vcf():
     assert utils.vcf_records_are_the_same(got_vcf, expect_vcf)
     subprocess.check_output(f"rm -r {tmp_out}", shell=True)
     # Test same run again, but mask a position in the truth where there's a SNP
-    truth_mask = {"truth": {59}}
+    truth_mask = {"truth": utils.IntervalMask([(59, 60)])}
     got_vcf = truth_variant_finding.make_truth_vcf(
         ref_fasta, truth_fasta, tmp_out, 100, truth_mask=truth_mask
     )
     expect_vcf = os.path.join(data_dir, "make_truth_vcf.expect.masked.vcf")
     assert utils.vcf_records_are_the_same(got_vcf, expect_vcf)
     subprocess.check_output(f"rm -r {tmp_out}", shell=True)
+    # Only probe mapping the variants in one shard of the genome should
+    # give the same records as before, but only those in the shard
+    expect_vcf = os.path.join(data_dir, "make_truth_vcf.expect.vcf")
+    _, expect_records = utils.vcf_file_to_list(expect_vcf)
+    for shard_index in 1, 2:
+        shard = vcf_shards.GenomeShard(ref_fasta, shard_index, 2)
+        got_vcf = truth_variant_finding.make_truth_vcf(
+            ref_fasta, truth_fasta, tmp_out, 100, to_map=shard
+        )
+        _, got_records = utils.vcf_file_to_list(got_vcf)
+        assert got_records == [x for x in expect_records if shard(x)]
+        subprocess.check_output(f"rm -r {tmp_out}", shell=True)
 
 
 
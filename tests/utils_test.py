@@ -1,9 +1,13 @@
 import filecmp
 import os
+import pickle
 import pytest
+import shutil
 import subprocess
 
 import pyfastaq
+import pysam
+import pysam.bcftools
 from cluster_vcf_records import vcf_record
 
 from varifier import utils
@@ -14,11 +18,28 @@ data_dir = os.path.join(this_dir, "data", "utils")
 
 def test_load_mask_bed_file():
     mask_bed_file = os.path.join(data_dir, "load_mask_bed_file.bed")
-    expect = {"ref1": {42, 43, 44, 45, 47}, "ref2": {9, 10, 11}}
+    expect = {
+        "ref1": utils.IntervalMask([(42, 46), (47, 48)]),
+        "ref2": utils.IntervalMask([(9, 12)]),
+    }
     got_mask = utils.load_mask_bed_file(mask_bed_file)
     assert got_mask == expect
 
 
+def test_interval_mask():
+    mask = utils.IntervalMask([(10, 12), (2, 5), (4, 6), (6, 7), (15, 15)])
+    assert list(mask) == [(2, 7), (10, 12)]
+    assert len(mask) == 2
+    assert [i for i in range(15) if i in mask] == [2, 3, 4, 5, 6, 10, 11]
+    assert not mask.overlaps(0, 2)
+    assert mask.overlaps(0, 3)
+    assert mask.overlaps(6, 10)
+    assert not mask.overlaps(7, 10)
+    assert mask.overlaps(11, 20)
+    assert not mask.overlaps(12, 20)
+    assert not utils.IntervalMask().overlaps(0, 100)
+
+
 def test_mask_vcf_file():
     vcf_in = os.path.join(data_dir, "mask_vcf_file.in.vcf")
     vcf_expect = os.path.join(data_dir, "mask_vcf_file.expect.vcf")
@@ -28,6 +49,114 @@ def test_mask_vcf_file():
     utils.mask_vcf_file(vcf_in, mask_bed_file, tmp_out)
     assert filecmp.cmp(tmp_out, vcf_expect, shallow=False)
     os.unlink(tmp_out)
+    mask = utils.load_mask_bed_file(mask_bed_file)
+    utils.mask_vcf_file(vcf_in, mask, tmp_out)
+    assert filecmp.cmp(tmp_out, vcf_expect, shallow=False)
+    os.unlink(tmp_out)
+
+
+def test_mask_sweep():
+    mask = {"ref1": utils.IntervalMask([(10, 20), (30, 40), (50, 60)])}
+    sweep = utils.MaskSweep(mask)
+    assert not sweep.overlaps("ref1", 0, 10)
+    assert sweep.overlaps("ref1", 5, 11)
+    assert sweep.overlaps("ref1", 19, 25)
+    assert not sweep.overlaps("ref1", 20, 30)
+    assert not sweep.overlaps("ref2", 20, 30)
+    assert sweep.overlaps("ref1", 55, 56)
+    assert not sweep.overlaps("ref1", 60, 100)
+    # Out of order
+    assert sweep.overlaps("ref1", 35, 36)
+    assert not sweep.overlaps("ref1", 0, 10)
+    assert sweep.overlaps("ref1", 39, 45)
+    assert not sweep.overlaps("ref1", 40, 50)
+
+
+def test_vcf_lines_not_in_mask():
+    mask = utils.load_mask_bed_file(os.path.join(data_dir, "mask_vcf_file.in.bed"))
+    with open(os.path.join(data_dir, "mask_vcf_file.in.vcf")) as f:
+        got = list(utils.vcf_lines_not_in_mask(f, mask))
+    with open(os.path.join(data_dir, "mask_vcf_file.expect.vcf")) as f:
+        assert got == f.readlines()
+
+
+def test_open_vcf_file_for_reading_and_writing():
+    vcf_in = os.path.join(data_dir, "open_vcf_file.vcf")
+    with open(vcf_in) as f:
+        expect_lines = f.readlines()
+    expect_header, expect_records = utils.vcf_file_to_list(vcf_in)
+    assert [str(x) for x in expect_records] == [
+        x.rstrip() for x in expect_lines if not x.startswith("#")
+    ]
+
+    tmp_vcf = "tmp.open_vcf_file.vcf.gz"
+    subprocess.check_output(f"rm -f {tmp_vcf}*", shell=True)
+    with utils.open_vcf_file_for_writing(tmp_vcf) as f:
+        print(*expect_lines, sep="", end="", file=f)
+    utils.index_vcf_file(tmp_vcf)
+    assert os.path.exists(f"{tmp_vcf}.tbi")
+    with utils.open_vcf_file_for_reading(tmp_vcf) as f:
+        assert list(f) == expect_lines
+    assert utils.vcf_file_to_list(tmp_vcf) == (expect_header, expect_records)
+
+    tmp_bcf = "tmp.open_vcf_file.bcf"
+    with pysam.VariantFile(tmp_vcf) as f_in:
+        with pysam.VariantFile(tmp_bcf, "wb", header=f_in.header) as f_out:
+            for record in f_in:
+                f_out.write(record)
+    assert utils.vcf_file_to_list(tmp_bcf)[1] == expect_records
+    os.unlink(tmp_bcf)
+    subprocess.check_output(f"rm {tmp_vcf}*", shell=True)
+
+
+def test_load_regions():
+    expect = {
+        "ref1": utils.IntervalMask([(10, 11), (19, 30)]),
+        "ref2": utils.IntervalMask([(0, 60)]),
+    }
+    bed_file = os.path.join(data_dir, "vcf_lines_in_regions.bed")
+    assert utils.load_regions(bed_file) == expect
+    assert utils.load_regions("ref1:11-11,ref2:1-60, ref1:20-30") == expect
+    assert utils.load_regions(expect) is expect
+    for bad_regions in "ref1", "ref1:10", "ref1:0-10", "ref1:10-9":
+        with pytest.raises(RuntimeError):
+            utils.load_regions(bad_regions)
+
+
+def test_vcf_lines_in_regions():
+    vcf_in = os.path.join(data_dir, "vcf_lines_in_regions.vcf")
+    regions = utils.load_regions("ref1:11-11,ref1:20-30,ref2:1-60")
+    with open(vcf_in) as f:
+        lines = f.readlines()
+    expect_records = [lines[i] for i in (8, 9, 11, 12)]
+    expect_lines = lines[:7] + expect_records
+    assert list(utils.vcf_lines_in_regions(vcf_in, regions)) == expect_lines
+
+    # Bgzipped, first without and then with an index
+    tmp_vcf = "tmp.vcf_lines_in_regions.vcf.gz"
+    subprocess.check_output(f"rm -f {tmp_vcf}*", shell=True)
+    with utils.open_vcf_file_for_writing(tmp_vcf) as f:
+        print(*lines, sep="", end="", file=f)
+    assert list(utils.vcf_lines_in_regions(tmp_vcf, regions)) == expect_lines
+    utils.index_vcf_file(tmp_vcf)
+    assert utils._fetch_vcf_lines_in_regions(tmp_vcf, regions) is not None
+    assert list(utils.vcf_lines_in_regions(tmp_vcf, regions)) == expect_lines
+
+    tmp_bcf = "tmp.vcf_lines_in_regions.bcf"
+    with pysam.VariantFile(tmp_vcf) as f_in:
+        with pysam.VariantFile(tmp_bcf, "wb", header=f_in.header) as f_out:
+            for record in f_in:
+                f_out.write(record)
+    pysam.bcftools.index(tmp_bcf)
+    assert utils._fetch_vcf_lines_in_regions(tmp_bcf, regions) is not None
+    got = list(utils.vcf_lines_in_regions(tmp_bcf, regions))
+    assert [x for x in got if not x.startswith("#")] == expect_records
+
+    tmp_out = "tmp.vcf_lines_in_regions.out.vcf"
+    utils.restrict_vcf_file_to_regions(tmp_bcf, regions, tmp_out)
+    got_records = utils.vcf_file_to_list(tmp_out)[1]
+    assert [str(x) + "\n" for x in got_records] == expect_records
+    subprocess.check_output(f"rm {tmp_vcf}* {tmp_bcf}* {tmp_out}", shell=True)
 
 
 def test_file_to_dict_of_seqs():
@@ -40,3 +169,63 @@ def test_file_to_dict_of_seqs():
     for k, v in x.items():
         print(k, v)
     assert utils.file_to_dict_of_seqs(infile) == expect
+
+
+def test_indexed_fasta():
+    infile = os.path.join(data_dir, "indexed_dict_of_seqs.fa")
+    expect = utils.file_to_dict_of_seqs(infile)
+    got = utils.IndexedFasta(infile, block_size=7, max_blocks=4)
+    assert list(got.keys()) == ["seq1", "seq2", "seq3"]
+    assert "seq1" in got
+    assert "seq4" not in got
+    for name, expect_seq in expect.items():
+        got_seq = got[name]
+        assert got_seq.id == expect_seq.id
+        assert len(got_seq) == len(expect_seq)
+        assert got_seq.seq == expect_seq.seq
+        assert str(got_seq) == str(expect_seq)
+        for start in range(len(expect_seq) + 2):
+            if start < len(expect_seq):
+                assert got_seq[start] == expect_seq[start]
+            for end in range(start, len(expect_seq) + 2):
+                assert got_seq[start:end] == expect_seq[start:end]
+        assert got_seq[-1] == expect_seq[-1]
+        assert got_seq[::2] == expect_seq.seq[::2]
+        with pytest.raises(IndexError):
+            got_seq[len(expect_seq)]
+
+    # A pickled copy opens the file itself
+    unpickled = pickle.loads(pickle.dumps(got))
+    assert unpickled["seq1"].seq == expect["seq1"].seq
+    assert unpickled["seq2"][10:20] == expect["seq2"][10:20]
+
+
+def test_indexed_dict_of_seqs():
+    infile = os.path.join(data_dir, "indexed_dict_of_seqs.fa")
+    got = utils.indexed_dict_of_seqs(infile)
+    assert isinstance(got, utils.IndexedFasta)
+    assert utils.indexed_dict_of_seqs(infile) is got
+
+    # Cannot be indexed because the line lengths are inconsistent, so
+    # should get the sequences loaded into memory instead
+    infile = os.path.join(data_dir, "indexed_dict_of_seqs.bad_lines.fa")
+    got = utils.indexed_dict_of_seqs(infile)
+    assert got == utils.file_to_dict_of_seqs(infile)
+
+
+def test_indexed_dict_of_seqs_evicts_least_recently_used():
+    infile = os.path.join(data_dir, "indexed_dict_of_seqs.fa")
+    expect = utils.file_to_dict_of_seqs(infile)
+    tmp_fastas = [f"tmp.indexed_dict_of_seqs.{i}.fa" for i in range(6)]
+    for filename in tmp_fastas:
+        shutil.copyfile(infile, filename)
+    first = utils.indexed_dict_of_seqs(tmp_fastas[0])
+    for filename in tmp_fastas[1:]:
+        utils.indexed_dict_of_seqs(filename)
+    assert len(utils._indexed_fastas) == utils._indexed_fastas_max_size
+    # The first one was evicted and closed, but can still be used
+    assert first._fasta is None
+    assert first["seq1"].seq == expect["seq1"].seq
+    assert utils.indexed_dict_of_seqs(tmp_fastas[0]) is not first
+    for filename in tmp_fastas:
+        os.unlink(filename)
@@ -1,5 +1,6 @@
 import copy
 import filecmp
+import json
 import os
 import pytest
 import subprocess
@@ -89,3 +90,301 @@ def test_evaluate_vcf():
     summary_stats_got_json = os.path.join(tmp_out, "summary_stats.json")
     assert filecmp.cmp(summary_stats_got_json, summary_stats_expect_json, shallow=False)
     subprocess.check_output(f"rm -r {tmp_out}", shell=True)
+
+
+def test_write_summary_stats_table():
+    stats = {
+        "Precision": {
+            "ALL": {
+                "Precision": 0.9,
+                "Precision_frac": 0.95,
+                "Precision_edit_dist": 0.8,
+                "TP": {"Count": 9},
+                "FP": {"Count": 1},
+            },
+            "FILT": {
+                "Precision": 1,
+                "Precision_frac": 1,
+                "Precision_edit_dist": 1,
+                "TP": {"Count": 5},
+                "FP": {"Count": 0},
+            },
+        },
+        "Recall": {
+            "ALL": {
+                "Recall": 0.5,
+                "Recall_frac": 0.6,
+                "Recall_edit_dist": 0.7,
+                "TP": {"Count": 9},
+                "FN": {"Count": 9},
+            },
+            "FILT": {
+                "Recall": 0.25,
+                "Recall_frac": 0.3,
+                "Recall_edit_dist": 0.35,
+                "TP": {"Count": 5},
+                "FN": {"Count": 15},
+            },
+        },
+    }
+    tmp_tsv = "tmp.vcf_evaluate.write_summary_stats_table.tsv"
+    vcf_evaluate.write_summary_stats_table(
+        ["x", "y"], ["x.vcf", "y.vcf"], [stats, stats], tmp_tsv
+    )
+    with open(tmp_tsv) as f:
+        lines = [x.rstrip().split("\t") for x in f]
+    os.unlink(tmp_tsv)
+    assert len(lines) == 3
+    assert lines[0][:7] == [
+        "Name",
+        "VCF",
+        "Precision_ALL",
+        "Precision_ALL_frac",
+        "Precision_ALL_edit_dist",
+        "Precision_ALL_TP",
+        "Precision_ALL_FP",
+    ]
+    assert lines[0][-1] == "Recall_FILT_FN"
+    got = dict(zip(lines[0], lines[2]))
+    assert got["Name"] == "y"
+    assert got["VCF"] == "y.vcf"
+    assert got["Precision_ALL"] == "0.9"
+    assert got["Recall_FILT_FN"] == "15"
+
+
+def test_evaluate_vcfs():
+    # Each VCF file should get the same results as evaluating it on its own
+    truth_fasta = os.path.join(data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(data_dir, "evaluate_vcf.to_eval.vcf")
+    truth_vcf = os.path.join(data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_out = "tmp.vcf_evaluate.evaluate_vcfs.out"
+    tmp_out_single = "tmp.vcf_evaluate.evaluate_vcfs.single.out"
+    subprocess.check_output(f"rm -rf {tmp_out} {tmp_out_single}", shell=True)
+    vcf_evaluate.evaluate_vcf(
+        vcf_to_eval, ref_fasta, truth_fasta, 100, tmp_out_single, truth_vcf=truth_vcf
+    )
+    expect_json = os.path.join(tmp_out_single, "summary_stats.json")
+
+    for parallel in 1, 2:
+        got = vcf_evaluate.evaluate_vcfs(
+            [vcf_to_eval, vcf_to_eval],
+            ref_fasta,
+            truth_fasta,
+            100,
+            tmp_out,
+            names=["a", "b"],
+            truth_vcf=truth_vcf,
+            force=True,
+            parallel=parallel,
+        )
+        assert len(got) == 2
+        assert got[0] == got[1]
+        for name in "a", "b":
+            got_json = os.path.join(tmp_out, "callers", name, "summary_stats.json")
+            assert filecmp.cmp(got_json, expect_json, shallow=False)
+        assert sorted(os.listdir(tmp_out)) == ["callers", "summary_stats.tsv"]
+
+    with pytest.raises(RuntimeError):
+        vcf_evaluate.evaluate_vcfs(
+            [vcf_to_eval, vcf_to_eval], ref_fasta, truth_fasta, 100, tmp_out, force=True
+        )
+    subprocess.check_output(f"rm -r {tmp_out} {tmp_out_single}", shell=True)
+
+
+def test_evaluate_vcf_processes():
+    # With 2 or more processes, the ALL and FILT recall runs are done at
+    # the same time, sharing the processes. Results should not change
+    truth_fasta = os.path.join(data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(data_dir, "evaluate_vcf.to_eval.vcf")
+    truth_vcf = os.path.join(data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_out = "tmp.vcf_evaluate.evaluate_vcf_processes"
+    subprocess.check_output(f"rm -rf {tmp_out}", shell=True)
+    os.mkdir(tmp_out)
+    summary_stats = []
+    for processes in 1, 3:
+        outdir = os.path.join(tmp_out, str(processes))
+        vcf_evaluate.evaluate_vcf(
+            vcf_to_eval,
+            ref_fasta,
+            truth_fasta,
+            100,
+            outdir,
+            truth_vcf=truth_vcf,
+            processes=processes,
+        )
+        with open(os.path.join(outdir, "summary_stats.json")) as f:
+            summary_stats.append(json.load(f))
+    assert summary_stats[0] == summary_stats[1]
+    subprocess.check_output(f"rm -r {tmp_out}", shell=True)
+
+
+def test_evaluate_vcf_with_regions():
+    truth_fasta = os.path.join(data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(data_dir, "evaluate_vcf.to_eval.vcf")
+    truth_vcf = os.path.join(data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_out = "tmp.vcf_evaluate.evaluate_vcf_with_regions.out"
+    subprocess.check_output(f"rm -rf {tmp_out}", shell=True)
+    vcf_evaluate.evaluate_vcf(
+        vcf_to_eval,
+        ref_fasta,
+        truth_fasta,
+        100,
+        tmp_out,
+        truth_vcf=truth_vcf,
+        regions="ref:200-400",
+    )
+    with open(os.path.join(tmp_out, "summary_stats.json")) as f:
+        got = json.load(f)
+    # The calls and truth variants at 250, 300, 302, 306 and 309
+    precision = got["Precision"]["ALL"]
+    assert precision["TP"]["Count"] + precision["FP"]["Count"] == 5
+    recall = got["Recall"]["ALL"]
+    assert recall["TP"]["Count"] + recall["FN"]["Count"] == 5
+    assert not os.path.exists(
+        os.path.join(tmp_out, "variants_to_eval.regions.vcf")
+    )
+    subprocess.check_output(f"rm -r {tmp_out}", shell=True)
+
+
+def test_evaluate_vcf_with_curve():
+    truth_fasta = os.path.join(data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(data_dir, "evaluate_vcf.to_eval.gt_conf.vcf")
+    truth_vcf = os.path.join(data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_out = "tmp.vcf_evaluate.evaluate_vcf_with_curve.out"
+    subprocess.check_output(f"rm -rf {tmp_out}", shell=True)
+    vcf_evaluate.evaluate_vcf(
+        vcf_to_eval,
+        ref_fasta,
+        truth_fasta,
+        100,
+        tmp_out,
+        truth_vcf=truth_vcf,
+        curve_by="GT_CONF",
+    )
+    with open(os.path.join(tmp_out, "summary_stats.json")) as f:
+        summary_stats = json.load(f)
+    with open(os.path.join(tmp_out, "curve.GT_CONF.json")) as f:
+        got = json.load(f)
+    assert got["score"] == "GT_CONF"
+    curve = got["curve"]
+    thresholds = [x["Threshold"] for x in curve]
+    assert thresholds == sorted(set(thresholds))
+    with open(os.path.join(tmp_out, "curve.GT_CONF.tsv")) as f:
+        lines = [x.rstrip().split("\t") for x in f]
+    assert lines[0] == list(curve[0].keys())
+    assert len(lines) == len(curve) + 1
+
+    # Every call has a GT_CONF, so the lowest threshold keeps all of them
+    precision = summary_stats["Precision"]["ALL"]
+    assert curve[0]["Calls"] == precision["TP"]["Count"] + precision["FP"]["Count"]
+    for key in "Precision", "Precision_frac", "Precision_edit_dist":
+        assert curve[0][key] == precision[key]
+    assert curve[0]["Recall_estimate"] == summary_stats["Recall"]["ALL"]["Recall"]
+    assert curve[-1]["Calls"] == 1
+    subprocess.check_output(f"rm -r {tmp_out}", shell=True)
+
+
+def test_summarise_evaluation():
+    truth_fasta = os.path.join(data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(data_dir, "evaluate_vcf.to_eval.gt_conf.vcf")
+    truth_vcf = os.path.join(data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_out = "tmp.vcf_evaluate.summarise_evaluation.out"
+    subprocess.check_output(f"rm -rf {tmp_out}", shell=True)
+    vcf_evaluate.evaluate_vcf(
+        vcf_to_eval,
+        ref_fasta,
+        truth_fasta,
+        100,
+        tmp_out,
+        truth_vcf=truth_vcf,
+        curve_by="GT_CONF",
+    )
+    assert os.path.exists(os.path.join(tmp_out, "per_record_stats.npz"))
+    with open(os.path.join(tmp_out, "summary_stats.json")) as f:
+        expect = json.load(f)
+    with open(os.path.join(tmp_out, "curve.GT_CONF.json")) as f:
+        curve = {x["Threshold"]: x for x in json.load(f)["curve"]}
+    tmp_json = f"{tmp_out}.json"
+    got = vcf_evaluate.summarise_evaluation(tmp_out, tmp_json)
+    assert got == expect
+    with open(tmp_json) as f:
+        assert json.load(f) == expect
+
+    # Same calls and truth variants as test_evaluate_vcf_with_regions()
+    got = vcf_evaluate.summarise_evaluation(tmp_out, tmp_json, regions="ref:200-400")
+    precision = got["Precision"]["ALL"]
+    assert precision["TP"]["Count"] + precision["FP"]["Count"] == 5
+    recall = got["Recall"]["ALL"]
+    assert recall["TP"]["Count"] + recall["FN"]["Count"] == 5
+
+    got = vcf_evaluate.summarise_evaluation(
+        tmp_out, tmp_json, calls_filter_expression="GT_CONF >= 30"
+    )
+    assert got["Precision"]["ALL"]["Precision"] == curve[30]["Precision"]
+    assert got["Precision"]["ALL"]["TP"]["Count"] == curve[30]["TP"]
+    assert got["Recall"] == expect["Recall"]
+
+    got = vcf_evaluate.summarise_evaluation(
+        tmp_out, tmp_json, filter_expression="REF_LEN == 1 and ALT_LEN == 1"
+    )
+    precision = got["Precision"]["ALL"]
+    assert 0 < precision["TP"]["Count"] < expect["Precision"]["ALL"]["TP"]["Count"]
+
+    mask_bed = f"{tmp_out}.bed"
+    with open(mask_bed, "w") as f:
+        print("ref", 0, 1000, sep="\t", file=f)
+    got = vcf_evaluate.summarise_evaluation(tmp_out, tmp_json, mask_bed_file=mask_bed)
+    assert got["Precision"]["ALL"]["TP"]["Count"] == 0
+    assert got["Recall"]["ALL"]["TP"]["Count"] == 0
+    subprocess.check_output(f"rm -r {tmp_out} {tmp_json} {mask_bed}", shell=True)
+
+
+def test_evaluate_vcf_shards_and_merge_evaluations():
+    truth_fasta = os.path.join(data_dir, "evaluate_vcf.truth.fa")
+    ref_fasta = os.path.join(data_dir, "evaluate_vcf.ref.fa")
+    vcf_to_eval = os.path.join(data_dir, "evaluate_vcf.to_eval.vcf")
+    truth_vcf = os.path.join(data_dir, "evaluate_vcfs.truth.vcf")
+    tmp_out = "tmp.vcf_evaluate.evaluate_vcf_shards"
+    subprocess.check_output(f"rm -rf {tmp_out}", shell=True)
+    os.mkdir(tmp_out)
+    expect_dir = os.path.join(tmp_out, "no_shards")
+    vcf_evaluate.evaluate_vcf(
+        vcf_to_eval, ref_fasta, truth_fasta, 100, expect_dir, truth_vcf=truth_vcf
+    )
+    with open(os.path.join(expect_dir, "summary_stats.json")) as f:
+        expect = json.load(f)
+
+    shard_dirs = [os.path.join(tmp_out, f"shard.{i}") for i in range(1, 4)]
+    for i, shard_dir in enumerate(shard_dirs):
+        vcf_evaluate.evaluate_vcf(
+            vcf_to_eval,
+            ref_fasta,
+            truth_fasta,
+            100,
+            shard_dir,
+            truth_vcf=truth_vcf,
+            processes=2 if i == 0 else 1,
+            shard=f"{i + 1}/3",
+        )
+        assert not os.path.exists(os.path.join(shard_dir, "summary_stats.json"))
+        assert os.path.exists(os.path.join(shard_dir, "per_record_stats.npz"))
+
+    merged_dir = os.path.join(tmp_out, "merged")
+    got = vcf_evaluate.merge_evaluations(shard_dirs[::-1], merged_dir)
+    assert got == expect
+    assert filecmp.cmp(
+        os.path.join(merged_dir, "summary_stats.json"),
+        os.path.join(expect_dir, "summary_stats.json"),
+        shallow=False,
+    )
+
+    with pytest.raises(RuntimeError):
+        vcf_evaluate.merge_evaluations(shard_dirs[:2], merged_dir, force=True)
+    with pytest.raises(RuntimeError):
+        vcf_evaluate.merge_evaluations(shard_dirs[:1] * 3, merged_dir, force=True)
+    subprocess.check_output(f"rm -r {tmp_out}", shell=True)
@@ -145,3 +145,63 @@ def test_add_qc_to_vcf():
     vcf_qc_annotate.add_qc_to_vcf(infile, outfile, want_ref_calls=False)
     assert filecmp.cmp(outfile, expect_not_want_ref, shallow=False)
     os.unlink(outfile)
+
+
+def test_records_sorted_after_trimming():
+    records = [
+        vcf_record.VcfRecord("ref1\t1\t1\tACGTA\tACGA\t.\tPASS\t.\tGT\t1/1"),
+        vcf_record.VcfRecord("ref1\t2\t2\tC\tT\t.\tPASS\t.\tGT\t1/1"),
+        vcf_record.VcfRecord("ref1\t3\t3\tG\tT\t.\tPASS\t.\tGT\t1/1"),
+        vcf_record.VcfRecord("ref1\t3\t4\tGT\tGA\t.\tPASS\t.\tGT\t1/1"),
+        vcf_record.VcfRecord("ref1\t4\t5\tT\tA\t.\tPASS\t.\tGT\t1/1"),
+        vcf_record.VcfRecord("ref0\t1\t6\tAC\tAG\t.\tPASS\t.\tGT\t1/1"),
+        vcf_record.VcfRecord("ref0\t2\t7\tC\tT\t.\tPASS\t.\tGT\t1/1"),
+    ]
+    got = list(vcf_qc_annotate._records_sorted_after_trimming(records))
+    assert [(x.CHROM, x.POS, x.ID) for x in got] == [
+        ("ref1", 1, "2"),
+        ("ref1", 2, "1"),
+        ("ref1", 2, "3"),
+        ("ref1", 2, "4"),
+        ("ref1", 3, "5"),
+        ("ref0", 0, "6"),
+        ("ref0", 1, "7"),
+    ]
+    assert got[1].REF == "GTA"
+
+
+def test_vcf_is_sorted():
+    assert vcf_qc_annotate._vcf_is_sorted(
+        os.path.join(data_dir, "add_qc_to_vcf.in.vcf")
+    )
+    assert not vcf_qc_annotate._vcf_is_sorted(
+        os.path.join(data_dir, "qc_annotated_records.unsorted.vcf")
+    )
+    assert vcf_qc_annotate._vcf_is_sorted(
+        os.path.join(data_dir, "qc_annotated_records.sorted.vcf")
+    )
+
+
+def test_qc_annotated_records():
+    # Sorted input is streamed, keeping the order of the CHROMs. Unsorted
+    # input is sorted, with the CHROMs in alphabetical order
+    for filename, expect_ids in (
+        ("qc_annotated_records.sorted.vcf", ["1", "3", "2", "4", "5"]),
+        ("qc_annotated_records.unsorted.vcf", ["4", "5", "1", "3", "2"]),
+    ):
+        records = vcf_qc_annotate.qc_annotated_records(
+            os.path.join(data_dir, filename)
+        )
+        header_lines = next(records)
+        assert header_lines[-1].startswith("#CHROM")
+        assert header_lines[-2].startswith("##FORMAT=<ID=VFR_FILTER,")
+        records = list(records)
+        assert [x.ID for x in records] == expect_ids
+        filters = {x.ID: x.FORMAT["VFR_FILTER"] for x in records}
+        assert filters == {
+            "1": "FAIL_CONFLICT",
+            "2": "PASS",
+            "3": "FAIL_CONFLICT",
+            "4": "PASS",
+            "5": "CANNOT_USE_GT",
+        }
@@ -0,0 +1,75 @@
+import filecmp
+import os
+import pytest
+import subprocess
+
+from cluster_vcf_records import vcf_file_read, vcf_record
+
+from varifier import genome, utils, vcf_shards
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(this_dir, "data", "vcf_shards")
+
+
+def test_split_and_merge_vcf_file_multi_chrom():
+    vcf_in = os.path.join(data_dir, "split_vcf_file.multi_chrom.vcf")
+    tmp_dir = "tmp.split_vcf_file.multi_chrom"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    os.mkdir(tmp_dir)
+    shard_files = vcf_shards.split_vcf_file(vcf_in, tmp_dir, window_size=10)
+    assert len(shard_files) == 3
+    got_chroms = []
+    for filename in shard_files:
+        _, records = vcf_file_read.vcf_file_to_list(filename)
+        got_chroms.append({x.CHROM for x in records})
+    assert got_chroms == [{"ref2"}, {"ref1"}, {"ref3"}]
+
+    tmp_vcf = os.path.join(tmp_dir, "merged.vcf")
+    vcf_shards.merge_vcf_files(list(reversed(shard_files)), tmp_vcf)
+    _, records = vcf_file_read.vcf_file_to_list(tmp_vcf)
+    assert [x.ID for x in records] == ["5", "3", "4", "1", "2"]
+    vcf_shards.merge_vcf_files(shard_files, tmp_vcf)
+    assert filecmp.cmp(vcf_in, tmp_vcf, shallow=False)
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
+
+
+def test_split_and_merge_vcf_file_one_chrom():
+    vcf_in = os.path.join(data_dir, "split_vcf_file.one_chrom.vcf")
+    tmp_dir = "tmp.split_vcf_file.one_chrom"
+    subprocess.check_output(f"rm -rf {tmp_dir}", shell=True)
+    os.mkdir(tmp_dir)
+    shard_files = vcf_shards.split_vcf_file(vcf_in, tmp_dir, window_size=10)
+    got_ids = []
+    for filename in shard_files:
+        _, records = vcf_file_read.vcf_file_to_list(filename)
+        got_ids.append([x.ID for x in records])
+    assert got_ids == [["1", "2", "3"], ["4"], ["5"]]
+
+    tmp_vcf = os.path.join(tmp_dir, "merged.vcf")
+    vcf_shards.merge_vcf_files(list(reversed(shard_files)), tmp_vcf)
+    assert filecmp.cmp(vcf_in, tmp_vcf, shallow=False)
+    subprocess.check_output(f"rm -r {tmp_dir}", shell=True)
+
+
+def test_parse_shard():
+    assert vcf_shards.parse_shard("1/1") == (1, 1)
+    assert vcf_shards.parse_shard("2/10") == (2, 10)
+    for bad_shard in "0/2", "3/2", "1", "1/2/3", "a/b":
+        with pytest.raises(RuntimeError):
+            vcf_shards.parse_shard(bad_shard)
+
+
+def test_genome_shard():
+    ref = genome.Genome(None, seqs={"ref1": "A" * 10, "ref2": "C" * 5})
+    shards = [vcf_shards.GenomeShard(ref, i, 3) for i in (1, 2, 3)]
+    assert [x.regions for x in shards] == [
+        {"ref1": utils.IntervalMask([(0, 5)])},
+        {"ref1": utils.IntervalMask([(5, 10)])},
+        {"ref2": utils.IntervalMask([(0, 5)])},
+    ]
+    for chrom, length in ("ref1", 10), ("ref2", 5):
+        for pos in range(length):
+            assert sum(x.contains(chrom, pos) for x in shards) == 1
+    assert [x.contains("ref3", 0) for x in shards] == [True, False, False]
+    record = vcf_record.VcfRecord("ref1\t6\t.\tA\tG\t.\tPASS\t.\tGT\t1/1")
+    assert [x(record) for x in shards] == [False, True, False]
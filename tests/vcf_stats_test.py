@@ -1,9 +1,11 @@
+import json
 import os
+import random
 import pytest
 
 from cluster_vcf_records import vcf_record
 
-from varifier import vcf_stats
+from varifier import utils, vcf_stats
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "vcf_stats")
@@ -98,6 +100,8 @@ def test_per_record_stats_from_vcf_file():
             "GT_CONF": 100.0,
             "GT_CONF_PERCENTILE": 0.12,
             "POS": 1,
+            "REF_LEN": 1,
+            "ALT_LEN": 1,
             "VFR_IN_MASK": 1,
             "VFR_ED_RA": 1,
             "VFR_ED_TR": 0,
@@ -116,6 +120,8 @@ def test_per_record_stats_from_vcf_file():
             "GT_CONF": 200.0,
             "GT_CONF_PERCENTILE": 0.95,
             "POS": 2,
+            "REF_LEN": 1,
+            "ALT_LEN": 1,
             "VFR_IN_MASK": 0,
             "VFR_ED_RA": 1,
             "VFR_ED_TR": 0,
@@ -130,6 +136,8 @@ def test_per_record_stats_from_vcf_file():
     got = vcf_stats.per_record_stats_from_vcf_file(infile)
     print(got)
     assert got == expect
+    got = list(vcf_stats.iter_per_record_stats_from_vcf_file(infile))
+    assert got == expect
 
 
 def test_summary_stats_from_per_record_stats():
@@ -221,3 +229,277 @@ def test_summary_stats_from_per_record_stats():
         del expect[all_or_filt]["FP"]
     got = vcf_stats.summary_stats_from_per_record_stats(record_stats, for_recall=True)
     assert got == expect
+
+
+def test_summary_stats_accumulator():
+    record_stats = [
+        {"VFR_FILTER": "FAIL_CONFLICT"},
+        {
+            "VFR_FILTER": "PASS",
+            "VFR_RESULT": "TP",
+            "VFR_ALLELE_MATCH_FRAC": 1.0,
+            "VFR_ED_RA": 1,
+            "VFR_ED_TR": 1,
+            "VFR_ED_TA": 0,
+        },
+        {
+            "VFR_FILTER": "FAIL_BUT_TEST",
+            "VFR_RESULT": "FP",
+            "VFR_ALLELE_MATCH_FRAC": "NA",
+            "VFR_ED_RA": 2,
+            "VFR_ED_TR": "NA",
+            "VFR_ED_TA": "NA",
+        },
+        {"VFR_FILTER": "PASS", "VFR_IN_MASK": 1},
+        {
+            "VFR_FILTER": "PASS",
+            "VFR_RESULT": "Partial_TP",
+            "VFR_ALLELE_MATCH_FRAC": 0.5,
+            "VFR_ED_RA": 3,
+            "VFR_ED_TR": 3,
+            "VFR_ED_TA": 1,
+        },
+    ]
+    for for_recall in False, True:
+        expect = vcf_stats.summary_stats_from_per_record_stats(
+            record_stats, for_recall=for_recall
+        )
+        for split in range(len(record_stats) + 1):
+            accumulators = []
+            for records in record_stats[:split], record_stats[split:]:
+                accumulator = vcf_stats.SummaryStatsAccumulator(for_recall=for_recall)
+                for d in records:
+                    accumulator.add(d)
+                accumulators.append(accumulator)
+            saved = [x.summary_stats() for x in accumulators]
+            accumulators[0].merge(accumulators[1])
+            assert accumulators[0].summary_stats() == expect
+            # Same again, starting from the saved stats of each part
+            accumulators = [
+                vcf_stats.SummaryStatsAccumulator(for_recall=for_recall, stats=x)
+                for x in saved
+            ]
+            accumulators[0].merge(accumulators[1])
+            assert accumulators[0].summary_stats() == expect
+
+    assert expect["UNUSED"] == {"CONFLICT": 1, "OTHER": 0, "MASKED": 1}
+    assert expect["ALL"]["FN"]["Count"] == 2
+    assert expect["FILT"]["FN"]["SUM_EDIT_DIST"] == 3
+
+    accumulator = vcf_stats.SummaryStatsAccumulator()
+    with pytest.raises(RuntimeError):
+        accumulator.merge(vcf_stats.SummaryStatsAccumulator(for_recall=True))
+    # The summary stats are a copy, so do not change when more records are added
+    got = accumulator.summary_stats()
+    accumulator.add(record_stats[1])
+    assert got["ALL"]["TP"]["Count"] == 0
+    assert accumulator.summary_stats()["ALL"]["TP"]["Count"] == 1
+
+
+def test_summary_stats_from_vcf_file(monkeypatch):
+    infile = os.path.join(data_dir, "per_record_stats_from_vcf_file.vcf")
+    per_record_stats = vcf_stats.per_record_stats_from_vcf_file(infile)
+    expect = {
+        for_recall: vcf_stats.summary_stats_from_per_record_stats(
+            per_record_stats, for_recall=for_recall
+        )
+        for for_recall in (False, True)
+    }
+
+    # The records are streamed, without making a table of all of them
+    def no_table(*args, **kwargs):
+        raise AssertionError("made a table")
+
+    monkeypatch.setattr(vcf_stats, "per_record_stats_table", no_table)
+    for for_recall in False, True:
+        got = vcf_stats.summary_stats_from_vcf_file(infile, for_recall=for_recall)
+        assert got == expect[for_recall]
+
+
+def test_concat_per_record_stats_tables():
+    infile = os.path.join(data_dir, "per_record_stats_from_vcf_file.vcf")
+    per_record_stats = vcf_stats.per_record_stats_from_vcf_file(infile)
+    expect = vcf_stats.per_record_stats_table(per_record_stats)
+    tables = [
+        vcf_stats.per_record_stats_table(per_record_stats[:1]),
+        vcf_stats.per_record_stats_table([]),
+        vcf_stats.per_record_stats_table(per_record_stats[1:]),
+    ]
+    got = vcf_stats.concat_per_record_stats_tables(tables)
+    assert got.equals(expect)
+    assert got["CHROM"].dtype == "category"
+
+
+def test_per_record_stats_table_chunks():
+    infile = os.path.join(data_dir, "per_record_stats_from_vcf_file.vcf")
+    per_record_stats = vcf_stats.per_record_stats_from_vcf_file(infile) * 3
+    expect = vcf_stats.per_record_stats_table(per_record_stats)
+    for chunk_size in 1, 2, 6, 7:
+        got = vcf_stats.per_record_stats_table(
+            iter(per_record_stats), chunk_size=chunk_size
+        )
+        assert got.equals(expect)
+    assert list(expect["CHROM"].cat.categories) == ["ref1", "ref2"]
+
+
+def test_per_record_stats_table_column_types():
+    infile = os.path.join(data_dir, "per_record_stats_from_vcf_file.vcf")
+    per_record_stats = vcf_stats.per_record_stats_from_vcf_file(infile)
+    got = vcf_stats.per_record_stats_table(per_record_stats)
+    assert list(got["CHROM"]) == ["ref1", "ref2"]
+    assert list(got["DP"]) == [10, 70]
+    assert got["DP"].dtype == float
+    assert list(got["VFR_RESULT"]) == ["FP", "FP"]
+
+
+def test_summary_stats_from_per_record_table():
+    # The stats from the table should be exactly the same as from adding
+    # one record at a time, including which numbers are ints and floats
+    random.seed(42)
+    values = {
+        "VFR_FILTER": ["PASS", "FAIL_BUT_TEST", "FAIL_CONFLICT", "CANNOT_USE_GT"],
+        "VFR_RESULT": ["TP", "FP", "Partial_TP", "FP_REF_PROBE_BETTER_MATCH"],
+        "VFR_IN_MASK": [0, 1, "NA"],
+        "VFR_ALLELE_MATCH_FRAC": [0.0, 0.1, 0.33, 0.5, 1.0, "NA"],
+        "VFR_ED_RA": [0, 1, 2, 5],
+        "VFR_ED_TR": [0, 1, 3, 7, "NA"],
+        "VFR_ED_TA": [0, 1, 2, "NA"],
+    }
+    for record_count in 0, 1, 10, 500:
+        record_stats = [
+            {k: random.choice(v) for k, v in values.items()}
+            for _ in range(record_count)
+        ]
+        # Remove combinations that probe mapping does not make
+        for d in record_stats:
+            if d["VFR_ED_TR"] == "NA" and d["VFR_ALLELE_MATCH_FRAC"] == "NA":
+                d["VFR_ALLELE_MATCH_FRAC"] = 0.25
+            if d["VFR_ED_TR"] != "NA" and d["VFR_ED_TA"] == "NA":
+                d["VFR_ED_TA"] = 1
+        table = vcf_stats.per_record_stats_table(record_stats)
+        for for_recall in False, True:
+            accumulator = vcf_stats.SummaryStatsAccumulator(for_recall=for_recall)
+            for d in record_stats:
+                accumulator.add(d)
+            expect = accumulator.summary_stats()
+            got = vcf_stats.summary_stats_from_per_record_stats(
+                table, for_recall=for_recall
+            )
+            assert json.dumps(got, sort_keys=True) == json.dumps(expect, sort_keys=True)
+            for i, d in enumerate(record_stats):
+                if d["VFR_RESULT"] == "CANNOT_USE_GT":
+                    continue
+                expect_num, expect_den = vcf_stats.format_dict_to_edit_dist_scores(d)
+                got_num, got_den, _ = vcf_stats.edit_dist_scores_from_table(
+                    table.iloc[i : i + 1]
+                )
+                assert (got_num[0], got_den[0]) == (expect_num, expect_den)
+
+
+def test_precision_recall_curve():
+    def record(gt_conf, vfr_filter, result, match_frac, ed_tr=1):
+        return {
+            "GT_CONF": gt_conf,
+            "VFR_FILTER": vfr_filter,
+            "VFR_IN_MASK": 0,
+            "VFR_RESULT": result,
+            "VFR_ALLELE_MATCH_FRAC": match_frac,
+            "VFR_ED_RA": 1,
+            "VFR_ED_TR": ed_tr,
+            "VFR_ED_TA": 0 if result == "TP" else 1,
+        }
+
+    precision = [
+        record(5, "PASS", "TP", 1.0),
+        record(20, "PASS", "FP", 0.5),
+        record(10, "FAIL_BUT_TEST", "TP", 1.0),
+        record(5, "PASS", "FP", 0.0),
+        record(30, "FAIL_CONFLICT", "TP", 1.0),
+        record("NA", "PASS", "TP", 1.0),
+        record(20, "PASS", "TP", 1.0),
+    ]
+    recall = [record("NA", "PASS", "TP", 1.0)] * 3 + [
+        record("NA", "PASS", "FP", 0.0)
+    ]
+    got = vcf_stats.precision_recall_curve(precision, recall, "GT_CONF")
+    assert list(got.columns) == [
+        "Threshold",
+        "Calls",
+        "TP",
+        "FP",
+        "Precision",
+        "Precision_frac",
+        "Precision_edit_dist",
+        "Recall_estimate",
+    ]
+    assert list(got["Threshold"]) == [5, 10, 20]
+    assert list(got["Calls"]) == [5, 3, 2]
+    assert list(got["TP"]) == [3, 2, 1]
+    assert list(got["FP"]) == [2, 1, 1]
+    assert list(got["Precision"]) == [0.6, round(2 / 3, 8), 0.5]
+    assert list(got["Precision_frac"]) == [0.7, 0.83333333, 0.75]
+    assert list(got["Precision_edit_dist"]) == [0.6, round(2 / 3, 8), 0.5]
+    assert list(got["Recall_estimate"]) == [0.75, 0.5, 0.25]
+
+    # None of the calls have a DP, so are never kept
+    table = vcf_stats.per_record_stats_table(precision)
+    assert vcf_stats.precision_recall_curve(table, recall, "DP").empty
+
+    with pytest.raises(RuntimeError):
+        vcf_stats.precision_recall_curve(precision, recall, "VFR_RESULT")
+
+
+def test_save_and_load_per_record_stats_tables():
+    infile = os.path.join(data_dir, "per_record_stats_from_vcf_file.vcf")
+    tables = {
+        "Precision": vcf_stats.per_record_stats_table(
+            vcf_stats.per_record_stats_from_vcf_file(infile)
+        ),
+        "Recall_ALL": vcf_stats.per_record_stats_table([{"CHROM": "ref1", "POS": 3}]),
+        "Recall_FILT": vcf_stats.per_record_stats_table([]),
+    }
+    tmp_npz = "tmp.save_and_load_per_record_stats_tables.npz"
+    vcf_stats.save_per_record_stats_tables(tables, tmp_npz)
+    got = vcf_stats.load_per_record_stats_tables(tmp_npz)
+    assert list(got) == ["Precision", "Recall_ALL", "Recall_FILT"]
+    assert got["Precision"].equals(tables["Precision"])
+    assert got["Recall_ALL"].equals(tables["Recall_ALL"])
+    assert list(got["Recall_FILT"].columns) == list(tables["Recall_FILT"].columns)
+    assert len(got["Recall_FILT"]) == 0
+    os.unlink(tmp_npz)
+
+
+def test_filter_per_record_stats_table():
+    record_stats = [
+        {"CHROM": "ref1", "POS": 10, "REF_LEN": 1, "ALT_LEN": 1, "GT_CONF": 5},
+        {"CHROM": "ref1", "POS": 18, "REF_LEN": 3, "ALT_LEN": 1, "GT_CONF": 50},
+        {"CHROM": "ref1", "POS": 30, "REF_LEN": 1, "ALT_LEN": 4, "GT_CONF": 20},
+        {"CHROM": "ref2", "POS": 10, "REF_LEN": 1, "ALT_LEN": 1, "GT_CONF": "NA"},
+    ]
+    table = vcf_stats.per_record_stats_table(record_stats)
+    regions = {"ref1": utils.IntervalMask([(19, 25), (29, 40)])}
+    assert list(vcf_stats.rows_overlapping_intervals(table, regions)) == [
+        False,
+        True,
+        True,
+        False,
+    ]
+
+    def got_positions(**kwargs):
+        got = vcf_stats.filter_per_record_stats_table(table, **kwargs)
+        return [(x.CHROM, x.POS) for x in got.itertuples()]
+
+    assert got_positions() == [("ref1", 10), ("ref1", 18), ("ref1", 30), ("ref2", 10)]
+    assert got_positions(expression="REF_LEN == 1 and ALT_LEN == 1") == [
+        ("ref1", 10),
+        ("ref2", 10),
+    ]
+    assert got_positions(expression="GT_CONF >= 10", regions=regions) == [
+        ("ref1", 18),
+        ("ref1", 30),
+    ]
+    assert got_positions(expression='CHROM == "ref1"', mask=regions) == [
+        ("ref1", 10)
+    ]
+    with pytest.raises(RuntimeError):
+        vcf_stats.filter_per_record_stats_table(table, expression="NOT_A_COLUMN > 1")
@@ -7,8 +7,11 @@ except:
 
 
 __all__ = [
+    "batch",
     "dnadiff",
     "edit_distance",
+    "genome",
+    "index_cache",
     "probe",
     "probe_mapping",
     "recall",
@@ -17,6 +20,7 @@ __all__ = [
     "utils",
     "vcf_evaluate",
     "vcf_qc_annotate",
+    "vcf_shards",
     "vcf_stats",
 ]
 
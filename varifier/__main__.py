@@ -2,6 +2,7 @@
 
 import argparse
 import logging
+import os
 import varifier
 
 
@@ -65,12 +66,49 @@ def main(args=None):
         default=100,
         metavar="INT",
     )
+    subparser_make_truth_vcf.add_argument(
+        "--threads",
+        help="Number of threads to use when mapping probes [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_make_truth_vcf.add_argument(
+        "--processes",
+        help="Number of processes to use when mapping probes. If more than 1, the VCF file is split by CHROM (or into windows if there is only one CHROM) and each part is processed separately. Each process uses --threads threads [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_make_truth_vcf.add_argument(
+        "--index_cache_dir",
+        help="Directory of minimap2 indexes of truth genomes. The index of truth_fasta is loaded from here if it exists, otherwise it is made and saved here to be used by later runs",
+        metavar="DIRNAME",
+    )
+    subparser_make_truth_vcf.add_argument(
+        "--index_cache_max_gb",
+        help="Maximum total size in GB of the files in --index_cache_dir. The least recently used indexes are deleted when the cache is bigger than this [%(default)s]",
+        type=float,
+        default=20,
+        metavar="FLOAT",
+    )
     subparser_make_truth_vcf.add_argument(
         "--truth_mask",
         help="BED file of truth genome regions to mask. Any variants in the VCF matching to the mask are flagged and will not count towards precision or recall if the output VCF is used with vcf_eval",
         metavar="FILENAME",
     )
 
+    subparser_make_truth_vcf.add_argument(
+        "--regions",
+        help="Only make truth variants in these regions of the reference genome. Either a BED file, or a comma-separated list of regions like chr:start-end (1-based, end included)",
+        metavar="BED_FILE or REGIONS",
+    )
+    subparser_make_truth_vcf.add_argument(
+        "--bgzip_output",
+        help="Write the truth VCF file bgzipped (04.truth.vcf.gz), with a tabix index",
+        action="store_true",
+    )
+
     subparser_make_truth_vcf.add_argument("outdir", help="Name of output directory")
     subparser_make_truth_vcf.set_defaults(func=varifier.tasks.make_truth_vcf.run)
 
@@ -89,6 +127,32 @@ def main(args=None):
         default=100,
         metavar="INT",
     )
+    subparser_vcf_eval.add_argument(
+        "--threads",
+        help="Number of threads to use when mapping probes [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_vcf_eval.add_argument(
+        "--processes",
+        help="Number of processes to use when mapping probes. If more than 1, the VCF file is split by CHROM (or into windows if there is only one CHROM) and each part is processed separately. Each process uses --threads threads [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_vcf_eval.add_argument(
+        "--index_cache_dir",
+        help="Directory of minimap2 indexes of truth genomes. The index of truth_fasta is loaded from here if it exists, otherwise it is made and saved here to be used by later runs",
+        metavar="DIRNAME",
+    )
+    subparser_vcf_eval.add_argument(
+        "--index_cache_max_gb",
+        help="Maximum total size in GB of the files in --index_cache_dir. The least recently used indexes are deleted when the cache is bigger than this [%(default)s]",
+        type=float,
+        default=20,
+        metavar="FLOAT",
+    )
     subparser_vcf_eval.add_argument(
         "--force", help="Replace outdir if it already exists", action="store_true"
     )
@@ -118,14 +182,304 @@ def main(args=None):
         help="Include 0/0 genotype calls when calculating TPs and precision. By default they are ignored",
         action="store_true",
     )
+    subparser_vcf_eval.add_argument(
+        "--incremental_filt",
+        help="When calculating recall of PASS calls only, only remap the truth variants near non-PASS calls, and reuse the results of all calls for the rest. Faster when most calls PASS, but can differ from the default where probes map to repeated sequence",
+        action="store_true",
+    )
+    subparser_vcf_eval.add_argument(
+        "--regions",
+        help="Only evaluate the calls and truth variants in these regions of the reference genome. If vcf_file is bgzipped or BCF with an index, only the calls in the regions are read. Either a BED file, or a comma-separated list of regions like chr:start-end (1-based, end included)",
+        metavar="BED_FILE or REGIONS",
+    )
+    subparser_vcf_eval.add_argument(
+        "--shard",
+        help="Only probe map the calls and truth variants in part i of N of the reference genome, where the genome is cut into N parts of about the same length. Writes the stats of each of those variants to outdir/per_record_stats.npz instead of summary_stats.json. Run with each of 1/N to N/N (eg on different nodes of a cluster), then combine them with merge_eval. Without --truth_vcf, each shard only probe maps the truth variants in its part of the genome, but still compares the whole genomes using dnadiff and minimap2 to find them. Make the truth VCF once with make_truth_vcf and use --truth_vcf to avoid that",
+        metavar="i/N",
+    )
+    subparser_vcf_eval.add_argument(
+        "--curve_by",
+        help="Also write the precision and recall of the calls with score at least each threshold of this score to outdir/curve.SCORE.tsv and curve.SCORE.json, using the stats from probe mapping. Recall is estimated as the recall of all calls, times the fraction of TP calls kept. One of: %(choices)s. Not used with --shard (use merge_eval --curve_by instead)",
+        choices=varifier.vcf_stats.curve_score_keys,
+        metavar="SCORE",
+    )
+    subparser_vcf_eval.add_argument(
+        "--bgzip_output",
+        help="Write the output VCF files (precision.vcf, the recall VCF files, and the truth VCF file if it is made) bgzipped, with tabix indexes. Their names end with .gz",
+        action="store_true",
+    )
     subparser_vcf_eval.add_argument("truth_fasta", help="FASTA file of truth genome")
     subparser_vcf_eval.add_argument(
         "vcf_fasta", help="FASTA file corresponding to vcf_file"
     )
-    subparser_vcf_eval.add_argument("vcf_in", help="VCF file to evaluate")
+    subparser_vcf_eval.add_argument(
+        "vcf_in", help="VCF file to evaluate. Can be bgzipped, or a BCF file"
+    )
     subparser_vcf_eval.add_argument("outdir", help="Name of output directory")
     subparser_vcf_eval.set_defaults(func=varifier.tasks.vcf_eval.run)
 
+    # ------------------------ merge_eval --------------------------------------
+    subparser_merge_eval = subparsers.add_parser(
+        "merge_eval",
+        help="Combine the shards from vcf_eval --shard",
+        usage="varifier merge_eval [options] <outdir> <shard_dir1> [shard_dir2 ...]",
+        description="Combine the output directories of vcf_eval --shard 1/N ... N/N into outdir/summary_stats.json, which is the same as running vcf_eval without --shard (apart from possibly the last digits of sums of fractions, which are added up separately in each shard)",
+    )
+    subparser_merge_eval.add_argument(
+        "--force", help="Replace outdir if it already exists", action="store_true"
+    )
+    subparser_merge_eval.add_argument(
+        "--curve_by",
+        help="Also write the precision and recall of the calls with score at least each threshold of this score to outdir/curve.SCORE.tsv and curve.SCORE.json, using the stats from probe mapping. Recall is estimated as the recall of all calls, times the fraction of TP calls kept. One of: %(choices)s",
+        choices=varifier.vcf_stats.curve_score_keys,
+        metavar="SCORE",
+    )
+    subparser_merge_eval.add_argument("outdir", help="Name of output directory")
+    subparser_merge_eval.add_argument(
+        "shard_dirs",
+        help="Output directories of vcf_eval --shard, one for each shard",
+        nargs="+",
+    )
+    subparser_merge_eval.set_defaults(func=varifier.tasks.merge_eval.run)
+
+    # ------------------------ summarise ---------------------------------------
+    subparser_summarise = subparsers.add_parser(
+        "summarise",
+        help="Remake summary stats from vcf_eval output, using only some variants",
+        usage="varifier summarise [options] <eval_dir> <outfile>",
+        description="Remake the summary stats of the output directory of vcf_eval or merge_eval, using only the calls and truth variants that pass the given filters. Uses the stats of each variant saved in eval_dir/per_record_stats.npz, so nothing is probe mapped again. Filters are pandas query expressions of the columns: CHROM, POS, REF_LEN, ALT_LEN (length of called allele), and the FORMAT tags DP, DPF, FRS, GT_CONF, GT_CONF_PERCENTILE and the VFR_* tags. For example, SNPs only: 'REF_LEN == 1 and ALT_LEN == 1'",
+    )
+    subparser_summarise.add_argument(
+        "--filter",
+        help="Only use the calls (for precision) and truth variants (for recall) that match this expression",
+        metavar="EXPRESSION",
+    )
+    subparser_summarise.add_argument(
+        "--calls_filter",
+        help="Only use the calls that match this expression when calculating precision, eg 'GT_CONF >= 10'. Does not change recall, because that would need the truth to be mapped to the calls again",
+        metavar="EXPRESSION",
+    )
+    subparser_summarise.add_argument(
+        "--regions",
+        help="Only use the calls and truth variants in these regions of the reference genome. Either a BED file, or a comma-separated list of regions like chr:start-end (1-based, end included)",
+        metavar="BED_FILE or REGIONS",
+    )
+    subparser_summarise.add_argument(
+        "--mask",
+        help="BED file of ref regions to mask. Calls and truth variants overlapping the mask are not used",
+        metavar="FILENAME",
+    )
+    subparser_summarise.add_argument(
+        "eval_dir", help="Output directory of vcf_eval or merge_eval"
+    )
+    subparser_summarise.add_argument(
+        "outfile", help="Name of output JSON file of summary stats"
+    )
+    subparser_summarise.set_defaults(func=varifier.tasks.summarise.run)
+
+    # ------------------------ vcf_eval_multi ----------------------------------
+    subparser_vcf_eval_multi = subparsers.add_parser(
+        "vcf_eval_multi",
+        help="Evaluate more than one VCF file against the same truth",
+        usage="varifier vcf_eval_multi [options] <truth_fasta> <vcf_fasta> <outdir> <vcf_file1> [vcf_file2 ...]",
+        description="Evaluate VCF files that were all called against the same reference, using the same truth genome. The truth VCF and truth genome index are only made once. Writes a summary of all the results in outdir/summary_stats.tsv",
+    )
+
+    subparser_vcf_eval_multi.add_argument(
+        "--names",
+        help="Comma-separated list of names of the VCF files, used in the output. Must be in the same order as the VCF files. Default is to use the VCF filenames, without the extension",
+        metavar="NAME1,NAME2,...",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--parallel",
+        help="Number of VCF files to evaluate at the same time, each in its own process. Each evaluation uses --threads times --processes CPUs, so the total is --parallel times that [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--flank_length",
+        help="Length of sequence to add either side of variant when making probe sequences [%(default)s]",
+        type=int,
+        default=100,
+        metavar="INT",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--threads",
+        help="Number of threads to use when mapping probes [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--processes",
+        help="Number of processes to use when mapping probes, for each VCF file. If more than 1, the VCF file is split by CHROM (or into windows if there is only one CHROM) and each part is processed separately. Each process uses --threads threads [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--index_cache_dir",
+        help="Directory of minimap2 indexes of truth genomes. The index of truth_fasta is loaded from here if it exists, otherwise it is made and saved here to be used by later runs. Default is to make the index once in outdir, and delete it at the end",
+        metavar="DIRNAME",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--index_cache_max_gb",
+        help="Maximum total size in GB of the files in --index_cache_dir. The least recently used indexes are deleted when the cache is bigger than this [%(default)s]",
+        type=float,
+        default=20,
+        metavar="FLOAT",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--force", help="Replace outdir if it already exists", action="store_true"
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--ref_mask",
+        help="BED file of ref regions to mask. Any variants in the VCFs overlapping the mask are removed at the start of the pipeline",
+        metavar="FILENAME",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--truth_mask",
+        help="BED file of truth genome regions to mask. Any variants in the VCFs matching to the mask are flagged and do not count towards precision or recall",
+        metavar="FILENAME",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--truth_vcf",
+        help="VCF file of variant calls between vcf_fasta and truth_fasta, where reference of this VCF file is truth_fasta. If provided, used to calculate recall",
+        metavar="FILENAME",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--max_recall_ref_len",
+        help="For recall, do not look for expected variants where REF length is more than this number. Default is no limit. This option will not work if you use --truth_vcf",
+        type=int,
+        metavar="INT",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--use_ref_calls",
+        help="Include 0/0 genotype calls when calculating TPs and precision. By default they are ignored",
+        action="store_true",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--incremental_filt",
+        help="When calculating recall of PASS calls only, only remap the truth variants near non-PASS calls, and reuse the results of all calls for the rest. Faster when most calls PASS, but can differ from the default where probes map to repeated sequence",
+        action="store_true",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--regions",
+        help="Only evaluate the calls and truth variants in these regions of the reference genome. Calls are read using the index of each VCF file, if it has one. Either a BED file, or a comma-separated list of regions like chr:start-end (1-based, end included)",
+        metavar="BED_FILE or REGIONS",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "--bgzip_output",
+        help="Write the output VCF files (precision.vcf, the recall VCF files, and the truth VCF file if it is made) bgzipped, with tabix indexes. Their names end with .gz",
+        action="store_true",
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "truth_fasta", help="FASTA file of truth genome"
+    )
+    subparser_vcf_eval_multi.add_argument(
+        "vcf_fasta", help="FASTA file corresponding to the VCF files"
+    )
+    subparser_vcf_eval_multi.add_argument("outdir", help="Name of output directory")
+    subparser_vcf_eval_multi.add_argument(
+        "vcf_in",
+        help="VCF file(s) to evaluate. Can be bgzipped, or BCF files",
+        nargs="+",
+    )
+    subparser_vcf_eval_multi.set_defaults(func=varifier.tasks.vcf_eval_multi.run)
+
+    # ------------------------ batch -------------------------------------------
+    subparser_batch = subparsers.add_parser(
+        "batch",
+        help="Evaluate VCF files listed in a manifest file",
+        usage="varifier batch [options] <manifest> <outdir>",
+        description="Evaluate VCF files listed in a manifest file, running the evaluations in parallel within a CPU and memory budget. Truth VCF files and truth genome indexes are shared between rows that have the same reference and truth. Rows that were already finished by a previous run with the same outdir are skipped. Writes a summary of all the results in outdir/summary_stats.tsv",
+    )
+
+    subparser_batch.add_argument(
+        "--cpus",
+        help="Maximum number of CPUs to use at once. Each evaluation uses --threads times --processes CPUs [%(default)s]",
+        type=int,
+        default=os.cpu_count(),
+        metavar="INT",
+    )
+    subparser_batch.add_argument(
+        "--mem_gb",
+        help="Maximum total memory in GB of the evaluations running at once. Default is no limit",
+        type=float,
+        metavar="FLOAT",
+    )
+    subparser_batch.add_argument(
+        "--job_mem_gb",
+        help="Memory in GB needed by each evaluation, for rows of the manifest that do not have a mem_gb column. With --processes of 2 or more, the two recall runs (all calls and PASS calls) are done at the same time, so this needs to allow for two copies of the reference genome with the calls applied [%(default)s]",
+        type=float,
+        default=4,
+        metavar="FLOAT",
+    )
+    subparser_batch.add_argument(
+        "--flank_length",
+        help="Length of sequence to add either side of variant when making probe sequences [%(default)s]",
+        type=int,
+        default=100,
+        metavar="INT",
+    )
+    subparser_batch.add_argument(
+        "--threads",
+        help="Number of threads to use when mapping probes [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_batch.add_argument(
+        "--processes",
+        help="Number of processes to use when mapping probes, for each evaluation. If more than 1, the VCF file is split by CHROM (or into windows if there is only one CHROM) and each part is processed separately. Each process uses --threads threads [%(default)s]",
+        type=int,
+        default=1,
+        metavar="INT",
+    )
+    subparser_batch.add_argument(
+        "--index_cache_dir",
+        help="Directory of minimap2 indexes of truth genomes. Indexes are loaded from here if they exist, otherwise they are made and saved here to be used by later runs [outdir/index_cache]",
+        metavar="DIRNAME",
+    )
+    subparser_batch.add_argument(
+        "--index_cache_max_gb",
+        help="Maximum total size in GB of the files in --index_cache_dir. The least recently used indexes are deleted when the cache is bigger than this [%(default)s]",
+        type=float,
+        default=20,
+        metavar="FLOAT",
+    )
+    subparser_batch.add_argument(
+        "--max_recall_ref_len",
+        help="For recall, do not look for expected variants where REF length is more than this number. Default is no limit. Is not used for rows of the manifest that have a truth_vcf",
+        type=int,
+        metavar="INT",
+    )
+    subparser_batch.add_argument(
+        "--use_ref_calls",
+        help="Include 0/0 genotype calls when calculating TPs and precision. By default they are ignored",
+        action="store_true",
+    )
+    subparser_batch.add_argument(
+        "--incremental_filt",
+        help="When calculating recall of PASS calls only, only remap the truth variants near non-PASS calls, and reuse the results of all calls for the rest. Faster when most calls PASS, but can differ from the default where probes map to repeated sequence",
+        action="store_true",
+    )
+    subparser_batch.add_argument(
+        "--bgzip_output",
+        help="Write the output VCF files (precision.vcf, the recall VCF files, and the truth VCF file if it is made) bgzipped, with tabix indexes. Their names end with .gz",
+        action="store_true",
+    )
+    subparser_batch.add_argument(
+        "manifest",
+        help="TSV file with a header line and one line per VCF file to evaluate. Required columns: name, vcf, vcf_fasta, truth_fasta. Optional columns: truth_vcf, ref_mask, truth_mask, mem_gb",
+    )
+    subparser_batch.add_argument(
+        "outdir",
+        help="Name of output directory. Is made if it does not exist, otherwise finished rows are skipped",
+    )
+    subparser_batch.set_defaults(func=varifier.tasks.batch.run)
+
     args = parser.parse_args()
 
     log = logging.getLogger()
@@ -0,0 +1,333 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from varifier import truth_variant_finding, utils, vcf_evaluate
+
+manifest_required_columns = ["name", "vcf", "vcf_fasta", "truth_fasta"]
+manifest_optional_columns = ["truth_vcf", "ref_mask", "truth_mask", "mem_gb"]
+
+
+def load_manifest(manifest_tsv):
+    """Loads a TSV file that has a header line, and one line per VCF
+    file to evaluate. The columns in manifest_required_columns must be
+    present, and can also have any of manifest_optional_columns. Empty
+    values, or ".", in optional columns mean not given.
+    Returns a list of dictionaries of column name -> value, one per line"""
+    rows = []
+    with open(manifest_tsv) as f:
+        columns = f.readline().rstrip("\n").split("\t")
+        missing = [x for x in manifest_required_columns if x not in columns]
+        if len(missing) > 0:
+            raise RuntimeError(
+                f"Missing column(s) in manifest file {manifest_tsv}: {','.join(missing)}. Cannot continue"
+            )
+        unknown = [
+            x
+            for x in columns
+            if x not in manifest_required_columns + manifest_optional_columns
+        ]
+        if len(unknown) > 0:
+            raise RuntimeError(
+                f"Unknown column(s) in manifest file {manifest_tsv}: {','.join(unknown)}. Cannot continue"
+            )
+
+        for line_number, line in enumerate(f, start=2):
+            if line.strip() == "":
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(columns):
+                raise RuntimeError(
+                    f"Expected {len(columns)} columns but got {len(fields)} at line {line_number} of manifest file {manifest_tsv}. Cannot continue"
+                )
+            row = {x: None for x in manifest_optional_columns}
+            for column, value in zip(columns, fields):
+                if column in manifest_required_columns:
+                    if value in ("", "."):
+                        raise RuntimeError(
+                            f"No value for {column} at line {line_number} of manifest file {manifest_tsv}. Cannot continue"
+                        )
+                    row[column] = value
+                elif value not in ("", "."):
+                    row[column] = float(value) if column == "mem_gb" else value
+            rows.append(row)
+
+    names = [x["name"] for x in rows]
+    if len(set(names)) != len(names):
+        raise RuntimeError(
+            f"Names in manifest file {manifest_tsv} must be unique. Cannot continue"
+        )
+    return rows
+
+
+class Job:
+    """A function to run by run_jobs(). cpus and mem_gb are what the job
+    needs from the budget. The job is only run after all the jobs with
+    names in depends_on have finished successfully"""
+
+    def __init__(
+        self, name, func, args, kwargs=None, cpus=1, mem_gb=0, depends_on=None
+    ):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+        self.depends_on = [] if depends_on is None else depends_on
+
+
+def run_jobs(jobs, max_cpus, max_mem_gb=None):
+    """Runs the jobs in a pool of processes. Jobs are started in the order
+    given, as long as the total cpus and mem_gb of the running jobs stay
+    within max_cpus and max_mem_gb (no memory limit if max_mem_gb is None).
+    A job that needs more than the whole budget is run when nothing else is
+    running. A job whose dependencies failed is not run.
+    Returns a dictionary of job name -> None if the job was successful,
+    otherwise the exception raised by the job"""
+    results = {}
+    pending = list(jobs)
+    running = {}
+    used_cpus = 0
+    used_mem_gb = 0
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(1, max_cpus)
+    ) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for job in list(pending):
+                failed = [x for x in job.depends_on if results.get(x) is not None]
+                if len(failed) > 0:
+                    logging.error(f"Not running {job.name} because failed: {failed}")
+                    results[job.name] = RuntimeError(f"Dependencies failed: {failed}")
+                    pending.remove(job)
+                    continue
+                if not all(x in results for x in job.depends_on):
+                    continue
+
+                fits = used_cpus + job.cpus <= max_cpus and (
+                    max_mem_gb is None or used_mem_gb + job.mem_gb <= max_mem_gb
+                )
+                if not (fits or len(running) == 0):
+                    # Do not let later jobs jump ahead, otherwise a
+                    # big job could wait forever behind small ones
+                    break
+
+                logging.info(f"Starting job {job.name}")
+                future = executor.submit(job.func, *job.args, **job.kwargs)
+                running[future] = job
+                used_cpus += job.cpus
+                used_mem_gb += job.mem_gb
+                pending.remove(job)
+
+            if len(running) == 0:
+                if len(pending) > 0:
+                    raise RuntimeError(
+                        f"Jobs depend on unknown jobs: {[x.name for x in pending]}"
+                    )
+                continue
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                job = running.pop(future)
+                used_cpus -= job.cpus
+                used_mem_gb -= job.mem_gb
+                results[job.name] = future.exception()
+                if results[job.name] is None:
+                    logging.info(f"Finished job {job.name}")
+                else:
+                    logging.error(f"Job {job.name} failed: {results[job.name]}")
+
+    return results
+
+
+def _file_identity(filename):
+    """Returns [absolute path, modification time, size] of filename, or
+    None if filename is None"""
+    if filename is None:
+        return None
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+
+
+def _truth_key(row, flank_length, max_recall_ref_len, bgzip_output=False):
+    """Returns an identifier of the truth VCF file needed by row, which is
+    the same for all rows that can share the same truth VCF. Changes if
+    any of the input files change, so that an old truth VCF made from
+    them is not used"""
+    key = [
+        _file_identity(row["vcf_fasta"]),
+        _file_identity(row["truth_fasta"]),
+        _file_identity(row["truth_mask"]),
+        flank_length,
+        max_recall_ref_len,
+    ]
+    if bgzip_output:
+        key.append("bgzip")
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+
+
+def _make_truth_vcf(
+    truth_dir, vcf_fasta, truth_fasta, flank_length, truth_mask_bed_file=None, **kwargs
+):
+    """Makes the truth VCF file truth_dir/truth_vcf/04.truth.vcf(.gz). It is
+    made in a temporary directory which is renamed to truth_dir at the end,
+    so that truth_dir only exists if the truth VCF was finished"""
+    tmp_dir = f"{truth_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    if truth_mask_bed_file is None:
+        truth_mask = None
+    else:
+        truth_mask = utils.load_mask_bed_file(truth_mask_bed_file)
+    truth_variant_finding.make_truth_vcf(
+        vcf_fasta,
+        truth_fasta,
+        os.path.join(tmp_dir, "truth_vcf"),
+        flank_length,
+        truth_mask=truth_mask,
+        **kwargs,
+    )
+    os.rename(tmp_dir, truth_dir)
+
+
+def evaluate_manifest(
+    manifest_tsv,
+    outdir,
+    flank_length=100,
+    max_cpus=1,
+    max_mem_gb=None,
+    job_mem_gb=4,
+    debug=False,
+    discard_ref_calls=True,
+    max_recall_ref_len=None,
+    threads=1,
+    processes=1,
+    index_cache_dir=None,
+    index_cache_max_size=None,
+    incremental_filt=False,
+    bgzip_output=False,
+):
+    """Runs evaluate_vcf() on each row of the manifest file (see
+    load_manifest()), scheduling the jobs with run_jobs(). Each job uses
+    threads * processes cpus, including when the ALL and FILT recall runs
+    are done at the same time (see recall.get_recall()), and job_mem_gb GB
+    of memory unless the row has a mem_gb value.
+    Rows that have the same (unchanged) vcf_fasta, truth_fasta and
+    truth_mask share one truth VCF file (unless the row has a truth_vcf), and all rows
+    share the minimap2 index cache, which is outdir/index_cache by default.
+    The output of each row is in outdir/evaluations/<name>. Rows that already
+    have a summary_stats.json file there are skipped, so that a failed or
+    interrupted batch can be run again to finish it. Writes a table of the
+    results of all the rows to outdir/summary_stats.tsv.
+    Returns a dictionary of row name -> None if successful, otherwise the
+    exception raised when evaluating it"""
+    rows = load_manifest(manifest_tsv)
+    evaluations_dir = os.path.join(outdir, "evaluations")
+    truths_dir = os.path.join(outdir, "truth")
+    os.makedirs(evaluations_dir, exist_ok=True)
+    os.makedirs(truths_dir, exist_ok=True)
+    if index_cache_dir is None:
+        index_cache_dir = os.path.join(outdir, "index_cache")
+    job_cpus = threads * processes
+    shared_kwargs = {
+        "threads": threads,
+        "processes": processes,
+        "index_cache_dir": index_cache_dir,
+        "index_cache_max_size": index_cache_max_size,
+        "bgzip_output": bgzip_output,
+    }
+    jobs = []
+    truth_jobs = {}
+    results = {}
+
+    for row in rows:
+        row_outdir = os.path.join(evaluations_dir, row["name"])
+        if os.path.exists(os.path.join(row_outdir, "summary_stats.json")):
+            logging.info(f"Skipping {row['name']} because already finished")
+            results[row["name"]] = None
+            continue
+
+        mem_gb = job_mem_gb if row["mem_gb"] is None else row["mem_gb"]
+        truth_vcf = row["truth_vcf"]
+        depends_on = []
+        if truth_vcf is None:
+            key = _truth_key(
+                row, flank_length, max_recall_ref_len, bgzip_output=bgzip_output
+            )
+            truth_dir = os.path.join(truths_dir, key)
+            truth_vcf = os.path.join(truth_dir, "truth_vcf", "04.truth.vcf")
+            if bgzip_output:
+                truth_vcf += ".gz"
+            if not os.path.exists(truth_dir) and key not in truth_jobs:
+                truth_jobs[key] = Job(
+                    f"truth.{key}",
+                    _make_truth_vcf,
+                    (truth_dir, row["vcf_fasta"], row["truth_fasta"], flank_length),
+                    kwargs={
+                        "truth_mask_bed_file": row["truth_mask"],
+                        "debug": debug,
+                        "max_ref_len": max_recall_ref_len,
+                        **shared_kwargs,
+                    },
+                    cpus=job_cpus,
+                    mem_gb=mem_gb,
+                )
+                jobs.append(truth_jobs[key])
+            if key in truth_jobs:
+                depends_on.append(truth_jobs[key].name)
+
+        jobs.append(
+            Job(
+                row["name"],
+                vcf_evaluate.evaluate_vcf,
+                (
+                    row["vcf"],
+                    row["vcf_fasta"],
+                    row["truth_fasta"],
+                    flank_length,
+                    row_outdir,
+                ),
+                kwargs={
+                    "truth_vcf": truth_vcf,
+                    "debug": debug,
+                    "force": True,
+                    "ref_mask_bed_file": row["ref_mask"],
+                    "truth_mask_bed_file": row["truth_mask"],
+                    "discard_ref_calls": discard_ref_calls,
+                    "incremental_filt": incremental_filt,
+                    **shared_kwargs,
+                },
+                cpus=job_cpus,
+                mem_gb=mem_gb,
+                depends_on=depends_on,
+            )
+        )
+
+    logging.info(
+        f"{len(rows)} rows in manifest. {len(results)} already finished. Running {len(jobs)} jobs"
+    )
+    job_results = run_jobs(jobs, max_cpus, max_mem_gb=max_mem_gb)
+    for row in rows:
+        if row["name"] not in results:
+            results[row["name"]] = job_results[row["name"]]
+
+    finished = [x for x in rows if results[x["name"]] is None]
+    summary_stats_list = []
+    for row in finished:
+        json_file = os.path.join(evaluations_dir, row["name"], "summary_stats.json")
+        with open(json_file) as f:
+            summary_stats_list.append(json.load(f))
+    vcf_evaluate.write_summary_stats_table(
+        [x["name"] for x in finished],
+        [x["vcf"] for x in finished],
+        summary_stats_list,
+        os.path.join(outdir, "summary_stats.tsv"),
+    )
+    return results
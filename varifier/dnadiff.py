@@ -35,7 +35,7 @@ def _snps_file_to_vcf(snps_file, query_fasta, outfile, snps_only):
     Writes a new VCF file unmerged records."""
     vcf_records = {}
     variants = pymummer.snp_file.get_all_variants(snps_file)
-    query_seqs = utils.file_to_dict_of_seqs(query_fasta)
+    query_seqs = utils.indexed_dict_of_seqs(query_fasta)
     discarded_variants = []
 
     for variant in variants:
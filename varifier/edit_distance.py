@@ -1,14 +1,212 @@
-from Bio import pairwise2
+import functools
 
+_NO_SCORE = -(1 << 60)
 
-def _needleman_wunsch(seq1, seq2, match=1, mismatch=-1, gap_open=-5, gap_extend=-3):
-    """Returns global alignment strings from NM alignment of the
-    two sequences. Dashes for gaps"""
-    alignments = pairwise2.align.globalms(
-        seq1, seq2, match, mismatch, gap_open, gap_extend
+
+def _band_upper_bound(len1, len2, lo, hi, match, gap_open, gap_extend):
+    """Returns twice the best possible score of an alignment that leaves
+    the diagonals lo..hi (diagonal = column - row), or None if there are no
+    other diagonals"""
+    end_diag = len2 - len1
+    gap_lengths = [
+        abs(t) + abs(end_diag - t) for t in (lo - 1, hi + 1) if -len1 <= t <= len2
+    ]
+    if len(gap_lengths) == 0:
+        return None
+    gap_length = min(gap_lengths)
+    return (
+        match * (len1 + len2 - gap_length)
+        + 2 * gap_open
+        + 2 * gap_extend * (gap_length - 1)
     )
-    assert len(alignments[0][0]) == len(alignments[0][1])
-    return alignments[0][0], alignments[0][1]
+
+
+def _banded_matrices(seq1, seq2, lo, hi, match, mismatch, gap_open, gap_extend):
+    """Fills in the affine gap score and traceback matrices, only using the
+    diagonals lo..hi. Scores and traceback values are the same as from
+    Bio.pairwise2 (traceback bits: 1 = open gap in seq1, 2 = match/mismatch,
+    4 = open gap in seq2, 8 = extend gap in seq1, 16 = extend gap in seq2).
+    Returns lists of rows of scores and traceback values, where row i has
+    the columns i + lo .. i + hi"""
+    width = hi - lo + 1
+    scores = [[_NO_SCORE] * width for _ in range(len(seq1) + 1)]
+    traces = [[0] * width for _ in range(len(seq1) + 1)]
+    col_scores = [_NO_SCORE] * (len(seq2) + 1)
+    for col in range(max(0, lo), min(len(seq2), hi) + 1):
+        scores[0][col - lo] = 0 if col == 0 else gap_open + gap_extend * (col - 1)
+
+    for row in range(1, len(seq1) + 1):
+        score_row = scores[row]
+        trace_row = traces[row]
+        previous_row = scores[row - 1]
+        start = max(0, row + lo)
+        end = min(len(seq2), row + hi)
+        if start == 0:
+            score_row[-row - lo] = gap_open + gap_extend * (row - 1)
+            start = 1
+        row_score = _NO_SCORE
+        base1 = seq1[row - 1]
+        for col in range(start, end + 1):
+            i = col - row - lo
+            nogap = previous_row[i] + (match if base1 == seq2[col - 1] else mismatch)
+            row_open = score_row[i - 1] + gap_open if i > 0 else _NO_SCORE
+            row_extend = row_score + gap_extend
+            row_score = row_open if row_open > row_extend else row_extend
+            col_open = previous_row[i + 1] + gap_open if i + 1 < width else _NO_SCORE
+            col_extend = col_scores[col] + gap_extend
+            col_score = col_open if col_open > col_extend else col_extend
+            col_scores[col] = col_score
+            best = nogap if nogap > row_score else row_score
+            if col_score > best:
+                best = col_score
+            score_row[i] = best
+
+            trace = 2 if nogap == best else 0
+            if row_score == best:
+                trace += (row_open == best) + 8 * (row_extend == best)
+            if col_score == best:
+                trace += 4 * (col_open == best) + 16 * (col_extend == best)
+            trace_row[i] = trace
+
+    return scores, traces
+
+
+def _traceback(seq1, seq2, scores, traces, lo, hi, gap_open, gap_extend):
+    """Follows the traceback matrix made by _banded_matrices(), trying the
+    options in the same order as Bio.pairwise2, and returns the first
+    alignment found as a tuple of two strings"""
+
+    def score_at(row, col):
+        if row == 0 and col == 0:
+            return 0
+        elif row == 0 or col == 0:
+            return gap_open + gap_extend * (row + col - 1)
+        elif lo <= col - row <= hi:
+            return scores[row][col - row - lo]
+        else:
+            return _NO_SCORE
+
+    def trace_at(row, col):
+        if row == 0 or col == 0:
+            return 0
+        elif lo <= col - row <= hi:
+            return traces[row][col - row - lo]
+        else:
+            return -1  # outside the band, which is never on a best path
+
+    def find_gap_open(path, row, col, col_gap, in_seq1):
+        dead_end = False
+        target_score = score_at(row, col)
+        for n in range(col if in_seq1 else row):
+            if in_seq1:
+                col -= 1
+                path = ("-", seq2[col], path)
+            else:
+                row -= 1
+                path = (seq1[row], "-", path)
+            trace = trace_at(row, col)
+            if n > 0 and score_at(row, col) + gap_open + gap_extend * n == target_score:
+                if not trace:
+                    break
+                to_process.append((path, row, col, col_gap, trace))
+            if not trace:
+                dead_end = True
+        return path, row, col, dead_end
+
+    # Paths are stored as linked lists of (seq1 char, seq2 char, rest of path),
+    # built from the end of the alignment backwards
+    to_process = [(None, len(seq1), len(seq2), False, trace_at(len(seq1), len(seq2)))]
+    while len(to_process) > 0:
+        path, row, col, col_gap, trace = to_process.pop()
+        dead_end = False
+
+        while (row > 0 or col > 0) and not dead_end:
+            cache = (path, row, col, col_gap)
+            if not trace:
+                if col and col_gap:
+                    dead_end = True
+                else:
+                    for i in reversed(range(row)):
+                        path = (seq1[i], "-", path)
+                    for i in reversed(range(col)):
+                        path = ("-", seq2[i], path)
+                    row = col = 0
+                break
+            elif trace % 2 == 1:
+                trace -= 1
+                if col_gap:
+                    dead_end = True
+                else:
+                    col -= 1
+                    path = ("-", seq2[col], path)
+            elif trace % 4 == 2:
+                trace -= 2
+                row -= 1
+                col -= 1
+                path = (seq1[row], seq2[col], path)
+                col_gap = False
+            elif trace % 8 == 4:
+                trace -= 4
+                row -= 1
+                path = (seq1[row], "-", path)
+                col_gap = True
+            elif trace in (8, 24):
+                trace -= 8
+                if col_gap:
+                    dead_end = True
+                else:
+                    path, row, col, dead_end = find_gap_open(
+                        path, row, col, col_gap, True
+                    )
+            elif trace == 16:
+                trace -= 16
+                col_gap = True
+                path, row, col, dead_end = find_gap_open(
+                    path, row, col, col_gap, False
+                )
+
+            if trace:
+                to_process.append(cache + (trace,))
+            trace = trace_at(row, col)
+
+        if not dead_end:
+            aln1 = []
+            aln2 = []
+            while path is not None:
+                aln1.append(path[0])
+                aln2.append(path[1])
+                path = path[2]
+            return "".join(aln1), "".join(aln2)
+
+    raise RuntimeError(f"No alignment found between {seq1} and {seq2}. Cannot continue")
+
+
+def _needleman_wunsch(
+    seq1, seq2, match=1, mismatch=-1, gap_open=-5, gap_extend=-3, band_width=4
+):
+    """Returns global alignment strings from NM alignment of the
+    two sequences. Dashes for gaps. End gaps are penalised, and the
+    alignment is the same one that Bio.pairwise2.align.globalms() would
+    return first. Only diagonals within band_width of the two ends of the
+    alignment are filled in. The band is doubled until no alignment outside
+    it can score as well as the best one inside it"""
+    end_diag = len(seq2) - len(seq1)
+    while True:
+        lo = max(-len(seq1), min(0, end_diag) - band_width)
+        hi = min(len(seq2), max(0, end_diag) + band_width)
+        scores, traces = _banded_matrices(
+            seq1, seq2, lo, hi, match, mismatch, gap_open, gap_extend
+        )
+        outside_bound = _band_upper_bound(
+            len(seq1), len(seq2), lo, hi, match, gap_open, gap_extend
+        )
+        if outside_bound is None or 2 * scores[-1][end_diag - lo] > outside_bound:
+            break
+        band_width *= 2
+
+    aln1, aln2 = _traceback(seq1, seq2, scores, traces, lo, hi, gap_open, gap_extend)
+    assert len(aln1) == len(aln2)
+    return aln1, aln2
 
 
 def edit_distance_from_aln_strings(str1, str2):
@@ -32,9 +230,37 @@ def edit_distance_from_aln_strings(str1, str2):
     return edit_distance
 
 
+def _closed_form_edit_distance(seq1, seq2):
+    """Returns the edit distance between the sequences if it can be worked
+    out without aligning them, otherwise None. With the scores used by
+    _needleman_wunsch(), the ungapped alignment is the only best one for
+    sequences of the same length with at most 5 mismatches, and a single
+    gap is the only best alignment if the sequences only differ by an
+    insertion/deletion"""
+    if seq1 == seq2:
+        return 0
+    elif len(seq1) == len(seq2):
+        mismatches = sum(1 for a, b in zip(seq1, seq2) if a != b)
+        return mismatches if mismatches <= 5 else None
+
+    shortest = min(len(seq1), len(seq2))
+    prefix = 0
+    while prefix < shortest and seq1[prefix] == seq2[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < shortest - prefix and seq1[-suffix - 1] == seq2[-suffix - 1]:
+        suffix += 1
+    return 1 if prefix + suffix == shortest else None
+
+
+@functools.lru_cache(maxsize=65536)
 def edit_distance_between_seqs(seq1, seq2):
     """Input is two strings. They are globally aligned
     and the edit distance is returned. An indel of any length
-    is counted as one edit"""
+    is counted as one edit. Results are cached, because the same
+    pairs of alleles come up many times"""
+    edit_distance = _closed_form_edit_distance(seq1, seq2)
+    if edit_distance is not None:
+        return edit_distance
     aln1, aln2 = _needleman_wunsch(seq1, seq2)
     return edit_distance_from_aln_strings(aln1, aln2)
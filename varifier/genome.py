@@ -0,0 +1,103 @@
+import itertools
+import os
+import threading
+
+from varifier import index_cache, utils
+
+# Numbers the genomes that are only in memory, to give each one a different
+# identity
+_in_memory_genome_numbers = itertools.count()
+
+
+class Genome:
+    """A genome in a FASTA file. The sequences, checksum and minimap2
+    mappers of the genome are only made when they are first needed, and
+    then kept, so that they can be shared by all the stages of a run
+    instead of each stage loading the file again.
+    A genome that is only in memory has fasta_file None, and is made by
+    giving seqs, a dictionary of sequence name -> sequence string"""
+
+    def __init__(self, fasta_file, seqs=None):
+        assert fasta_file is not None or seqs is not None
+        self.fasta_file = fasta_file
+        self._seqs = seqs
+        self._checksum = None
+        if fasta_file is None:
+            self._identity = ("in_memory", os.getpid(), next(_in_memory_genome_numbers))
+        else:
+            self._identity = None
+        self._mappers = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        if self.fasta_file is None:
+            return f"Genome(seqs={list(self._seqs)!r})"
+        return f"Genome({self.fasta_file!r})"
+
+    @property
+    def seqs(self):
+        """Dictionary of sequence name -> sequence"""
+        if self._seqs is None:
+            self._seqs = utils.indexed_dict_of_seqs(self.fasta_file)
+        return self._seqs
+
+    @property
+    def checksum(self):
+        if self._checksum is None:
+            if self.fasta_file is None:
+                self._checksum = index_cache.seqs_checksum(self._seqs)
+            else:
+                self._checksum = index_cache.fasta_checksum(self.fasta_file)
+        return self._checksum
+
+    @property
+    def identity(self):
+        """Cheap identifier of the genome, that changes if the FASTA file
+        changes. Unlike checksum, it does not read the sequences. Two
+        genomes that are only in memory always have different identities,
+        even if they have the same sequences"""
+        if self._identity is None:
+            stat = os.stat(self.fasta_file)
+            self._identity = (
+                os.path.abspath(self.fasta_file),
+                stat.st_mtime_ns,
+                stat.st_size,
+            )
+        return self._identity
+
+    def mapper(self, key, make_mapper):
+        """Returns the mapper for key, calling make_mapper() to make it if
+        it has not already been made"""
+        with self._lock:
+            if key not in self._mappers:
+                self._mappers[key] = make_mapper()
+            return self._mappers[key]
+
+
+def load(genome):
+    """Returns genome if it is a Genome, otherwise a Genome made from the
+    FASTA file genome"""
+    if isinstance(genome, Genome):
+        return genome
+    return Genome(genome)
+
+
+def fasta_file(genome):
+    """Returns the name of the FASTA file of genome, which can be a Genome
+    or a filename"""
+    return load(genome).fasta_file
+
+
+class EvaluationContext:
+    """Everything that is shared between the stages of evaluating a VCF file:
+    the reference genome of the VCF file, the truth genome (if known), and
+    the truth mask. Stages that take a genome accept either a Genome or a
+    FASTA filename, so pass ref and truth from here to share them"""
+
+    def __init__(self, ref_fasta, truth_fasta=None, truth_mask_bed_file=None):
+        self.ref = load(ref_fasta)
+        self.truth = None if truth_fasta is None else load(truth_fasta)
+        if truth_mask_bed_file is None:
+            self.truth_mask = None
+        else:
+            self.truth_mask = utils.load_mask_bed_file(truth_mask_bed_file)
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+
+import mappy
+
+
+def fasta_checksum(fasta_file):
+    """Returns the sha256 hex digest of the contents of fasta_file"""
+    checksum = hashlib.sha256()
+    with open(fasta_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def seqs_checksum(seqs):
+    """Returns the sha256 hex digest of the sequences in seqs, which is a
+    dictionary of sequence name -> sequence string"""
+    checksum = hashlib.sha256()
+    for name, seq in seqs.items():
+        checksum.update(f">{name}\n".encode())
+        checksum.update(seq.encode())
+        checksum.update(b"\n")
+    return checksum.hexdigest()
+
+
+def index_filename(fasta_file, cache_dir, k, w, preset, checksum=None):
+    """Returns the name of the minimap2 index file in cache_dir for the
+    sequences in fasta_file, indexed using k, w and preset. The name only
+    depends on the contents of fasta_file, not its filename.
+    checksum should be fasta_checksum(fasta_file), if it is already known"""
+    if checksum is None:
+        checksum = fasta_checksum(fasta_file)
+    return os.path.join(cache_dir, f"{checksum}.k{k}.w{w}.{preset}.mmi")
+
+
+def evict(cache_dir, max_size, keep=None):
+    """Deletes the least recently used index files in cache_dir, until the
+    total size of the index files is at most max_size bytes. Never deletes
+    the file keep"""
+    indexes = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".mmi"):
+            filename = os.path.join(cache_dir, filename)
+            stat = os.stat(filename)
+            indexes.append((stat.st_mtime, stat.st_size, filename))
+
+    total_size = sum(x[1] for x in indexes)
+    for _, size, filename in sorted(indexes):
+        if total_size <= max_size:
+            break
+        if filename == keep:
+            continue
+        logging.info(f"Removing index file from cache {filename}")
+        os.unlink(filename)
+        total_size -= size
+
+
+def cached_index(
+    fasta_file, cache_dir, k, w, preset, max_size=None, threads=1, checksum=None
+):
+    """Returns the name of a minimap2 index file of fasta_file in cache_dir,
+    making the index if it is not already in the cache.
+    If max_size is not None, the least recently used indexes are removed
+    from the cache to keep its total size at most max_size bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    index = index_filename(fasta_file, cache_dir, k, w, preset, checksum=checksum)
+
+    if os.path.exists(index):
+        logging.info(f"Using cached index {index} for {fasta_file}")
+        # Update the modification time, so that the least recently used
+        # indexes are the ones that get evicted
+        os.utime(index)
+    else:
+        logging.info(f"Making index {index} for {fasta_file}")
+        # Write to a temporary file and then rename, so that a partially
+        # written index never gets used by other varifier processes
+        tmp_index = f"{index}.tmp.{os.getpid()}"
+        mappy.Aligner(
+            fn_idx_in=fasta_file,
+            fn_idx_out=tmp_index,
+            k=k,
+            w=w,
+            preset=preset,
+            n_threads=threads,
+        )
+        os.replace(tmp_index, index)
+
+    if max_size is not None:
+        evict(cache_dir, max_size, keep=index)
+
+    return index
@@ -1,6 +1,42 @@
-import pyfastaq
+import operator
 
-from varifier import edit_distance
+# Same complements as pyfastaq.sequences.Fasta.revcomp()
+_complement = str.maketrans("ATCGatcg", "TAGCtagc")
+
+
+def _ref_part(ref_seq, first, last, strand):
+    """Returns ref_seq from first to last, reverse complemented if the
+    strand is -1"""
+    if strand == -1:
+        return ref_seq[first : last + 1].translate(_complement)[::-1]
+    return ref_seq[first : last + 1]
+
+
+def _ref_range(allele_runs):
+    """Returns the first and last ref positions in the runs from
+    Probe._allele_runs(), or None, None if there are none"""
+    firsts = [x[3] for x in allele_runs if x[3] is not None]
+    if len(firsts) == 0:
+        return None, None
+    return min(firsts), max(x[4] for x in allele_runs if x[4] is not None)
+
+
+def _count_mismatches(seq1, seq2):
+    """Returns the number of positions where the two sequences, which must
+    have the same length, are different"""
+    if seq1 == seq2:
+        return 0
+    return sum(map(operator.ne, seq1, seq2))
+
+
+def _probe_oriented_cigar(map_hit):
+    """Returns the cigar of map_hit in the order along the probe, which is
+    reversed if the hit is on the reverse strand. Does not reverse the cigar
+    in place, because hits can be shared between threads by the probe
+    mapping cache"""
+    if map_hit.strand == -1:
+        return list(reversed(map_hit.cigar))
+    return map_hit.cigar
 
 
 class Probe:
@@ -48,22 +84,19 @@ class Probe:
         total_positions = 0
         matches = 0
 
-        if map_hit.strand == -1:
-            map_hit.cigar.reverse()
-
-        for length, operator in map_hit.cigar:
+        for length, operator in _probe_oriented_cigar(map_hit):
             if probe_pos > self.allele_end:
                 break
 
             if operator == 7 or operator == 8:  # 7,8 are "=","X"  == match/mismatch
-                for i in range(length):
-                    if self.allele_start <= probe_pos <= self.allele_end:
-                        if operator == 7:
-                            matches += 1
-                        total_positions += 1
-                    probe_pos += 1
-                    if probe_pos > self.allele_end:
-                        break
+                overlap = min(probe_pos + length, self.allele_end + 1) - max(
+                    probe_pos, self.allele_start
+                )
+                if overlap > 0:
+                    if operator == 7:
+                        matches += overlap
+                    total_positions += overlap
+                probe_pos += length
             elif operator == 1:  # 1 = I = insertion
                 if self.allele_start <= probe_pos <= self.allele_end:
                     total_positions += length
@@ -76,114 +109,125 @@ class Probe:
                     f"Unexpected cigar operator number {operator} with length {length} from cigar"
                 )
 
-        if map_hit.strand == -1:
-            map_hit.cigar.reverse()
-
         return matches, total_positions
 
-    def padded_probe_or_ref_seq(self, map_hit, ref_seq=None, ref_mask=None):
-        """Returns a tuple: (padded seq string, mask list of bools).
-        padded seq string is the padded probe seq inferred from map_hit, or
-        if ref_seq provided then the padded ref seq matching the probe.
-        If ref_mask is given, should be a set of positions in the mask.
-        The returned mask list of bools is same length as the returned padded
-        seq string, and has True or False for whether each position is in the mask"""
-        # Cigar operators:
-        # 1  I  Insertion in query (pad in ref)
-        # 2  D  Deletion in query (pad in query)
-        # 7  =  Match
-        # 8  X  Mismatch
+    def _alignment_runs(self, map_hit):
+        """Returns the alignment columns of map_hit, in the order along the
+        probe, as a list of runs of the same cigar operator. Each run is a
+        tuple (first column, length, operator, first probe position, first
+        ref position). The probe or ref position is None if the operator does
+        not use that sequence. On the reverse strand, the ref positions go
+        down along the run. The first map_hit.q_st columns are the start of
+        the probe that is not in the hit, which has operator None"""
+        cigar = _probe_oriented_cigar(map_hit)
         if map_hit.strand == -1:
-            q_st = len(self.seq) - map_hit.q_en
-        else:
-            q_st = map_hit.q_st
-
-        padded_seq = []
-        padded_mask = []
-
-        if ref_seq is None:
-            assert ref_mask is None
-            ref_seq = self.seq
-            pad_operators = {2}
-            non_pad_operators = {1, 7, 8}
-            if map_hit.strand == -1:
-                ref_seq = pyfastaq.sequences.Fasta("probe", self.seq)
-                ref_seq.revcomp()
-            position = q_st
+            ref_step = -1
+            ref_pos = map_hit.r_st - 1 + sum(l for l, op in cigar if op in {2, 7, 8})
         else:
-            pad_operators = {1}
-            non_pad_operators = {2, 7, 8}
-            position = map_hit.r_st
-
-        for operator_length, operator_type in map_hit.cigar:
-            if operator_type in pad_operators:
-                padded_seq.append("-" * operator_length)
-                if ref_mask is not None:
-                    padded_mask.extend([False] * operator_length)
-            elif operator_type in non_pad_operators:
-                padded_seq.append(ref_seq[position : position + operator_length])
-                if ref_mask is not None:
-                    for i in range(position, position + operator_length):
-                        padded_mask.append(i in ref_mask)
-                position += operator_length
+            ref_step = 1
+            ref_pos = map_hit.r_st
+
+        runs = [(0, map_hit.q_st, None, 0, None)]
+        column = probe_pos = map_hit.q_st
+        for length, operator in cigar:
+            if operator == 7 or operator == 8:
+                runs.append((column, length, operator, probe_pos, ref_pos))
+                probe_pos += length
+                ref_pos += ref_step * length
+            elif operator == 1:
+                runs.append((column, length, operator, probe_pos, None))
+                probe_pos += length
+            elif operator == 2:
+                runs.append((column, length, operator, None, ref_pos))
+                ref_pos += ref_step * length
             else:
                 raise RuntimeError(
-                    f"Unexpected cigar operator number {operator_type} with length {operator_length} from cigar"
+                    f"Unexpected cigar operator number {operator} with length {length} from cigar"
                 )
-
-        if map_hit.strand == -1:
-            padded_seq.extend(["N"] * map_hit.q_st)
-            padded_seq = pyfastaq.sequences.Fasta("seq", "".join(padded_seq))
-            padded_seq.revcomp()
-            padded_seq = padded_seq.seq
-            if ref_mask is not None:
-                padded_mask.extend([False] * map_hit.q_st)
-                padded_mask.reverse()
-        else:
-            padded_seq = "".join(["N"] * map_hit.q_st + padded_seq)
-            if ref_mask is not None:
-                padded_mask = [False] * map_hit.q_st + padded_mask
-
-        if ref_mask is None:
-            padded_mask = [False] * len(padded_seq)
-        assert len(padded_seq) == len(padded_mask)
-        return padded_seq, padded_mask
-
-    def padded_seq_allele_start_end_coords(self, padded_seq):
-        position = 0
-        allele_start = None
-
-        for index, base in enumerate(padded_seq):
-            if base != "-":
-                if position == self.allele_start:
-                    allele_start = index
-                if position == self.allele_end:
-                    return allele_start, index
-
-                position += 1
-
+            column += length
+        return runs
+
+    def padded_allele_coords(self, runs):
+        """Returns the start and end columns of the allele in the probe
+        padded with "-" for gaps in the alignment (and starting with
+        map_hit.q_st columns of the probe that are not in the hit), using the
+        runs from _alignment_runs(). Returns None, None if the allele is not
+        all in the padded probe"""
+        start = end = None
+        for column, length, operator, probe_pos, _ in runs:
+            if probe_pos is None:
+                continue
+            if start is None and self.allele_start < probe_pos + length:
+                start = column + self.allele_start - probe_pos
+            if self.allele_end < probe_pos + length:
+                end = column + self.allele_end - probe_pos
+                return start, end
         return None, None
 
+    def _allele_runs(self, map_hit):
+        """Returns the parts of the runs from _alignment_runs() that are in
+        the allele columns of the padded probe, as a list of tuples (length,
+        operator, first probe position, first ref position, last ref
+        position). The ref positions are on the forward strand, so the first
+        is never more than the last. Returns None if the allele is not all
+        in the padded probe"""
+        runs = self._alignment_runs(map_hit)
+        start, end = self.padded_allele_coords(runs)
+        if start is None:
+            return None
+
+        allele_runs = []
+        for column, length, operator, probe_pos, ref_pos in runs:
+            lo = max(start, column) - column
+            hi = min(end + 1, column + length) - column
+            if hi <= lo:
+                continue
+            if probe_pos is not None:
+                probe_pos += lo
+            if ref_pos is None:
+                ref_first = ref_last = None
+            elif map_hit.strand == -1:
+                ref_first, ref_last = ref_pos - hi + 1, ref_pos - lo
+            else:
+                ref_first, ref_last = ref_pos + lo, ref_pos + hi - 1
+            allele_runs.append((hi - lo, operator, probe_pos, ref_first, ref_last))
+        return allele_runs
+
     def edit_distance_vs_ref(self, map_hit, ref_seq, ref_mask=None):
-        padded_probe_seq, _ = self.padded_probe_or_ref_seq(map_hit)
-        padded_ref_seq, padded_ref_mask = self.padded_probe_or_ref_seq(
-            map_hit, ref_seq=ref_seq, ref_mask=ref_mask
-        )
-        start, end = self.padded_seq_allele_start_end_coords(padded_probe_seq)
-        x = "".join([{"N": "N", False: "0", True: "1"}[x] for x in padded_ref_mask])
-        diffs = ["|" if padded_probe_seq[i] == padded_ref_seq[i] else " " for i in range(len(padded_ref_seq))]
-        if start == None:
+        """Returns a tuple (edit distance, in mask) between the allele and the
+        ref sequence it is aligned to in map_hit. Indels count as one edit,
+        the same as edit_distance.edit_distance_from_aln_strings() on the
+        padded sequences. in mask is True if any of the aligned ref
+        positions are in ref_mask. Returns (-1, False) if the allele is not
+        all in the padded probe.
+        This works on the cigar runs, instead of on padded strings"""
+        allele_runs = self._allele_runs(map_hit)
+        if allele_runs is None:
             return -1, False
-        probe_allele = padded_probe_seq[start : end + 1]
-        ref_allele = padded_ref_seq[start : end + 1]
-        if ref_mask is None:
+
+        edit_dist = 0
+        in_gap = False
+        for length, operator, probe_pos, ref_first, ref_last in allele_runs:
+            if operator == 1 or operator == 2:
+                if not in_gap:
+                    edit_dist += 1
+                in_gap = True
+                continue
+
+            in_gap = False
+            # The padding at the start is N in the probe and ref, so matches
+            if operator is not None:
+                edit_dist += _count_mismatches(
+                    self.seq[probe_pos : probe_pos + length],
+                    _ref_part(ref_seq, ref_first, ref_last, map_hit.strand),
+                )
+
+        ref_start, ref_end = _ref_range(allele_runs)
+        if ref_mask is None or ref_start is None:
             in_mask = False
         else:
-            in_mask = any(padded_ref_mask[start : end + 1])
-        return (
-            edit_distance.edit_distance_from_aln_strings(probe_allele, ref_allele),
-            in_mask,
-        )
+            in_mask = ref_mask.overlaps(ref_start, ref_end + 1)
+        return edit_dist, in_mask
 
     def get_interval_as_str(self):
         return f"[{self.allele_start},{self.allele_end+1})"
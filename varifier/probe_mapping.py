@@ -1,11 +1,100 @@
+import collections
+import concurrent.futures
+import io
+import itertools
+import logging
 import operator
 import os
+import shutil
+import tempfile
+import threading
 
 import mappy
 import pyfastaq
-from cluster_vcf_records import vcf_file_read
-
-from varifier import edit_distance, probe, utils, vcf_qc_annotate
+from cluster_vcf_records import vcf_record
+
+from varifier import (
+    edit_distance,
+    genome,
+    index_cache,
+    probe,
+    utils,
+    vcf_qc_annotate,
+    vcf_shards,
+)
+
+
+class ProbeHitCache:
+    """Least recently used cache of the hits from mapping probes. The keys
+    are (probe sequence, index identity, MD), where the index identity is
+    the genome.Genome.identity of the genome that was indexed. Holds at
+    most max_size keys. Is safe to use from more than one thread"""
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.lookups = 0
+        self.found = 0
+        self._hits = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached hits for key, or None if not in the cache"""
+        with self._lock:
+            self.lookups += 1
+            hits = self._hits.get(key)
+            if hits is not None:
+                self._hits.move_to_end(key)
+                self.found += 1
+            return hits
+
+    def add(self, key, hits):
+        with self._lock:
+            self._hits[key] = hits
+            self._hits.move_to_end(key)
+            while len(self._hits) > self.max_size:
+                self._hits.popitem(last=False)
+
+    def hit_rate(self):
+        """Returns the fraction of lookups that were found in the cache"""
+        return 0 if self.lookups == 0 else self.found / self.lookups
+
+    def clear(self):
+        with self._lock:
+            self._hits.clear()
+            self.lookups = 0
+            self.found = 0
+
+
+class _CachedMapper:
+    """Wraps a mappy.Aligner, so that the hits of each probe are looked up in
+    a ProbeHitCache before mapping. index_id is the identity of the index used
+    by the aligner, which is part of the cache key"""
+
+    def __init__(self, mapper, index_id, hit_cache):
+        self.mapper = mapper
+        self.index_id = index_id
+        self.hit_cache = hit_cache
+
+    def map(self, seq, buf=None, MD=False):
+        key = (seq, self.index_id, MD)
+        hits = self.hit_cache.get(key)
+        if hits is None:
+            hits = tuple(self.mapper.map(seq, buf=buf, MD=MD))
+            self.hit_cache.add(key, hits)
+        return hits
+
+
+# Shared by all calls to annotate_vcf_with_probe_mapping() in this process,
+# so that probes that are the same between calls (eg when making the truth
+# VCF and checking precision, or evaluating several VCF files against the
+# same truth) only need mapping once
+probe_hit_cache = ProbeHitCache()
+
+
+def _log_probe_hit_cache_stats():
+    logging.info(
+        f"Probe mapping cache: {probe_hit_cache.found} of {probe_hit_cache.lookups} probes were already mapped ({round(100 * probe_hit_cache.hit_rate(), 2)}%)"
+    )
 
 
 def _get_wanted_format(use_fail_conflict):
@@ -22,10 +111,15 @@ def get_probes_and_vcf_records(
     so that each record has the FORMAT tag VFR_FILTER.
     For each line of the input VCF file, yields a
     tuple (vcf_record, alt probe sequence).
-    vcf_file = name of VCF file.
+    vcf_file = name of VCF file, or an iterable that yields the header lines
+    and then the records, eg from vcf_qc_annotate.qc_annotated_records().
     ref_seqs = dictionary of sequence name -> sequence.
     flank_length = number of nucleotides to add either side of variant sequence."""
-    header_lines, vcf_records = vcf_file_read.vcf_file_to_list(vcf_file)
+    if isinstance(vcf_file, str):
+        header_lines, vcf_records = utils.vcf_file_to_list(vcf_file)
+    else:
+        vcf_records = iter(vcf_file)
+        header_lines = next(vcf_records)
     yield header_lines
     wanted_format = _get_wanted_format(use_fail_conflict)
 
@@ -102,8 +196,14 @@ def evaluate_vcf_record(
     map_outfile=None,
     use_fail_conflict=False,
     truth_mask=None,
-    output_probes=False
+    output_probes=False,
+    thread_buffer=None,
 ):
+    if ref_probe is None:
+        # No probes because the record was filtered out, is not to be
+        # mapped, or because its result was taken from a previous run
+        return
+
     if output_probes:
         vcf_record.set_format_key_value("VFR_REF_PROBE", ref_probe.seq)
         vcf_record.set_format_key_value("VFR_REF_PROBE_ALLELE_INTERVAL", ref_probe.get_interval_as_str())
@@ -119,7 +219,7 @@ def evaluate_vcf_record(
     )
     vcf_record.set_format_key_value("VFR_ED_RA", str(edit_dist_allele_v_ref))
 
-    alt_hits = list(mapper.map(alt_probe.seq, MD=True))
+    alt_hits = list(mapper.map(alt_probe.seq, buf=thread_buffer, MD=True))
 
     if map_outfile is not None:
         print("VCF", vcf_record, sep="\t", file=map_outfile)
@@ -148,7 +248,7 @@ def evaluate_vcf_record(
         vcf_record.set_format_key_value("VFR_ED_SCORE", "0")
         return
 
-    ref_hits = list(mapper.map(ref_probe.seq, MD=True))
+    ref_hits = list(mapper.map(ref_probe.seq, buf=thread_buffer, MD=True))
     if map_outfile is not None:
         print("VCF", vcf_record, sep="\t", file=map_outfile)
         print(
@@ -181,13 +281,13 @@ def evaluate_vcf_record(
     else:
         ref_hits.sort(key=operator.attrgetter("NM"))
         best_ref_hit = ref_hits[0]
-        mask = None if truth_mask is None else truth_mask[best_ref_hit.ctg]
+        mask = None if truth_mask is None else truth_mask.get(best_ref_hit.ctg)
         edit_dist_ref_allele, ref_allele_in_mask = ref_probe.edit_distance_vs_ref(
             best_ref_hit, truth_seqs[best_ref_hit.ctg], ref_mask=mask,
         )
         vcf_record.set_format_key_value("VFR_ED_TR", str(edit_dist_ref_allele))
 
-    mask = None if truth_mask is None else truth_mask[alt_best_hit.ctg]
+    mask = None if truth_mask is None else truth_mask.get(alt_best_hit.ctg)
     edit_dist_alt_allele, alt_allele_in_mask = alt_probe.edit_distance_vs_ref(
         alt_best_hit, truth_seqs[alt_best_hit.ctg], ref_mask=mask,
     )
@@ -212,27 +312,128 @@ def evaluate_vcf_record(
         print("FINISH:", vcf_record, file=map_outfile)
 
 
-def annotate_vcf_with_probe_mapping(
-    vcf_in,
-    vcf_ref_fasta,
-    truth_ref_fasta,
-    flank_length,
-    vcf_out,
+def _use_previous_results(probes_and_vcf_reader, previous_vcf_out, remap):
+    """Yields the (vcf_record, ref_probe, alt_probe) tuples from
+    probes_and_vcf_reader, except that each record where remap(record) is
+    False is replaced with the same record from previous_vcf_out, with no
+    probes so that it is not mapped again. previous_vcf_out must have been
+    made by this module from the same input VCF file"""
+    with utils.open_vcf_file_for_reading(previous_vcf_out) as f:
+        previous_records = (
+            vcf_record.VcfRecord(x.rstrip("\n")) for x in f if not x.startswith("#")
+        )
+        for record, ref_probe, alt_probe in probes_and_vcf_reader:
+            previous = next(previous_records, None)
+            if previous is None or (previous.CHROM, previous.POS) != (
+                record.CHROM,
+                record.POS,
+            ):
+                raise RuntimeError(
+                    f"Record {record.CHROM}:{record.POS + 1} not found in the same place in {previous_vcf_out}. Cannot continue"
+                )
+            if remap(record):
+                yield record, ref_probe, alt_probe
+            else:
+                yield previous, None, None
+
+        if next(previous_records, None) is not None:
+            raise RuntimeError(
+                f"More records in {previous_vcf_out} than expected. Cannot continue"
+            )
+
+
+def _evaluate_vcf_records(
+    mapper,
+    probes_and_vcf_reader,
+    vcf_ref_seqs,
+    truth_ref_seqs,
     map_outfile=None,
-    use_fail_conflict=False,
-    use_ref_calls=False,
-    debug=False,
-    truth_mask=None,
-    output_probes=False
+    threads=1,
+    **kwargs,
 ):
-    vcf_ref_seqs = utils.file_to_dict_of_seqs(vcf_ref_fasta)
-    truth_ref_seqs = utils.file_to_dict_of_seqs(truth_ref_fasta)
-    vcf_with_qc = vcf_out + ".debug.vcf"
-    vcf_qc_annotate.add_qc_to_vcf(vcf_in, vcf_with_qc, want_ref_calls=use_ref_calls)
-    probes_and_vcf_reader = get_probes_and_vcf_records(
-        vcf_with_qc, vcf_ref_seqs, flank_length, use_fail_conflict=use_fail_conflict,
+    """Runs evaluate_vcf_record() on each (vcf_record, ref_probe, alt_probe)
+    tuple from probes_and_vcf_reader, and yields the evaluated records in the
+    same order as the input. If threads > 1, the records are evaluated by a
+    pool of threads, each with its own mappy.ThreadBuffer. The mapping debug
+    output (if map_outfile is not None) is buffered per record, so that it is
+    written in the same order as when using one thread"""
+    if threads == 1:
+        for (vcf_record, ref_probe, alt_probe) in probes_and_vcf_reader:
+            evaluate_vcf_record(
+                mapper,
+                vcf_record,
+                ref_probe,
+                alt_probe,
+                vcf_ref_seqs[vcf_record.CHROM],
+                truth_ref_seqs,
+                map_outfile=map_outfile,
+                **kwargs,
+            )
+            yield vcf_record
+        return
+
+    thread_data = threading.local()
+
+    def evaluate(record_and_probes):
+        if not hasattr(thread_data, "buffer"):
+            thread_data.buffer = mappy.ThreadBuffer()
+        vcf_record, ref_probe, alt_probe = record_and_probes
+        record_map_out = None if map_outfile is None else io.StringIO()
+        evaluate_vcf_record(
+            mapper,
+            vcf_record,
+            ref_probe,
+            alt_probe,
+            vcf_ref_seqs[vcf_record.CHROM],
+            truth_ref_seqs,
+            map_outfile=record_map_out,
+            thread_buffer=thread_data.buffer,
+            **kwargs,
+        )
+        map_out = None if record_map_out is None else record_map_out.getvalue()
+        return vcf_record, map_out
+
+    # Take the records in chunks, so that we don't have the whole VCF file
+    # in memory when the threads are faster than the writing of the output
+    chunk_size = 1000 * threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            chunk = list(itertools.islice(probes_and_vcf_reader, chunk_size))
+            if len(chunk) == 0:
+                break
+            for vcf_record, map_out in executor.map(evaluate, chunk):
+                if map_out is not None:
+                    print(map_out, end="", file=map_outfile)
+                yield vcf_record
+
+
+# Options used when indexing the truth genome. See comments in _make_mapper()
+_index_options = {"k": 15, "w": 10, "preset": "sr"}
+
+
+def truth_index_file(
+    truth_ref_fasta, index_cache_dir=None, index_cache_max_size=None, checksum=None
+):
+    """Returns the name of the file to use for making the mapper from
+    truth_ref_fasta. This is truth_ref_fasta, unless index_cache_dir is given,
+    in which case it is the minimap2 index file in the cache. The index is
+    made if it is not already in the cache, so this can be used to make it
+    before it is needed by more than one evaluation"""
+    if index_cache_dir is None:
+        return truth_ref_fasta
+    return index_cache.cached_index(
+        truth_ref_fasta,
+        index_cache_dir,
+        max_size=index_cache_max_size,
+        checksum=checksum,
+        **_index_options,
     )
 
+
+def _make_mapper(truth_ref_fasta, threads=1, seq=None):
+    """truth_ref_fasta can be a FASTA file, or a minimap2 index file made
+    using _index_options. Or truth_ref_fasta is None and seq is the sequence
+    to index"""
     # Some notes on the mapper options...
     #
     # From the docs: score is the "scoring system. It is a tuple/list consisting
@@ -251,16 +452,124 @@ def annotate_vcf_with_probe_mapping(
     # extra_flags=0x4000000 turns on extended cigars, which we use to more easily
     # determine where the matches and mismatches are between the probe and truth
     # reference.
-    mapper = mappy.Aligner(
+    return mappy.Aligner(
         fn_idx_in=truth_ref_fasta,
-        k=15,
-        w=10,
-        preset="sr",
-        n_threads=1,
+        seq=seq,
+        **_index_options,
+        n_threads=threads,
         extra_flags=0x4000000,
         scoring=[1, 1, 5, 3],
     )
+
+
+def _make_index_file(truth_ref_fasta, index_file, threads=1):
+    """Writes a minimap2 index file of truth_ref_fasta, made using
+    _index_options, that _make_mapper() can load"""
+    mappy.Aligner(
+        fn_idx_in=truth_ref_fasta,
+        fn_idx_out=index_file,
+        **_index_options,
+        n_threads=threads,
+    )
+
+
+class _NamedHit:
+    """A hit from a mappy.Aligner made using seq=, which calls the sequence
+    "N/A", but with ctg set to the real name of the sequence"""
+
+    def __init__(self, hit, ctg):
+        self._hit = hit
+        self.ctg = ctg
+
+    def __getattr__(self, name):
+        return getattr(self._hit, name)
+
+    def __str__(self):
+        fields = str(self._hit).split("\t")
+        fields[3] = self.ctg
+        return "\t".join(fields)
+
+
+class _SeqMapper:
+    """Wraps a mappy.Aligner made from the sequence called name, so that
+    its hits have that name"""
+
+    def __init__(self, aligner, name):
+        self.aligner = aligner
+        self.name = name
+
+    def map(self, seq, buf=None, MD=False):
+        for hit in self.aligner.map(seq, buf=buf, MD=MD):
+            yield _NamedHit(hit, self.name)
+
+
+def _make_mapper_from_seqs(truth_ref_seqs, threads=1):
+    """Same as _make_mapper(), but indexes the sequences in the dictionary
+    truth_ref_seqs of name -> sequence string, without needing a file.
+    Only works without a file when there is one sequence: mappy can only
+    index one sequence from memory, so more than one sequence is written to
+    a temporary FASTA file to be indexed. (Indexing each sequence on its own
+    and joining the hits would give different results, because the mapq of
+    each hit depends on where else the probe maps in the whole genome, and
+    hits with mapq 0 are not used)"""
+    if len(truth_ref_seqs) == 1:
+        name, seq = next(iter(truth_ref_seqs.items()))
+        return _SeqMapper(_make_mapper(None, threads=threads, seq=seq), name)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_fasta = os.path.join(tmp_dir, "genome.fa")
+        with open(tmp_fasta, "w") as f:
+            for name, seq in truth_ref_seqs.items():
+                print(pyfastaq.sequences.Fasta(name, seq), file=f)
+        return _make_mapper(tmp_fasta, threads=threads)
+
+
+def _make_genome_mapper(truth_index, truth_ref_seqs, threads=1):
+    """Makes the mapper from truth_index (see truth_index_file()), or from
+    truth_ref_seqs if truth_index is None because the genome is only
+    in memory"""
+    if truth_index is None:
+        return _make_mapper_from_seqs(truth_ref_seqs, threads=threads)
+    return _make_mapper(truth_index, threads=threads)
+
+
+def _annotate_qc_vcf_with_probe_mapping(
+    vcf_with_qc,
+    vcf_ref_seqs,
+    truth_ref_seqs,
+    mapper,
+    flank_length,
+    vcf_out,
+    map_outfile=None,
+    use_fail_conflict=False,
+    truth_mask=None,
+    output_probes=False,
+    threads=1,
+    previous_vcf_out=None,
+    remap=None,
+    to_map=None,
+):
+    """vcf_with_qc should be a VCF file made by vcf_qc_annotate.add_qc_to_vcf(),
+    or the records from vcf_qc_annotate.qc_annotated_records().
+    Maps the probes for each record to the truth genome using mapper, and
+    writes the annotated records to vcf_out. If previous_vcf_out is given,
+    only the records where remap(record) is True are mapped, and the
+    results of the others are copied from previous_vcf_out. If to_map is
+    given, the records where to_map(record) is False are written without
+    being mapped"""
+    probes_and_vcf_reader = get_probes_and_vcf_records(
+        vcf_with_qc, vcf_ref_seqs, flank_length, use_fail_conflict=use_fail_conflict,
+    )
     header_lines = next(probes_and_vcf_reader)
+    if previous_vcf_out is not None:
+        probes_and_vcf_reader = _use_previous_results(
+            probes_and_vcf_reader, previous_vcf_out, remap
+        )
+    if to_map is not None:
+        probes_and_vcf_reader = (
+            (record, ref_probe, alt_probe) if to_map(record) else (record, None, None)
+            for record, ref_probe, alt_probe in probes_and_vcf_reader
+        )
 
     if map_outfile is not None:
         f_map = open(map_outfile, "w")
@@ -278,7 +587,7 @@ def annotate_vcf_with_probe_mapping(
         '##FORMAT=<ID=VFR_ED_TA,Number=1,Type=String,Description="Edit distance between truth and alt allele">',
     ]
 
-    with open(vcf_out, "w") as f_vcf:
+    with utils.open_vcf_file_for_writing(vcf_out) as f_vcf:
         print(
             *header_lines[:-1],
             *new_header_lines,
@@ -287,23 +596,249 @@ def annotate_vcf_with_probe_mapping(
             file=f_vcf,
         )
 
-        for (vcf_record, ref_probe, alt_probe) in probes_and_vcf_reader:
-            evaluate_vcf_record(
-                mapper,
-                vcf_record,
-                ref_probe,
-                alt_probe,
-                vcf_ref_seqs[vcf_record.CHROM],
-                truth_ref_seqs,
-                map_outfile=f_map,
-                use_fail_conflict=use_fail_conflict,
-                truth_mask=truth_mask,
-                output_probes=output_probes
-            )
+        for vcf_record in _evaluate_vcf_records(
+            mapper,
+            probes_and_vcf_reader,
+            vcf_ref_seqs,
+            truth_ref_seqs,
+            map_outfile=f_map,
+            threads=threads,
+            use_fail_conflict=use_fail_conflict,
+            truth_mask=truth_mask,
+            output_probes=output_probes,
+        ):
             print(vcf_record, file=f_vcf)
 
     if map_outfile is not None:
         f_map.close()
 
+
+# Each process used by _annotate_qc_vcf_shards() loads the genomes and makes
+# the mapper once, and then stores them here to use for all of its shards
+_shard_worker_data = {}
+
+
+def _init_shard_worker(vcf_ref_seqs, truth_ref_seqs, truth_index, index_id, threads):
+    _shard_worker_data["vcf_ref_seqs"] = vcf_ref_seqs
+    _shard_worker_data["truth_ref_seqs"] = truth_ref_seqs
+    _shard_worker_data["mapper"] = _CachedMapper(
+        _make_mapper(truth_index, threads=threads), index_id, probe_hit_cache,
+    )
+
+
+def _annotate_shard(shard_vcf, flank_length, shard_out, map_outfile, kwargs):
+    _annotate_qc_vcf_with_probe_mapping(
+        shard_vcf,
+        _shard_worker_data["vcf_ref_seqs"],
+        _shard_worker_data["truth_ref_seqs"],
+        _shard_worker_data["mapper"],
+        flank_length,
+        shard_out,
+        map_outfile=map_outfile,
+        **kwargs,
+    )
+    _log_probe_hit_cache_stats()
+
+
+def _annotate_qc_vcf_shards(
+    vcf_with_qc,
+    vcf_ref,
+    truth_ref,
+    flank_length,
+    vcf_out,
+    processes,
+    truth_index=None,
+    index_id=None,
+    map_outfile=None,
+    debug=False,
+    threads=1,
+    **kwargs,
+):
+    """Same as _annotate_qc_vcf_with_probe_mapping(), but splits vcf_with_qc
+    into shards (one per CHROM, or windows if only one CHROM), and annotates
+    the shards using a pool of processes. The shards are then merged back
+    into vcf_out, in the same order as vcf_with_qc.
+    vcf_ref and truth_ref are genome.Genome objects"""
+    shard_dir = f"{vcf_out}.shards"
+    os.mkdir(shard_dir)
+    truth_fasta = truth_ref.fasta_file
+    truth_ref_seqs = truth_ref.seqs
+    if truth_fasta is None:
+        # The genome is only in memory. Write it to a file once, so that the
+        # processes are not each sent a copy of it, and so that it can be
+        # indexed (mappy cannot save an index made from memory)
+        truth_fasta = os.path.join(shard_dir, "truth.fa")
+        with open(truth_fasta, "w") as f:
+            for name, seq in truth_ref_seqs.items():
+                print(pyfastaq.sequences.Fasta(name, seq), file=f)
+        truth_ref_seqs = utils.IndexedFasta(truth_fasta)
+        truth_index = truth_fasta
+    if truth_index == truth_fasta:
+        # Make the index once here, instead of in every process. Each
+        # process still loads the whole index
+        truth_index = os.path.join(shard_dir, "truth.mmi")
+        _make_index_file(truth_fasta, truth_index, threads=threads)
+    shard_vcfs = vcf_shards.split_vcf_file(vcf_with_qc, shard_dir)
+    shard_outs = [f"{x}.out.vcf" for x in shard_vcfs]
+    if map_outfile is None:
+        shard_maps = [None] * len(shard_vcfs)
+    else:
+        shard_maps = [f"{x}.out.map" for x in shard_vcfs]
+    kwargs["threads"] = threads
+    logging.info(
+        f"Probe mapping {len(shard_vcfs)} shards using {processes} processes"
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_shard_worker,
+        initargs=(
+            vcf_ref.seqs,
+            truth_ref_seqs,
+            truth_index,
+            index_id,
+            threads,
+        ),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _annotate_shard, shard_vcf, flank_length, shard_out, shard_map, kwargs
+            )
+            for shard_vcf, shard_out, shard_map in zip(
+                shard_vcfs, shard_outs, shard_maps
+            )
+        ]
+        for future in futures:
+            future.result()
+
+    if truth_ref_seqs is not truth_ref.seqs:
+        truth_ref_seqs.close()
+
+    if len(shard_vcfs) == 0:
+        # No records, but still want the header lines in the output
+        _annotate_qc_vcf_with_probe_mapping(
+            vcf_with_qc, {}, {}, None, flank_length, vcf_out, map_outfile=map_outfile,
+        )
+    else:
+        vcf_shards.merge_vcf_files(shard_outs, vcf_out)
+        if map_outfile is not None:
+            with open(map_outfile, "w") as f_out:
+                for filename in shard_maps:
+                    with open(filename) as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+
     if not debug:
-        os.unlink(vcf_with_qc)
+        shutil.rmtree(shard_dir)
+
+
+def annotate_vcf_with_probe_mapping(
+    vcf_in,
+    vcf_ref_fasta,
+    truth_ref_fasta,
+    flank_length,
+    vcf_out,
+    map_outfile=None,
+    use_fail_conflict=False,
+    use_ref_calls=False,
+    debug=False,
+    truth_mask=None,
+    output_probes=False,
+    threads=1,
+    processes=1,
+    index_cache_dir=None,
+    index_cache_max_size=None,
+    previous_vcf_out=None,
+    remap=None,
+    to_map=None,
+):
+    """Annotates each record in vcf_in with whether or not it is a TP or FP,
+    by mapping probes made from vcf_ref_fasta to truth_ref_fasta. These can
+    be FASTA filenames or genome.Genome objects. Using Genome objects means
+    that their sequences and mapper are reused by later calls.
+    truth_ref_fasta can be a Genome that is only in memory, which is
+    indexed straight from its sequences (or if processes > 1, is written to
+    a temporary file that is indexed once, for all the processes to use).
+    If processes > 1, the VCF file is split into shards that are annotated
+    in parallel. threads is the number of threads used by each process.
+    If index_cache_dir is given, the minimap2 index of truth_ref_fasta is
+    loaded from that directory if it is there, otherwise it is made and
+    saved there for next time (see index_cache.cached_index()).
+    If previous_vcf_out is given, it must be the output of an earlier call
+    with the same vcf_in and vcf_ref_fasta. Then only the records where
+    remap(record) is True are mapped to truth_ref_fasta, and the others are
+    copied from previous_vcf_out. This is always done in one process,
+    because it is only worth doing when few records are mapped.
+    If to_map is given, only the records where to_map(record) is True are
+    mapped, and the others are written to vcf_out without the mapping tags.
+    to_map must be picklable if processes > 1, eg a vcf_shards.GenomeShard.
+    vcf_in can be a VCF, bgzipped VCF or BCF file. If vcf_out ends with .gz,
+    it is bgzipped and tabix indexed"""
+    vcf_with_qc = vcf_out + ".debug.vcf"
+    qc_records = vcf_qc_annotate.qc_annotated_records(
+        vcf_in, want_ref_calls=use_ref_calls
+    )
+    kwargs = {
+        "map_outfile": map_outfile,
+        "use_fail_conflict": use_fail_conflict,
+        "truth_mask": truth_mask,
+        "output_probes": output_probes,
+        "threads": threads,
+        "to_map": to_map,
+    }
+
+    vcf_ref = genome.load(vcf_ref_fasta)
+    truth_ref = genome.load(truth_ref_fasta)
+    index_id = truth_ref.identity
+    if truth_ref.fasta_file is None:
+        # The genome is only in memory, so is indexed from its sequences
+        truth_index = None
+    else:
+        truth_index = truth_index_file(
+            truth_ref.fasta_file,
+            index_cache_dir=index_cache_dir,
+            index_cache_max_size=index_cache_max_size,
+            checksum=None if index_cache_dir is None else truth_ref.checksum,
+        )
+
+    if processes > 1 and previous_vcf_out is None:
+        # The shards are made from a file of all the QC annotated records
+        for _ in vcf_qc_annotate.write_vcf_file(qc_records, vcf_with_qc):
+            pass
+        _annotate_qc_vcf_shards(
+            vcf_with_qc,
+            vcf_ref,
+            truth_ref,
+            flank_length,
+            vcf_out,
+            processes,
+            truth_index=truth_index,
+            index_id=index_id,
+            debug=debug,
+            **kwargs,
+        )
+        if not debug:
+            os.unlink(vcf_with_qc)
+    else:
+        # The QC annotated records are streamed straight into probe
+        # mapping, only going via a file if it is wanted for debugging
+        if debug:
+            qc_records = vcf_qc_annotate.write_vcf_file(qc_records, vcf_with_qc)
+        mapper = truth_ref.mapper(
+            (truth_index, threads),
+            lambda: _make_genome_mapper(truth_index, truth_ref.seqs, threads=threads),
+        )
+        mapper = _CachedMapper(mapper, index_id, probe_hit_cache)
+        _annotate_qc_vcf_with_probe_mapping(
+            qc_records,
+            vcf_ref.seqs,
+            truth_ref.seqs,
+            mapper,
+            flank_length,
+            vcf_out,
+            previous_vcf_out=previous_vcf_out,
+            remap=remap,
+            **kwargs,
+        )
+        _log_probe_hit_cache_stats()
+
+    utils.index_vcf_file(vcf_out)
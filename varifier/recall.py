@@ -1,10 +1,12 @@
+import bisect
+import concurrent.futures
+import itertools
 import operator
 import os
 
 import pyfastaq
-from cluster_vcf_records import vcf_file_read
 
-from varifier import probe_mapping, truth_variant_finding, utils
+from varifier import genome, probe_mapping, truth_variant_finding, utils
 
 
 def _vcf_file_to_dict(vcf_file, pass_only=True):
@@ -15,7 +17,7 @@ def _vcf_file_to_dict(vcf_file, pass_only=True):
     if not pass_only:
         wanted_format.add("FAIL_BUT_TEST")
 
-    header_lines, vcf_records = vcf_file_read.vcf_file_to_list(vcf_file)
+    header_lines, vcf_records = utils.vcf_file_to_list(vcf_file)
     for record in vcf_records:
         if record.FORMAT["VFR_FILTER"] not in wanted_format:
             continue
@@ -30,30 +32,251 @@ def _vcf_file_to_dict(vcf_file, pass_only=True):
     return records
 
 
-def apply_variants_to_genome(ref_fasta, vcf_file, out_fasta, pass_only=True):
+def _ref_seq_chunks(ref_seq, start, end, chunk_size=1000000):
+    """Yields ref_seq[start:end] in pieces of at most chunk_size, so that
+    long stretches between variants are not all in memory at once"""
+    for i in range(start, end, chunk_size):
+        yield ref_seq[i : min(i + chunk_size, end)]
+
+
+def _mutated_seq_pieces(ref_seq, vcf_records, offsets=None):
+    """Yields the pieces of the sequence made by applying vcf_records (which
+    must be sorted by position) to ref_seq. If offsets is a list, appends
+    (ref start, ref end, mutated start, mutated end) of each applied variant
+    to it, 0-based with the ends not included"""
+    ref_pos = 0
+    new_pos = 0
+    for vcf_record in vcf_records:
+        genotype = set(vcf_record.FORMAT["GT"].split("/"))
+        assert len(genotype) == 1
+        allele_index = int(genotype.pop())
+        if allele_index == 0:
+            continue
+        allele = vcf_record.ALT[allele_index - 1]
+        start, end = vcf_record.POS, vcf_record.ref_end_pos() + 1
+        # Variants are applied in order, so must not overlap earlier ones
+        assert start >= ref_pos
+        yield from _ref_seq_chunks(ref_seq, ref_pos, start)
+        yield allele
+        new_pos += start - ref_pos
+        if offsets is not None:
+            offsets.append((start, end, new_pos, new_pos + len(allele)))
+        new_pos += len(allele)
+        ref_pos = end
+    yield from _ref_seq_chunks(ref_seq, ref_pos, len(ref_seq))
+
+
+def _write_fasta_seq(name, pieces, f):
+    """Writes a sequence, given as an iterable of pieces, to the open file f.
+    The output is the same as printing a pyfastaq.sequences.Fasta of the
+    whole sequence, but without needing the whole sequence in memory"""
+    line_length = pyfastaq.sequences.Fasta.line_length
+    print(">", name, sep="", file=f)
+    if line_length == 0:
+        for piece in pieces:
+            f.write(piece)
+        f.write("\n")
+        return
+
+    remainder = ""
+    wrote_lines = False
+    for piece in pieces:
+        remainder += piece
+        full_lines_end = len(remainder) - len(remainder) % line_length
+        if full_lines_end > 0:
+            lines = range(0, full_lines_end, line_length)
+            f.write("\n".join(remainder[i : i + line_length] for i in lines))
+            f.write("\n")
+            wrote_lines = True
+            remainder = remainder[full_lines_end:]
+    if len(remainder) > 0 or not wrote_lines:
+        f.write(remainder)
+        f.write("\n")
+
+
+def apply_variants_to_genome(
+    ref_fasta, vcf_file, out_fasta, pass_only=True, offsets_tsv=None
+):
     """Takes the variants in vcf_file, and applies them to the associated
-    reference genome in ref_fasta. Writes a new file out_fasta that has those
-    variants applied"""
-    ref_sequences = utils.file_to_dict_of_seqs(ref_fasta)
+    reference genome in ref_fasta (a FASTA filename or genome.Genome).
+    Writes a new file out_fasta that has those variants applied. out_fasta can
+    also be an open file, eg io.StringIO to keep the genome in memory.
+    The sequences are written in pieces, instead of being made in memory.
+    If offsets_tsv is given, writes a table of the position of each applied
+    variant in the reference and in the new genome"""
+    ref_sequences = genome.load(ref_fasta).seqs
     vcf_dict = _vcf_file_to_dict(vcf_file, pass_only=pass_only)
-    with open(out_fasta, "w") as f:
+    offsets = {}
+
+    def write_seqs(f):
         for ref_name, vcf_records in sorted(vcf_dict.items()):
-            old_seq = ref_sequences[ref_name]
-            new_seq = list(old_seq.seq)
-            # Applying indels messes up the coords of any subsequent variant,
-            # so start at the end and work backwards
-            for vcf_record in reversed(vcf_records):
-                genotype = set(vcf_record.FORMAT["GT"].split("/"))
-                assert len(genotype) == 1
-                allele_index = int(genotype.pop())
-                if allele_index == 0:
-                    continue
-                allele = vcf_record.ALT[allele_index - 1]
-                start, end = vcf_record.POS, vcf_record.ref_end_pos() + 1
-                assert old_seq[start:end] == "".join(new_seq[start:end])
-                new_seq[start:end] = [allele]
-            new_seq = pyfastaq.sequences.Fasta(f"{ref_name}.mutated", "".join(new_seq))
-            print(new_seq, file=f)
+            offsets[ref_name] = []
+            pieces = _mutated_seq_pieces(
+                ref_sequences[ref_name], vcf_records, offsets=offsets[ref_name]
+            )
+            _write_fasta_seq(f"{ref_name}.mutated", pieces, f)
+
+    if isinstance(out_fasta, str):
+        with open(out_fasta, "w") as f:
+            write_seqs(f)
+    else:
+        write_seqs(out_fasta)
+
+    if offsets_tsv is not None:
+        _write_offsets_tsv(offsets, offsets_tsv)
+
+
+def _write_offsets_tsv(offsets, filename):
+    """Writes the offsets made by apply_variants_to_genome() or
+    mutated_genome() to a tab-delimited file"""
+    with open(filename, "w") as f:
+        print(
+            "#ref_name",
+            "ref_start",
+            "ref_end",
+            "mutated_name",
+            "mutated_start",
+            "mutated_end",
+            sep="\t",
+            file=f,
+        )
+        for ref_name, ref_offsets in offsets.items():
+            for ref_start, ref_end, new_start, new_end in ref_offsets:
+                print(
+                    ref_name,
+                    ref_start,
+                    ref_end,
+                    f"{ref_name}.mutated",
+                    new_start,
+                    new_end,
+                    sep="\t",
+                    file=f,
+                )
+
+
+def mutated_genome(ref_fasta, vcf_file, pass_only=True, offsets=None):
+    """Same as apply_variants_to_genome(), but instead of writing a file,
+    returns a genome.Genome that is only in memory. If offsets is a
+    dictionary, it is filled with ref name -> list of the positions of the
+    variants applied to that sequence (see _mutated_seq_pieces())"""
+    ref_sequences = genome.load(ref_fasta).seqs
+    vcf_dict = _vcf_file_to_dict(vcf_file, pass_only=pass_only)
+    seqs = {}
+    for ref_name, vcf_records in sorted(vcf_dict.items()):
+        ref_offsets = None if offsets is None else offsets.setdefault(ref_name, [])
+        pieces = _mutated_seq_pieces(
+            ref_sequences[ref_name], vcf_records, offsets=ref_offsets
+        )
+        seqs[f"{ref_name}.mutated"] = "".join(pieces)
+    return genome.Genome(None, seqs=seqs)
+
+
+def _truth_records_changed_by_filtering(vcf_to_test, flank_length):
+    """The genome made by applying all the variants in vcf_to_test, and the
+    genome made by applying only the PASS variants, only differ where
+    FAIL_BUT_TEST variants were applied, and by the sequences that only have
+    FAIL_BUT_TEST variants (which are not in the PASS genome at all).
+    Returns a function that takes a truth VCF record, and returns True if
+    its probes (which have flank_length either side of the variant) could
+    map differently to the two genomes"""
+    all_records = _vcf_file_to_dict(vcf_to_test, pass_only=False)
+    pass_seqs = set()
+    differences = {}
+    for ref_name, vcf_records in all_records.items():
+        for vcf_record in vcf_records:
+            if vcf_record.FORMAT["VFR_FILTER"] == "PASS":
+                pass_seqs.add(ref_name)
+            elif vcf_record.FORMAT["GT"].split("/")[0] != "0":
+                differences.setdefault(ref_name, []).append(
+                    (vcf_record.POS, vcf_record.ref_end_pos())
+                )
+    missing_seqs = set(all_records) - pass_seqs
+    starts = {k: [x[0] for x in v] for k, v in differences.items()}
+    # The intervals are sorted by start. Using the running maximum of the
+    # ends means that bisect finds the first one that ends after a position
+    max_ends = {
+        k: list(itertools.accumulate([x[1] for x in v], max))
+        for k, v in differences.items()
+    }
+
+    def changed(truth_record):
+        if truth_record.CHROM in missing_seqs:
+            return True
+        if truth_record.CHROM not in differences:
+            return False
+        # Add one either side, so that variants next to the probes count
+        start = truth_record.POS - flank_length - 1
+        end = truth_record.ref_end_pos() + flank_length + 1
+        i = bisect.bisect_left(max_ends[truth_record.CHROM], start)
+        chrom_starts = starts[truth_record.CHROM]
+        return i < len(chrom_starts) and chrom_starts[i] <= end
+
+    return changed
+
+
+def _probe_map_truth_to_mutated_genome(
+    all_or_filt,
+    ref_fasta,
+    vcf_to_test,
+    truth_vcf,
+    outdir,
+    flank_length,
+    debug=False,
+    threads=1,
+    processes=1,
+    all_vcf_out=None,
+    bgzip_output=False,
+    to_map=None,
+):
+    """Applies the variants in vcf_to_test (all of them if all_or_filt is
+    "ALL", or only PASS ones if "FILT") to ref_fasta, and probe maps the truth
+    VCF to the mutated genome. Returns the name of the probe mapped VCF.
+    If all_or_filt is "FILT" and all_vcf_out is the output of the "ALL" run,
+    then only the truth records that could map differently to the FILT genome
+    are mapped, and the results of the others are copied from all_vcf_out.
+    If to_map is given, only the truth records where to_map(record) is True
+    are mapped"""
+    run_outdir = os.path.join(outdir, all_or_filt)
+    os.mkdir(run_outdir)
+    pass_only = all_or_filt == "FILT"
+    # The mutated genome is indexed from memory, so only needs writing to
+    # a file for debugging. (If it has more than one sequence, probe mapping
+    # still writes it to a temporary file, see
+    # probe_mapping._make_mapper_from_seqs())
+    offsets = {} if debug else None
+    mutated_ref = mutated_genome(
+        ref_fasta, vcf_to_test, pass_only=pass_only, offsets=offsets
+    )
+    if debug:
+        mutated_fasta = os.path.join(run_outdir, "00.ref_with_mutations_added.fa")
+        with open(mutated_fasta, "w") as f:
+            for name, seq in mutated_ref.seqs.items():
+                _write_fasta_seq(name, [seq], f)
+        _write_offsets_tsv(offsets, os.path.join(run_outdir, "00.offsets.tsv"))
+
+    # For each record in the truth VCF, make a probe and map to the mutated genome
+    vcf_out = os.path.join(run_outdir, "02.truth.probe_mapped_to_mutated_genome.vcf")
+    if bgzip_output:
+        vcf_out += ".gz"
+    map_outfile = os.path.join(run_outdir, "02.probe_map_debug.txt") if debug else None
+    if all_vcf_out is None:
+        remap = None
+    else:
+        remap = _truth_records_changed_by_filtering(vcf_to_test, flank_length)
+    probe_mapping.annotate_vcf_with_probe_mapping(
+        truth_vcf,
+        ref_fasta,
+        mutated_ref,
+        flank_length,
+        vcf_out,
+        map_outfile=map_outfile,
+        threads=threads,
+        processes=processes,
+        previous_vcf_out=all_vcf_out,
+        remap=remap,
+        to_map=to_map,
+    )
+    return vcf_out
 
 
 def get_recall(
@@ -66,8 +289,35 @@ def get_recall(
     debug=False,
     truth_mask=None,
     max_ref_len=None,
+    threads=1,
+    processes=1,
+    index_cache_dir=None,
+    index_cache_max_size=None,
+    incremental_filt=False,
+    bgzip_output=False,
+    regions=None,
+    to_map=None,
 ):
+    """Probe maps the truth VCF to ref_fasta with the variants in vcf_to_test
+    applied, first using all the variants and then only the PASS ones.
+    Returns the names of the two probe mapped VCF files (ALL, FILT).
+    If incremental_filt is True, the FILT run only maps the truth records
+    near non-PASS variants, and copies the results of the rest from the ALL
+    run. This is much faster when most variants PASS. The results are the
+    same as mapping all the truth records, unless probes map to more than
+    one place in the genome. If bgzip_output is True, the output VCF files
+    are bgzipped and tabix indexed. If regions is given (see
+    utils.load_regions()), only the truth variants in those regions are used.
+    If to_map is given, only the truth records where to_map(record) is True
+    are probe mapped (see probe_mapping.annotate_vcf_with_probe_mapping()).
+    If the truth VCF is made here, it only has those records (see
+    truth_variant_finding.make_truth_vcf()).
+    If processes is at least 2 (and incremental_filt is False), the ALL and
+    FILT runs are done at the same time, and share the processes between
+    them. Otherwise they are run one after the other, each using all the
+    processes. Either way, at most threads * processes CPUs are used"""
     os.mkdir(outdir)
+    ref_fasta = genome.load(ref_fasta)
 
     if truth_vcf is None:
         assert truth_fasta is not None
@@ -84,32 +334,77 @@ def get_recall(
             debug=debug,
             truth_mask=truth_mask,
             max_ref_len=max_ref_len,
+            threads=threads,
+            processes=processes,
+            index_cache_dir=index_cache_dir,
+            index_cache_max_size=index_cache_max_size,
+            bgzip_output=bgzip_output,
+            regions=regions,
+            to_map=to_map,
         )
     else:
         assert truth_fasta is None
+        if regions is not None:
+            regions_vcf = os.path.join(outdir, "truth.regions.vcf")
+            utils.restrict_vcf_file_to_regions(truth_vcf, regions, regions_vcf)
+            truth_vcf = regions_vcf
 
-    vcfs_out = {}
-    for all_or_filt in "ALL", "FILT":
-        run_outdir = os.path.join(outdir, all_or_filt)
-        os.mkdir(run_outdir)
-        mutated_ref_fasta = os.path.join(run_outdir, "00.ref_with_mutations_added.fa")
-        apply_variants_to_genome(
-            ref_fasta, vcf_to_test, mutated_ref_fasta, pass_only=all_or_filt == "FILT"
-        )
-
-        # For each record in the truth VCF, make a probe and map to the mutated genome
-        vcfs_out[all_or_filt] = os.path.join(
-            run_outdir, "02.truth.probe_mapped_to_mutated_genome.vcf"
-        )
-        map_outfile = (
-            os.path.join(run_outdir, "02.probe_map_debug.txt") if debug else None
-        )
-        probe_mapping.annotate_vcf_with_probe_mapping(
+    if incremental_filt or processes < 2:
+        # The FILT run reuses the results of the ALL run, or there are not
+        # enough processes to share between two runs at the same time
+        vcf_out_all = _probe_map_truth_to_mutated_genome(
+            "ALL",
+            ref_fasta,
+            vcf_to_test,
             truth_vcf,
+            outdir,
+            flank_length,
+            debug=debug,
+            threads=threads,
+            processes=processes,
+            bgzip_output=bgzip_output,
+            to_map=to_map,
+        )
+        vcf_out_filt = _probe_map_truth_to_mutated_genome(
+            "FILT",
             ref_fasta,
-            mutated_ref_fasta,
+            vcf_to_test,
+            truth_vcf,
+            outdir,
             flank_length,
-            vcfs_out[all_or_filt],
-            map_outfile=map_outfile,
+            debug=debug,
+            threads=threads,
+            processes=processes,
+            all_vcf_out=vcf_out_all if incremental_filt else None,
+            bgzip_output=bgzip_output,
+            to_map=to_map,
         )
+        return vcf_out_all, vcf_out_filt
+
+    # The ALL and FILT runs do not depend on each other, so run them at the
+    # same time in separate processes. These cannot share the loaded ref
+    # genome, so are given its filename. Each run gets half of the
+    # processes, so that the total number used is the same as running them
+    # one after the other
+    run_processes = {"ALL": (processes + 1) // 2, "FILT": processes // 2}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        futures = {
+            all_or_filt: executor.submit(
+                _probe_map_truth_to_mutated_genome,
+                all_or_filt,
+                genome.fasta_file(ref_fasta),
+                vcf_to_test,
+                truth_vcf,
+                outdir,
+                flank_length,
+                debug=debug,
+                threads=threads,
+                processes=run_processes[all_or_filt],
+                bgzip_output=bgzip_output,
+                to_map=to_map,
+            )
+            for all_or_filt in ("ALL", "FILT")
+        }
+        vcfs_out = {k: v.result() for k, v in futures.items()}
+
     return vcfs_out["ALL"], vcfs_out["FILT"]
@@ -1,3 +1,10 @@
-__all__ = ["make_truth_vcf", "vcf_eval"]
+__all__ = [
+    "batch",
+    "make_truth_vcf",
+    "merge_eval",
+    "summarise",
+    "vcf_eval",
+    "vcf_eval_multi",
+]
 
 from varifier.tasks import *
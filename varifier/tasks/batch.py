@@ -0,0 +1,27 @@
+import logging
+
+from varifier import batch, utils
+
+
+def run(options):
+    results = batch.evaluate_manifest(
+        options.manifest,
+        options.outdir,
+        flank_length=options.flank_length,
+        max_cpus=options.cpus,
+        max_mem_gb=options.mem_gb,
+        job_mem_gb=options.job_mem_gb,
+        debug=options.debug,
+        discard_ref_calls=not options.use_ref_calls,
+        max_recall_ref_len=options.max_recall_ref_len,
+        threads=options.threads,
+        processes=options.processes,
+        index_cache_dir=options.index_cache_dir,
+        index_cache_max_size=utils.gb_to_bytes(options.index_cache_max_gb),
+        incremental_filt=options.incremental_filt,
+        bgzip_output=options.bgzip_output,
+    )
+    failed = [name for name, result in results.items() if result is not None]
+    if len(failed) > 0:
+        logging.error(f"Failed: {','.join(failed)}")
+        raise RuntimeError(f"{len(failed)} of {len(results)} evaluations failed")
@@ -17,5 +17,11 @@ def run(options):
         max_ref_len=options.max_recall_ref_len,
         snps_only=options.snps_only,
         output_probes=options.output_probes_in_VCF,
-        detailed_VCF=options.detailed_VCF
+        detailed_VCF=options.detailed_VCF,
+        threads=options.threads,
+        processes=options.processes,
+        index_cache_dir=options.index_cache_dir,
+        index_cache_max_size=utils.gb_to_bytes(options.index_cache_max_gb),
+        bgzip_output=options.bgzip_output,
+        regions=options.regions,
     )
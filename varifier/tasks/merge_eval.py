@@ -0,0 +1,10 @@
+from varifier import vcf_evaluate
+
+
+def run(options):
+    vcf_evaluate.merge_evaluations(
+        options.shard_dirs,
+        options.outdir,
+        force=options.force,
+        curve_by=options.curve_by,
+    )
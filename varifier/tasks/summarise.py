@@ -0,0 +1,12 @@
+from varifier import vcf_evaluate
+
+
+def run(options):
+    vcf_evaluate.summarise_evaluation(
+        options.eval_dir,
+        options.outfile,
+        filter_expression=options.filter,
+        calls_filter_expression=options.calls_filter,
+        regions=options.regions,
+        mask_bed_file=options.mask,
+    )
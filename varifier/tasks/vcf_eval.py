@@ -1,4 +1,4 @@
-from varifier import vcf_evaluate
+from varifier import utils, vcf_evaluate
 
 
 def run(options):
@@ -15,4 +15,13 @@ def run(options):
         truth_mask_bed_file=options.truth_mask,
         discard_ref_calls=not options.use_ref_calls,
         max_recall_ref_len=options.max_recall_ref_len,
+        threads=options.threads,
+        processes=options.processes,
+        index_cache_dir=options.index_cache_dir,
+        index_cache_max_size=utils.gb_to_bytes(options.index_cache_max_gb),
+        incremental_filt=options.incremental_filt,
+        bgzip_output=options.bgzip_output,
+        regions=options.regions,
+        shard=options.shard,
+        curve_by=options.curve_by,
     )
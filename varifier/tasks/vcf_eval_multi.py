@@ -0,0 +1,27 @@
+from varifier import utils, vcf_evaluate
+
+
+def run(options):
+    vcf_evaluate.evaluate_vcfs(
+        options.vcf_in,
+        options.vcf_fasta,
+        options.truth_fasta,
+        options.flank_length,
+        options.outdir,
+        names=None if options.names is None else options.names.split(","),
+        truth_vcf=options.truth_vcf,
+        debug=options.debug,
+        force=options.force,
+        ref_mask_bed_file=options.ref_mask,
+        truth_mask_bed_file=options.truth_mask,
+        discard_ref_calls=not options.use_ref_calls,
+        max_recall_ref_len=options.max_recall_ref_len,
+        parallel=options.parallel,
+        threads=options.threads,
+        processes=options.processes,
+        index_cache_dir=options.index_cache_dir,
+        index_cache_max_size=utils.gb_to_bytes(options.index_cache_max_gb),
+        incremental_filt=options.incremental_filt,
+        bgzip_output=options.bgzip_output,
+        regions=options.regions,
+    )
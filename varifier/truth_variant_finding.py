@@ -8,9 +8,9 @@ import pysam
 import pysam.bcftools
 import re
 
-from cluster_vcf_records import vcf_file_read, vcf_merge
+from cluster_vcf_records import vcf_merge
 
-from varifier import dnadiff, probe_mapping, utils
+from varifier import dnadiff, genome, probe_mapping, utils
 
 
 def _check_dependencies_in_path():
@@ -28,8 +28,8 @@ def _check_dependencies_in_path():
 
 qname_matcher = re.compile(".*QNAME=(.+?);")
 def fix_minimap2_vcf(input_vcf_file, output_vcf_file, ref_fasta, qry_fasta, snps_only):
-    ref_seqs = utils.file_to_dict_of_seqs(ref_fasta)
-    qry_seqs = utils.file_to_dict_of_seqs(qry_fasta)
+    ref_seqs = utils.indexed_dict_of_seqs(ref_fasta)
+    qry_seqs = utils.indexed_dict_of_seqs(qry_fasta)
 
     discarded_variants = []
     with open(input_vcf_file) as input_vcf_filehandler,\
@@ -143,7 +143,7 @@ def _identify_vcf_lines(vcf_lines):
     return identified_vcf_lines
 
 def _deduplicate_vcf_files_for_probe_mapping(to_merge, ref_fasta, vcf_out):
-    ref_seqs = utils.file_to_dict_of_seqs(ref_fasta)
+    ref_seqs = genome.load(ref_fasta).seqs
     vcf_lines = _deduplicate_vcf_files(to_merge, f"{vcf_out}.disagreements_between_dnadiff_and_minimap2")
     vcf_lines = _identify_vcf_lines(vcf_lines)
 
@@ -156,12 +156,12 @@ def _deduplicate_vcf_files_for_probe_mapping(to_merge, ref_fasta, vcf_out):
         print("\n".join(vcf_lines), file=f)
 
 def _merge_vcf_files_for_probe_mapping(list_of_vcf_files, ref_fasta, vcf_out):
-    ref_seqs = utils.file_to_dict_of_seqs(ref_fasta)
+    ref_seqs = genome.load(ref_fasta).seqs
     # This makes a merged file, where two different ALTs at the same place
     # result in one record with a list of ALTs. For probe mapping, we want
     # a separate record for each allele. Also need genotype to be "1/1"
     vcf_merge.merge_vcf_files(list_of_vcf_files, ref_seqs, vcf_out)
-    header_lines, vcf_records = vcf_file_read.vcf_file_to_list(vcf_out)
+    header_lines, vcf_records = utils.vcf_file_to_list(vcf_out)
     with open(vcf_out, "w") as f:
         print("##fileformat=VCFv4.2", file=f)
         for seq in ref_seqs.values():
@@ -184,7 +184,7 @@ def _filter_fps_and_long_vars_from_probe_mapped_vcf(vcf_in, vcf_out, max_ref_len
     """vcf_in should be file made by _merge_vcf_files_for_probe_mapping, and
     then annotated using probe_mapping.annotate_vcf_with_probe_mapping().
     Outputs a new VCF file that only contains the TPs, based on probe mapping"""
-    header_lines, vcf_records = vcf_file_read.vcf_file_to_list(vcf_in)
+    header_lines, vcf_records = utils.vcf_file_to_list(vcf_in)
     with open(vcf_out, "w") as f:
         for line in header_lines:
             if (
@@ -231,11 +231,13 @@ def _bcftools_norm(ref_fasta, vcf_in, vcf_out):
     # The "-o" option doesn't get passed to pysam's bcftools wrapper.
     # Instead it returns a string that is the new vcf file
     options = ["-c", "x", "-d", "any", "-f", ref_fasta]
-    with open(vcf_out, "w") as f:
-        print(pysam.bcftools.norm(*options, vcf_in), end="", file=f)
+    vcf_string = pysam.bcftools.norm(*options, vcf_in)
+    with utils.open_vcf_file_for_writing(vcf_out) as f:
+        print(vcf_string, end="", file=f)
     vcf_string = pysam.bcftools.norm(*options, vcf_out)
-    with open(vcf_out, "w") as f:
+    with utils.open_vcf_file_for_writing(vcf_out) as f:
         print(vcf_string, end="", file=f)
+    utils.index_vcf_file(vcf_out)
 
 
 def make_truth_vcf(
@@ -248,10 +250,29 @@ def make_truth_vcf(
     max_ref_len=None,
     snps_only=False,
     output_probes=False,
-    detailed_VCF=False
+    detailed_VCF=False,
+    threads=1,
+    processes=1,
+    index_cache_dir=None,
+    index_cache_max_size=None,
+    bgzip_output=False,
+    regions=None,
+    to_map=None,
 ):
+    """Makes a truth VCF file of the differences between ref_fasta and
+    truth_fasta, which can be FASTA filenames or genome.Genome objects.
+    If bgzip_output is True, the truth VCF file is bgzipped and tabix indexed.
+    If regions is given (see utils.load_regions()), the truth VCF file only
+    has the variants in those regions of ref_fasta.
+    If to_map is given (eg a vcf_shards.GenomeShard), only the variants
+    where to_map(record) is True are probe mapped, so the truth VCF file
+    only has those variants. The whole genomes are still compared using
+    dnadiff and minimap2 to find the variants.
+    Returns the name of the truth VCF file"""
     _check_dependencies_in_path()
     os.mkdir(outdir)
+    ref = genome.load(ref_fasta)
+    truth = genome.load(truth_fasta)
     minimap2_vcf = os.path.join(outdir, "00.minimap2.vcf")
     dnadiff_vcf = os.path.join(outdir, "00.dnadiff.vcf")
     merged_vcf = os.path.join(outdir, "01.merged.vcf")
@@ -262,32 +283,45 @@ def make_truth_vcf(
     probe_mapped_vcf = os.path.join(outdir, "02.merged_and_probe_mapped.vcf")
     probe_filtered_vcf = os.path.join(outdir, "03.probe_filtered.vcf")
     truth_vcf = os.path.join(outdir, "04.truth.vcf")
+    if bgzip_output:
+        truth_vcf += ".gz"
 
-    dnadiff.make_truth_vcf(ref_fasta, truth_fasta, dnadiff_vcf, snps_only=snps_only, debug=debug)
-    _truth_using_minimap2_paftools(ref_fasta, truth_fasta, minimap2_vcf, snps_only=snps_only)
+    dnadiff.make_truth_vcf(ref.fasta_file, truth.fasta_file, dnadiff_vcf, snps_only=snps_only, debug=debug)
+    _truth_using_minimap2_paftools(ref.fasta_file, truth.fasta_file, minimap2_vcf, snps_only=snps_only)
     to_merge = [dnadiff_vcf, minimap2_vcf]
 
     if snps_only:
-        _deduplicate_vcf_files_for_probe_mapping(to_merge, ref_fasta, merged_vcf)
+        _deduplicate_vcf_files_for_probe_mapping(to_merge, ref, merged_vcf)
     else:
-        _merge_vcf_files_for_probe_mapping(to_merge, ref_fasta, merged_vcf)
+        _merge_vcf_files_for_probe_mapping(to_merge, ref, merged_vcf)
     logging.info(f"Made merged VCF file {merged_vcf}")
+    if regions is not None:
+        regions_vcf = os.path.join(outdir, "01.merged.regions.vcf")
+        utils.restrict_vcf_file_to_regions(merged_vcf, regions, regions_vcf)
+        merged_vcf = regions_vcf
+        logging.info(f"Made VCF file of merged variants in regions {merged_vcf}")
     logging.info(f"Probe mapping to remove incorrect calls")
     probe_mapping.annotate_vcf_with_probe_mapping(
         merged_vcf,
-        ref_fasta,
-        truth_fasta,
+        ref,
+        truth,
         flank_length,
         probe_mapped_vcf,
         map_outfile=map_debug_file,
         truth_mask=truth_mask,
-        output_probes=output_probes
+        output_probes=output_probes,
+        threads=threads,
+        processes=processes,
+        index_cache_dir=index_cache_dir,
+        index_cache_max_size=index_cache_max_size,
+        to_map=to_map,
     )
+    # Variants that were not probe mapped have no VFR_RESULT, so are removed
     _filter_fps_and_long_vars_from_probe_mapped_vcf(
         probe_mapped_vcf, probe_filtered_vcf, max_ref_len, detailed_VCF=detailed_VCF
     )
     logging.info(f"Made filtered VCF file {probe_filtered_vcf}")
     logging.info(f"Using bcftools to normalise and remove duplicates")
-    _bcftools_norm(ref_fasta, probe_filtered_vcf, truth_vcf)
+    _bcftools_norm(ref.fasta_file, probe_filtered_vcf, truth_vcf)
     logging.info(f"Finished making truth VCF file {truth_vcf}")
     return truth_vcf
@@ -1,57 +1,289 @@
-import pyfastaq
+import bisect
+import collections
+import collections.abc
+import contextlib
+import io
+import itertools
+import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
+import weakref
+
+import pyfastaq
+import pysam
+
+from cluster_vcf_records import vcf_record
+
+
+class IntervalMask:
+    """Masked positions of one sequence, stored as sorted non-overlapping
+    intervals. intervals is an iterable of (start, end) tuples of 0-based
+    coords, end not included, which can overlap and be in any order.
+    Use "position in mask" or mask.overlaps(start, end) to query"""
+
+    def __init__(self, intervals=None):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted([] if intervals is None else intervals):
+            if start >= end:
+                continue
+            if len(self.ends) > 0 and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        return f"IntervalMask({list(self)})"
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
 
-from cluster_vcf_records import vcf_file_read
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, position):
+        return self.overlaps(position, position + 1)
+
+    def overlaps(self, start, end):
+        """Returns True if any position from start to end (not including
+        end) is in the mask"""
+        i = bisect.bisect_left(self.starts, end) - 1
+        return i >= 0 and self.ends[i] > start
 
 
 def load_mask_bed_file(mask_bed_file):
     """Loads a BED file of ref seq names, and start and end postiions.
-    Returns a dictionary of ref seq name -> set of (0-based) coords in the mask."""
-    mask = {}
+    Returns a dictionary of ref seq name -> IntervalMask of the
+    (0-based) coords in the mask."""
+    intervals = {}
     with pyfastaq.utils.open_file_read(mask_bed_file) as f:
         for line in f:
-            chrom, start, end = line.rstrip().split("\t")
-            if chrom not in mask:
-                mask[chrom] = set()
-            for i in range(int(start), int(end)):
-                mask[chrom].add(i)
-    return mask
+            chrom, start, end = line.rstrip().split("\t")[:3]
+            intervals.setdefault(chrom, []).append((int(start), int(end)))
+    return {k: IntervalMask(v) for k, v in intervals.items()}
+
+
+class MaskSweep:
+    """Checks if intervals overlap a mask, which is a dictionary of ref seq
+    name -> IntervalMask (eg from load_mask_bed_file()). Is fastest when
+    the intervals are given in sorted order, like the records in a sorted
+    VCF file: a cursor for each ref seq sweeps forwards through its mask
+    intervals. Intervals out of order are found with bisect instead"""
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.cursors = {}
+
+    def overlaps(self, chrom, start, end):
+        """Returns True if any position of chrom from start to end (0-based,
+        not including end) is in the mask"""
+        intervals = self.mask.get(chrom)
+        if intervals is None:
+            return False
+        i, previous_start = self.cursors.get(chrom, (0, start))
+        if start < previous_start:
+            i = bisect.bisect_right(intervals.ends, start)
+        while i < len(intervals.ends) and intervals.ends[i] <= start:
+            i += 1
+        self.cursors[chrom] = (i, start)
+        return i < len(intervals.starts) and intervals.starts[i] < end
+
+
+def vcf_lines_not_in_mask(lines, mask):
+    """Generator of the lines of a VCF file, leaving out the records where
+    REF intersects the mask (a dictionary of ref seq name -> IntervalMask).
+    Header lines are kept"""
+    sweep = MaskSweep(mask)
+    for line in lines:
+        if not line.startswith("#"):
+            chrom, pos, _, ref, _ = line.split("\t", maxsplit=4)
+            pos = int(pos) - 1
+            if sweep.overlaps(chrom, pos, pos + len(ref)):
+                continue
+        yield line
 
 
 def mask_vcf_file(vcf_in, mask_bed_file, vcf_out):
     """Removes all variants in file vcf_in where REF intersects
-    an interval in mask_bed_file. Writes new vcf file vcf_out"""
-    # This is a quick hacky implementation that is likely not very fast.
-    # Put the coords of the mask into a set, and then for each VCF record,
-    # check if the ref position(s) are in the set
-    mask = load_mask_bed_file(mask_bed_file)
-
-    with pyfastaq.utils.open_file_read(vcf_in) as f_in, open(vcf_out, "w") as f_out:
-        for line in f_in:
-            if not line.startswith("#"):
-                chrom, pos, _, ref, _ = line.split("\t", maxsplit=4)
-                in_mask = False
-                if chrom in mask:
-                    pos = int(pos) - 1
-                    for i in range(pos, pos + len(ref)):
-                        if i in mask[chrom]:
-                            in_mask = True
-                            break
+    an interval in mask_bed_file. Writes new vcf file vcf_out.
+    mask_bed_file can instead be a mask already loaded with
+    load_mask_bed_file()"""
+    if isinstance(mask_bed_file, dict):
+        mask = mask_bed_file
+    else:
+        mask = load_mask_bed_file(mask_bed_file)
 
-                    if in_mask:
-                        continue
+    with open_vcf_file_for_reading(vcf_in) as f_in:
+        with open_vcf_file_for_writing(vcf_out) as f_out:
+            for line in vcf_lines_not_in_mask(f_in, mask):
+                print(line, end="", file=f_out)
+    index_vcf_file(vcf_out)
 
-            print(line, end="", file=f_out)
+
+@contextlib.contextmanager
+def open_vcf_file_for_reading(filename):
+    """Context manager that gives an iterable of the lines of a VCF file.
+    Compressed files (ending .gz) and BCF files (ending .bcf) are read
+    with htslib. Lines of BCF files are VCF text made by htslib"""
+    if filename.endswith(".bcf"):
+        with pysam.VariantFile(filename) as f:
+            header_lines = str(f.header).splitlines(keepends=True)
+            yield itertools.chain(header_lines, (str(x) for x in f))
+    elif filename.endswith(".gz"):
+        with pysam.BGZFile(filename, "rb") as f_bgzip, io.TextIOWrapper(f_bgzip) as f:
+            yield f
+    else:
+        with open(filename) as f:
+            yield f
+
+
+def open_vcf_file_for_writing(filename):
+    """Returns a file handle for writing a VCF file. If filename ends with
+    .gz, the output is bgzipped. Use index_vcf_file() to index the file
+    after closing it"""
+    if filename.endswith(".gz"):
+        return io.TextIOWrapper(pysam.BGZFile(filename, "wb"))
+    return open(filename, "w")
+
+
+def index_vcf_file(filename):
+    """Makes a tabix index of filename if it is a bgzipped VCF file,
+    otherwise does nothing. Logs a warning if the file cannot be
+    indexed, eg because it is not sorted"""
+    if not filename.endswith(".gz"):
+        return
+    try:
+        pysam.tabix_index(filename, preset="vcf", force=True)
+    except OSError as error:
+        logging.warning(f"Could not make tabix index of {filename}: {error}")
+
+
+def vcf_file_to_list(infile):
+    """Returns a tuple (list of header lines, list of VcfRecords) of the
+    VCF file infile, which can be any file that
+    open_vcf_file_for_reading() can read"""
+    header_lines = []
+    records = []
+    with open_vcf_file_for_reading(infile) as f:
+        for line in f:
+            if line.startswith("#"):
+                header_lines.append(line.rstrip())
+            else:
+                records.append(vcf_record.VcfRecord(line))
+    return header_lines, records
 
 
 def vcf_records_are_the_same(file1, file2):
     """Returns True if records in the two VCF files are the same.
     Ignores header lines in the files. Returns False if any lines are different"""
-    _, expect_records = vcf_file_read.vcf_file_to_list(file1)
-    _, got_records = vcf_file_read.vcf_file_to_list(file2)
+    _, expect_records = vcf_file_to_list(file1)
+    _, got_records = vcf_file_to_list(file2)
     return got_records == expect_records
 
 
+def load_regions(regions):
+    """Returns a dictionary of ref seq name -> IntervalMask of the regions in
+    regions, which is either the name of a BED file, or a comma-separated list
+    of regions like name:start-end, where start and end are 1-based and the
+    end is included (the same as samtools). regions can also be a dictionary
+    already made by this function, which is returned unchanged"""
+    if isinstance(regions, dict):
+        return regions
+    if os.path.exists(regions):
+        return load_mask_bed_file(regions)
+
+    intervals = {}
+    for region in regions.split(","):
+        match = re.fullmatch(r"(\S+):([0-9]+)-([0-9]+)", region.strip())
+        if match is None or not 0 < int(match.group(2)) <= int(match.group(3)):
+            raise RuntimeError(
+                f"Region '{region}' must be like name:start-end, or regions must be a BED file. Cannot continue"
+            )
+        name, start, end = match.groups()
+        intervals.setdefault(name, []).append((int(start) - 1, int(end)))
+    return {k: IntervalMask(v) for k, v in intervals.items()}
+
+
+def _fetch_vcf_lines_in_regions(vcf_file, regions):
+    """Returns an iterable of the lines of vcf_file in regions, fetched
+    using the index of vcf_file. Returns None if vcf_file is not a bgzipped
+    VCF or BCF file with an index"""
+    if vcf_file.endswith(".gz"):
+        try:
+            f = pysam.TabixFile(vcf_file)
+        except OSError:
+            return None
+        header_lines = [x + "\n" for x in f.header]
+        contigs = f.contigs
+        fetch = lambda *x: (y + "\n" for y in f.fetch(*x))
+    elif vcf_file.endswith(".bcf"):
+        f = pysam.VariantFile(vcf_file)
+        if f.index is None:
+            f.close()
+            return None
+        header_lines = str(f.header).splitlines(keepends=True)
+        contigs = list(f.header.contigs)
+        fetch = lambda *x: (str(y) for y in f.fetch(*x))
+    else:
+        return None
+
+    def lines():
+        with f:
+            yield from header_lines
+            # Records are fetched in the same order as they are in the file
+            for chrom in [x for x in contigs if x in regions]:
+                previous_end = 0
+                for start, end in regions[chrom]:
+                    for line in fetch(chrom, start, end):
+                        # A record that overlaps more than one region is
+                        # fetched more than once
+                        pos = int(line.split("\t", maxsplit=2)[1]) - 1
+                        if pos >= previous_end:
+                            yield line
+                    previous_end = end
+
+    return lines()
+
+
+def vcf_lines_in_regions(vcf_file, regions):
+    """Generator of the header lines of vcf_file, then the records where REF
+    overlaps regions (a dictionary of ref seq name -> IntervalMask, eg from
+    load_regions()). If vcf_file is a bgzipped VCF or BCF file that has an
+    index, then only the records in the regions are read from the file.
+    Otherwise the whole file is read"""
+    fetched_lines = _fetch_vcf_lines_in_regions(vcf_file, regions)
+    if fetched_lines is not None:
+        yield from fetched_lines
+        return
+
+    sweep = MaskSweep(regions)
+    with open_vcf_file_for_reading(vcf_file) as f:
+        for line in f:
+            if not line.startswith("#"):
+                chrom, pos, _, ref, _ = line.split("\t", maxsplit=4)
+                pos = int(pos) - 1
+                if not sweep.overlaps(chrom, pos, pos + len(ref)):
+                    continue
+            yield line
+
+
+def restrict_vcf_file_to_regions(vcf_in, regions, vcf_out):
+    """Writes a new VCF file vcf_out of the records in vcf_in where REF
+    overlaps the regions (see load_regions())"""
+    regions = load_regions(regions)
+    with open_vcf_file_for_writing(vcf_out) as f_out:
+        for line in vcf_lines_in_regions(vcf_in, regions):
+            print(line, end="", file=f_out)
+    index_vcf_file(vcf_out)
+
+
 def file_to_dict_of_seqs(infile):
     """Given a file of sequences, returns a dictionary of
     sequence name -> pyfastaq.sequences.Fasta.
@@ -64,6 +296,194 @@ def file_to_dict_of_seqs(infile):
     return seqs
 
 
+def _remove_tmp_dir(tmp_dir, pid):
+    # Forked processes get a copy of the finalizer that calls this, but
+    # only the process that made tmp_dir should delete it
+    if os.getpid() == pid:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class IndexedFastaSeq:
+    """One sequence from an IndexedFasta. Looks enough like a
+    pyfastaq.sequences.Fasta for how varifier uses sequences: has the
+    attributes id and seq, and can be indexed and sliced. Only the
+    positions that are asked for are fetched from the file"""
+
+    def __init__(self, indexed_fasta, name, length):
+        self._indexed_fasta = indexed_fasta
+        self.id = name
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(self._length)
+            if step != 1:
+                return self.seq[index]
+            return self._indexed_fasta.fetch(self.id, start, end)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(f"Position {index} out of range for sequence {self.id}")
+        return self._indexed_fasta.fetch(self.id, index, index + 1)
+
+    @property
+    def seq(self):
+        return self._indexed_fasta.fetch(self.id, 0, self._length)
+
+    def __str__(self):
+        return str(pyfastaq.sequences.Fasta(self.id, self.seq))
+
+
+class IndexedFasta(collections.abc.Mapping):
+    """Read-only dictionary of sequence name -> IndexedFastaSeq, for the
+    sequences in a FASTA file. Uses a samtools faidx index, so that the
+    sequences are not loaded into memory. Sequences are fetched in blocks of
+    block_size, and the most recently used max_blocks blocks are kept.
+    Is safe to use from more than one thread, and can be pickled to send to
+    other processes, which open the file themselves"""
+
+    def __init__(self, fasta_file, block_size=65536, max_blocks=64):
+        self.fasta_file = os.path.abspath(fasta_file)
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        index = self.fasta_file + ".fai"
+        if not (
+            os.path.exists(index)
+            and os.path.getmtime(index) >= os.path.getmtime(self.fasta_file)
+        ):
+            # Make the index in a temporary directory, instead of writing
+            # files next to the user's FASTA file
+            tmp_dir = tempfile.mkdtemp(prefix="varifier.faidx.")
+            weakref.finalize(self, _remove_tmp_dir, tmp_dir, os.getpid())
+            index = os.path.join(tmp_dir, "index.fai")
+            pysam.faidx(self.fasta_file, "--fai-idx", index)
+        self.index = index
+        self._lock = threading.Lock()
+        self._open()
+        self._seqs = {
+            name: IndexedFastaSeq(self, name, length)
+            for name, length in zip(self._fasta.references, self._fasta.lengths)
+        }
+
+    def _open(self):
+        self._fasta = pysam.FastaFile(self.fasta_file, filepath_index=self.index)
+        self._pid = os.getpid()
+        self._blocks = collections.OrderedDict()
+
+    def close(self):
+        """Closes the FASTA file. It is opened again if more sequence is
+        fetched"""
+        with self._lock:
+            if self._fasta is not None:
+                self._fasta.close()
+                self._fasta = None
+            self._blocks.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_fasta", "_pid", "_lock", "_blocks"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._open()
+
+    def __getitem__(self, name):
+        return self._seqs[name]
+
+    def __iter__(self):
+        return iter(self._seqs)
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def _block(self, name, block_number):
+        key = (name, block_number)
+        block = self._blocks.get(key)
+        if block is None:
+            start = block_number * self.block_size
+            block = self._fasta.fetch(name, start, start + self.block_size)
+            self._blocks[key] = block
+            if len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        else:
+            self._blocks.move_to_end(key)
+        return block
+
+    def fetch(self, name, start, end):
+        """Returns the sequence of name from 0-based start to end, not
+        including end"""
+        if end <= start:
+            return ""
+        with self._lock:
+            if self._fasta is None or os.getpid() != self._pid:
+                # Closed, or a forked process, which cannot share the
+                # parent's open file
+                self._open()
+            first_block = start // self.block_size
+            last_block = (end - 1) // self.block_size
+            if last_block - first_block >= self.max_blocks // 2:
+                return self._fasta.fetch(name, start, end)
+            seq = "".join(
+                self._block(name, i) for i in range(first_block, last_block + 1)
+            )
+        offset = first_block * self.block_size
+        return seq[start - offset : end - offset]
+
+
+# The most recently used results of indexed_dict_of_seqs(). Only a few are
+# kept, so that long-running processes that use many different files do not
+# keep all of them open (or in memory, if they could not be indexed)
+_indexed_fastas = collections.OrderedDict()
+_indexed_fastas_lock = threading.Lock()
+_indexed_fastas_max_size = 4
+
+
+def _forget_indexed_fasta(key):
+    seqs = _indexed_fastas.pop(key)
+    if isinstance(seqs, IndexedFasta):
+        seqs.close()
+
+
+def indexed_dict_of_seqs(infile):
+    """Returns a dictionary of sequence name -> sequence for the
+    sequences in infile, like file_to_dict_of_seqs(). Where possible,
+    this is an IndexedFasta, so that the sequences are fetched from
+    the file when needed. Falls back to file_to_dict_of_seqs() if the file
+    cannot be indexed, eg because it is not a FASTA file. The result is
+    reused by later calls with the same unchanged file, for the few most
+    recently used files"""
+    infile = os.path.abspath(infile)
+    key = (infile, os.path.getmtime(infile), os.path.getsize(infile))
+    with _indexed_fastas_lock:
+        if key in _indexed_fastas:
+            _indexed_fastas.move_to_end(key)
+            return _indexed_fastas[key]
+        try:
+            seqs = IndexedFasta(infile)
+        except (OSError, ValueError, pysam.utils.SamtoolsError):
+            logging.info(f"Could not index {infile}. Loading it into memory")
+            seqs = file_to_dict_of_seqs(infile)
+        for old_key in [x for x in _indexed_fastas if x[0] == infile]:
+            _forget_indexed_fasta(old_key)
+        _indexed_fastas[key] = seqs
+        while len(_indexed_fastas) > _indexed_fastas_max_size:
+            _forget_indexed_fasta(next(iter(_indexed_fastas)))
+        return seqs
+
+
+def gb_to_bytes(gigabytes):
+    """Converts size in GB to bytes. Returns None if gigabytes is None"""
+    if gigabytes is None:
+        return None
+    return int(gigabytes * 1024 ** 3)
+
+
 def get_script_dir():
     script_dir = os.path.dirname(os.path.realpath(__file__))
     return script_dir
\ No newline at end of file
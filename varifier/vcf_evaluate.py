@@ -1,8 +1,19 @@
+import concurrent.futures
 import json
+import logging
 import os
+import shutil
 import subprocess
 
-from varifier import probe_mapping, recall, utils, vcf_stats
+from varifier import (
+    genome,
+    probe_mapping,
+    recall,
+    truth_variant_finding,
+    utils,
+    vcf_shards,
+    vcf_stats,
+)
 
 
 def _add_overall_precision_and_recall_to_summary_stats(summary_stats):
@@ -37,6 +48,110 @@ def _add_overall_precision_and_recall_to_summary_stats(summary_stats):
                 d[f"{prec_or_recall}_edit_dist"] = 0
 
 
+def _combine_summary_stats(precision_stats, recall_stats_all, recall_stats_filtered):
+    recall_stats = {
+        "ALL": recall_stats_all["ALL"],
+        "FILT": recall_stats_filtered["ALL"],
+    }
+    summary_stats = {"Recall": recall_stats, "Precision": precision_stats}
+    _add_overall_precision_and_recall_to_summary_stats(summary_stats)
+    return summary_stats
+
+
+def _write_summary_stats_json(summary_stats, outdir):
+    # Written to a temporary file that is then renamed, so that
+    # summary_stats.json is never half written. batch.evaluate_manifest()
+    # uses it to tell that an evaluation finished
+    summary_stats_json = os.path.join(outdir, "summary_stats.json")
+    tmp_json = f"{summary_stats_json}.tmp"
+    with open(tmp_json, "w") as f:
+        json.dump(summary_stats, f, indent=2, sort_keys=True)
+    os.replace(tmp_json, summary_stats_json)
+
+
+def _summary_stats_from_tables(tables):
+    return _combine_summary_stats(
+        vcf_stats.summary_stats_from_per_record_stats(tables["Precision"]),
+        vcf_stats.summary_stats_from_per_record_stats(
+            tables["Recall_ALL"], for_recall=True
+        ),
+        vcf_stats.summary_stats_from_per_record_stats(
+            tables["Recall_FILT"], for_recall=True
+        ),
+    )
+
+
+def _added_to_accumulator(per_record_stats, accumulator):
+    for d in per_record_stats:
+        accumulator.add(d)
+        yield d
+
+
+def _stats_from_vcf_files(vcf_files, keep=None):
+    """Reads each record of the precision and recall VCF files once, to get
+    both the summary stats and the per-record stats tables of the records
+    where keep(per-record stats) is True (or all of them if keep is None).
+    vcf_files is a dictionary with keys Precision, Recall_ALL and
+    Recall_FILT. Returns two dictionaries with the same keys, of the
+    vcf_stats.SummaryStatsAccumulator and the table of each VCF file"""
+    accumulators = {}
+    tables = {}
+    for key, vcf_file in vcf_files.items():
+        accumulators[key] = vcf_stats.SummaryStatsAccumulator(
+            for_recall=key != "Precision"
+        )
+        per_record_stats = vcf_stats.iter_per_record_stats_from_vcf_file(vcf_file)
+        if keep is not None:
+            per_record_stats = (x for x in per_record_stats if keep(x))
+        tables[key] = vcf_stats.per_record_stats_table(
+            _added_to_accumulator(per_record_stats, accumulators[key])
+        )
+    return accumulators, tables
+
+
+def _summary_stats_from_accumulators(accumulators):
+    return _combine_summary_stats(
+        accumulators["Precision"].summary_stats(),
+        accumulators["Recall_ALL"].summary_stats(),
+        accumulators["Recall_FILT"].summary_stats(),
+    )
+
+
+def _write_stats(summary_stats, tables, outdir, curve_by=None):
+    """Writes per_record_stats.npz, the curve files if curve_by is given,
+    and summary_stats.json, to outdir, from the summary stats and
+    per-record stats tables of the precision and recall VCF files.
+    summary_stats.json is written last, so that it is only there if
+    everything else was written"""
+    vcf_stats.save_per_record_stats_tables(
+        tables, os.path.join(outdir, "per_record_stats.npz")
+    )
+    if curve_by is not None:
+        _write_curve_files(tables["Precision"], tables["Recall_ALL"], curve_by, outdir)
+    _write_summary_stats_json(summary_stats, outdir)
+
+
+def _write_curve_files(per_record_precision, per_record_recall, score_key, outdir):
+    """Writes outdir/curve.<score_key>.tsv and .json, of the precision and
+    recall at each threshold of score_key (see
+    vcf_stats.precision_recall_curve())"""
+    curve = vcf_stats.precision_recall_curve(
+        per_record_precision, per_record_recall, score_key
+    )
+    outprefix = os.path.join(outdir, f"curve.{score_key}")
+    curve.to_csv(f"{outprefix}.tsv", sep="\t", index=False)
+    count_columns = {"Calls", "TP", "FP"}
+    rows = [
+        {
+            k: int(v) if k in count_columns else float(v)
+            for k, v in zip(curve.columns, row)
+        }
+        for row in curve.itertuples(index=False)
+    ]
+    with open(f"{outprefix}.json", "w") as f:
+        json.dump({"score": score_key, "curve": rows}, f, indent=2)
+
+
 def evaluate_vcf(
     vcf_to_eval,
     vcf_ref_fasta,
@@ -50,89 +165,430 @@ def evaluate_vcf(
     truth_mask_bed_file=None,
     discard_ref_calls=True,
     max_recall_ref_len=None,
+    threads=1,
+    processes=1,
+    index_cache_dir=None,
+    index_cache_max_size=None,
+    incremental_filt=False,
+    bgzip_output=False,
+    regions=None,
+    shard=None,
+    curve_by=None,
 ):
+    """Evaluates the precision and recall of the calls in vcf_to_eval,
+    which can be a VCF, bgzipped VCF or BCF file. If bgzip_output is True,
+    the output VCF files are bgzipped and tabix indexed. If regions is given
+    (a BED file or chr:start-end list, see utils.load_regions()), only the
+    calls and truth variants in those regions are evaluated. The calls are
+    fetched using the index of vcf_to_eval, if it has one.
+    If shard is given, as a string i/N, only the calls and truth variants
+    in part i of N of vcf_ref_fasta are probe mapped (see
+    vcf_shards.GenomeShard), including when making the truth VCF if
+    truth_vcf is not given. Instead of summary_stats.json, only the stats
+    of each of those records are written, to outdir/per_record_stats.npz,
+    and the shard and its summary stats to outdir/shard.json. Use
+    merge_evaluations() to combine the N shards.
+    If curve_by is given (eg GT_CONF), the precision and recall at each
+    threshold of that score are written to outdir/curve.<curve_by>.tsv
+    and .json, using the stats already made by probe mapping.
+    The stats of each record are saved to outdir/per_record_stats.npz, for
+    summarise_evaluation()"""
     if force:
         subprocess.check_output(f"rm -rf {outdir}", shell=True)
     os.mkdir(outdir)
 
+    if regions is not None:
+        regions = utils.load_regions(regions)
+        regions_vcf = os.path.join(outdir, "variants_to_eval.regions.vcf")
+        utils.restrict_vcf_file_to_regions(vcf_to_eval, regions, regions_vcf)
+        vcf_to_eval = regions_vcf
+
     # Mask if needed
     if ref_mask_bed_file is not None:
+        ref_mask = utils.load_mask_bed_file(ref_mask_bed_file)
         masked_vcf = os.path.join(outdir, "variants_to_eval.masked.vcf")
-        utils.mask_vcf_file(vcf_to_eval, ref_mask_bed_file, masked_vcf)
+        utils.mask_vcf_file(vcf_to_eval, ref_mask, masked_vcf)
         vcf_to_eval = masked_vcf
 
     # Make VCF annotated with TP/FP for precision
-    vcf_for_precision = os.path.join(outdir, "precision.vcf")
+    vcf_suffix = ".vcf.gz" if bgzip_output else ".vcf"
+    vcf_for_precision = os.path.join(outdir, "precision" + vcf_suffix)
     if debug:
         map_outfile = f"{vcf_for_precision}.debug.map"
     else:
         map_outfile = None
 
-    if truth_mask_bed_file is None:
-        truth_mask = None
+    # Each genome is loaded once, and shared by all the stages below
+    context = genome.EvaluationContext(
+        vcf_ref_fasta, truth_ref_fasta, truth_mask_bed_file=truth_mask_bed_file
+    )
+    if shard is None:
+        genome_shard = None
     else:
-        truth_mask = utils.load_mask_bed_file(truth_mask_bed_file)
+        genome_shard = vcf_shards.GenomeShard(
+            context.ref, *vcf_shards.parse_shard(shard)
+        )
 
     probe_mapping.annotate_vcf_with_probe_mapping(
         vcf_to_eval,
-        vcf_ref_fasta,
-        truth_ref_fasta,
+        context.ref,
+        context.truth,
         flank_length,
         vcf_for_precision,
         map_outfile=map_outfile,
         use_ref_calls=not discard_ref_calls,
-        truth_mask=truth_mask,
+        truth_mask=context.truth_mask,
+        threads=threads,
+        processes=processes,
+        index_cache_dir=index_cache_dir,
+        index_cache_max_size=index_cache_max_size,
+        to_map=genome_shard,
     )
 
     recall_dir = os.path.join(outdir, "recall")
     vcf_for_recall_all, vcf_for_recall_filtered = recall.get_recall(
-        vcf_ref_fasta,
+        context.ref,
         vcf_for_precision,
         recall_dir,
         flank_length,
         debug=debug,
-        truth_fasta=truth_ref_fasta if truth_vcf is None else None,
+        truth_fasta=context.truth if truth_vcf is None else None,
         truth_vcf=truth_vcf,
-        truth_mask=truth_mask,
+        truth_mask=context.truth_mask,
         max_ref_len=max_recall_ref_len,
+        threads=threads,
+        processes=processes,
+        index_cache_dir=index_cache_dir,
+        index_cache_max_size=index_cache_max_size,
+        incremental_filt=incremental_filt,
+        bgzip_output=bgzip_output,
+        regions=regions,
+        to_map=genome_shard,
     )
     if ref_mask_bed_file is not None:
-        utils.mask_vcf_file(
-            vcf_for_recall_all, ref_mask_bed_file, f"{vcf_for_recall_all}.masked.vcf"
+        masked_suffix = ".vcf.masked" + vcf_suffix
+        masked_all = vcf_for_recall_all[: -len(vcf_suffix)] + masked_suffix
+        utils.mask_vcf_file(vcf_for_recall_all, ref_mask, masked_all)
+        vcf_for_recall_all = masked_all
+        masked_filtered = vcf_for_recall_filtered[: -len(vcf_suffix)] + masked_suffix
+        utils.mask_vcf_file(vcf_for_recall_filtered, ref_mask, masked_filtered)
+        vcf_for_recall_filtered = masked_filtered
+        os.unlink(masked_vcf)
+    if regions is not None:
+        os.unlink(regions_vcf)
+
+    # Gather stats and make plots. The records are streamed from the VCF
+    # files, adding up the summary stats and the columns of the tables
+    vcf_files = {
+        "Precision": vcf_for_precision,
+        "Recall_ALL": vcf_for_recall_all,
+        "Recall_FILT": vcf_for_recall_filtered,
+    }
+    if genome_shard is None:
+        accumulators, tables = _stats_from_vcf_files(vcf_files)
+        summary_stats = _summary_stats_from_accumulators(accumulators)
+        _write_stats(summary_stats, tables, outdir, curve_by=curve_by)
+        return
+
+    # The records from other shards are in the VCF files, but were not
+    # probe mapped, so are not counted here
+    accumulators, tables = _stats_from_vcf_files(
+        vcf_files, keep=lambda x: genome_shard.contains(x["CHROM"], x["POS"] - 1)
+    )
+    vcf_stats.save_per_record_stats_tables(
+        tables, os.path.join(outdir, "per_record_stats.npz")
+    )
+    shard_stats = {
+        "shard": [genome_shard.shard_index, genome_shard.shard_count],
+        "summary_stats": {k: v.summary_stats() for k, v in accumulators.items()},
+    }
+    with open(os.path.join(outdir, "shard.json"), "w") as f:
+        json.dump(shard_stats, f)
+
+
+def merge_evaluations(shard_dirs, outdir, force=False, curve_by=None):
+    """Combines the output directories of evaluate_vcf() run with
+    shard=1/N, ..., shard=N/N into outdir/summary_stats.json, which is the
+    same as running evaluate_vcf() without sharding, except that the sums
+    of fractions (eg SUM_ALLELE_MATCH_FRAC) can differ in the last digits,
+    because they are added up in each shard and then combined using
+    vcf_stats.SummaryStatsAccumulator.merge(). Returns the summary stats.
+    curve_by is the same as for evaluate_vcf()"""
+    shards = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, "shard.json")) as f:
+            shards.append((json.load(f), shard_dir))
+
+    shard_count = len(shards)
+    got_shards = sorted(tuple(x[0]["shard"]) for x in shards)
+    expect_shards = [(i, shard_count) for i in range(1, shard_count + 1)]
+    if got_shards != expect_shards:
+        got_str = ",".join(f"{i}/{n}" for i, n in got_shards)
+        raise RuntimeError(
+            f"Need each of the {shard_count} shards exactly once. Got: {got_str}. Cannot continue"
         )
-        vcf_for_recall_all = f"{vcf_for_recall_all}.masked.vcf"
-        utils.mask_vcf_file(
-            vcf_for_recall_filtered,
-            ref_mask_bed_file,
-            f"{vcf_for_recall_filtered}.masked.vcf",
+
+    # The shards are consecutive pieces of the genome, and each has its
+    # records in the same order as the VCF files. The summary stats of the
+    # shards are added up, and the tables are joined in order
+    shards.sort(key=lambda x: x[0]["shard"][0])
+    accumulators = {}
+    for key in "Precision", "Recall_ALL", "Recall_FILT":
+        for_recall = key != "Precision"
+        accumulators[key] = vcf_stats.SummaryStatsAccumulator(for_recall=for_recall)
+        for shard_stats, _ in shards:
+            accumulators[key].merge(
+                vcf_stats.SummaryStatsAccumulator(
+                    for_recall=for_recall, stats=shard_stats["summary_stats"][key]
+                )
+            )
+    shard_tables = [
+        vcf_stats.load_per_record_stats_tables(
+            os.path.join(shard_dir, "per_record_stats.npz")
         )
-        vcf_for_recall_filtered = f"{vcf_for_recall_filtered}.masked.vcf"
-        os.unlink(masked_vcf)
+        for _, shard_dir in shards
+    ]
+    tables = {}
+    for key in "Precision", "Recall_ALL", "Recall_FILT":
+        tables[key] = vcf_stats.concat_per_record_stats_tables(
+            [x[key] for x in shard_tables]
+        )
+
+    if force:
+        subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    os.mkdir(outdir)
+    summary_stats = _summary_stats_from_accumulators(accumulators)
+    _write_stats(summary_stats, tables, outdir, curve_by=curve_by)
+    return summary_stats
 
-    # Gather stats and make plots
-    per_record_recall_all = vcf_stats.per_record_stats_from_vcf_file(vcf_for_recall_all)
-    per_record_recall_filtered = vcf_stats.per_record_stats_from_vcf_file(
-        vcf_for_recall_filtered
+
+def summarise_evaluation(
+    eval_dir,
+    outfile,
+    filter_expression=None,
+    calls_filter_expression=None,
+    regions=None,
+    mask_bed_file=None,
+):
+    """Remakes the summary stats of the output directory eval_dir of
+    evaluate_vcf() or merge_evaluations(), using only some of the calls and
+    truth variants, from eval_dir/per_record_stats.npz. Nothing is probe
+    mapped again. The summary stats are written to outfile, and returned.
+    filter_expression is a pandas query expression (eg 'ALT_LEN == 1')
+    used on the calls for precision, and the truth variants for recall.
+    calls_filter_expression is the same, but only used on the calls, so can
+    use the annotations from the caller (eg 'GT_CONF >= 10'). Removing calls
+    does not change recall, because that needs the truth to be mapped to
+    the calls again. Only the calls and truth variants that overlap regions
+    (see utils.load_regions()), and do not overlap mask_bed_file, are used"""
+    tables = vcf_stats.load_per_record_stats_tables(
+        os.path.join(eval_dir, "per_record_stats.npz")
+    )
+    if regions is not None:
+        regions = utils.load_regions(regions)
+    mask = None if mask_bed_file is None else utils.load_mask_bed_file(mask_bed_file)
+    for key, table in tables.items():
+        tables[key] = vcf_stats.filter_per_record_stats_table(
+            table, expression=filter_expression, regions=regions, mask=mask
+        )
+    tables["Precision"] = vcf_stats.filter_per_record_stats_table(
+        tables["Precision"], expression=calls_filter_expression
     )
-    recall_stats_all = vcf_stats.summary_stats_from_per_record_stats(
-        per_record_recall_all, for_recall=True
+    summary_stats = _summary_stats_from_tables(tables)
+    with open(outfile, "w") as f:
+        json.dump(summary_stats, f, indent=2, sort_keys=True)
+    return summary_stats
+
+
+def _summary_stats_table_columns_and_values(summary_stats):
+    columns = []
+    values = []
+    for prec_or_recall in "Precision", "Recall":
+        fp_key = "FP" if prec_or_recall == "Precision" else "FN"
+        for all_or_filt in "ALL", "FILT":
+            d = summary_stats[prec_or_recall][all_or_filt]
+            prefix = f"{prec_or_recall}_{all_or_filt}"
+            columns.extend(
+                [
+                    prefix,
+                    f"{prefix}_frac",
+                    f"{prefix}_edit_dist",
+                    f"{prefix}_TP",
+                    f"{prefix}_{fp_key}",
+                ]
+            )
+            values.extend(
+                [
+                    d[prec_or_recall],
+                    d[f"{prec_or_recall}_frac"],
+                    d[f"{prec_or_recall}_edit_dist"],
+                    d["TP"]["Count"],
+                    d[fp_key]["Count"],
+                ]
+            )
+    return columns, values
+
+
+def write_summary_stats_table(names, vcf_files, summary_stats_list, outfile):
+    """Writes a TSV file with one line per VCF file, of the main precision
+    and recall numbers from each summary_stats dictionary"""
+    with open(outfile, "w") as f:
+        for i, (name, vcf_file, stats) in enumerate(
+            zip(names, vcf_files, summary_stats_list)
+        ):
+            columns, values = _summary_stats_table_columns_and_values(stats)
+            if i == 0:
+                print("Name", "VCF", *columns, sep="\t", file=f)
+            print(name, vcf_file, *values, sep="\t", file=f)
+
+
+def _default_name(vcf_file):
+    name = os.path.basename(vcf_file)
+    for suffix in ".gz", ".vcf", ".bcf":
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+    return name
+
+
+def evaluate_vcfs(
+    vcfs_to_eval,
+    vcf_ref_fasta,
+    truth_ref_fasta,
+    flank_length,
+    outdir,
+    names=None,
+    truth_vcf=None,
+    debug=False,
+    force=False,
+    ref_mask_bed_file=None,
+    truth_mask_bed_file=None,
+    discard_ref_calls=True,
+    max_recall_ref_len=None,
+    parallel=1,
+    threads=1,
+    processes=1,
+    index_cache_dir=None,
+    index_cache_max_size=None,
+    incremental_filt=False,
+    bgzip_output=False,
+    regions=None,
+):
+    """Evaluates each of the VCF files in vcfs_to_eval, which are all
+    calls against vcf_ref_fasta, using the same truth genome. The truth VCF
+    (unless truth_vcf is given) and the index of the truth genome are only
+    made once, and used by all the evaluations. Evaluates parallel VCF
+    files at the same time, each in its own process and using
+    threads * processes cpus, so parallel * threads * processes in total.
+    The output of evaluate_vcf() for each VCF file is put in
+    outdir/callers/<name>, where names default to the VCF filenames without
+    the extension. Writes a summary of all the results to
+    outdir/summary_stats.tsv. Returns a list of the summary stats of
+    each VCF file"""
+    if regions is not None:
+        regions = utils.load_regions(regions)
+    if names is None:
+        names = [_default_name(x) for x in vcfs_to_eval]
+    if len(names) != len(vcfs_to_eval):
+        raise RuntimeError(
+            f"Got {len(names)} names for {len(vcfs_to_eval)} VCF files. Cannot continue"
+        )
+    if len(set(names)) != len(names):
+        raise RuntimeError(f"Names must be unique. Got: {names}. Cannot continue")
+
+    if force:
+        subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    os.mkdir(outdir)
+    context = genome.EvaluationContext(
+        vcf_ref_fasta, truth_ref_fasta, truth_mask_bed_file=truth_mask_bed_file
     )
-    recall_stats_filtered = vcf_stats.summary_stats_from_per_record_stats(
-        per_record_recall_filtered, for_recall=True
+
+    # Make the index of the truth genome, so that it does not get remade
+    # for every VCF file
+    remove_index_cache = index_cache_dir is None and not debug
+    if index_cache_dir is None:
+        index_cache_dir = os.path.join(outdir, "index_cache")
+    probe_mapping.truth_index_file(
+        context.truth.fasta_file,
+        index_cache_dir=index_cache_dir,
+        index_cache_max_size=index_cache_max_size,
+        checksum=context.truth.checksum,
     )
-    recall_stats = {
-        "ALL": recall_stats_all["ALL"],
-        "FILT": recall_stats_filtered["ALL"],
+
+    if truth_vcf is None:
+        logging.info("Making truth VCF file, to be used for all VCF files")
+        truth_vcf = truth_variant_finding.make_truth_vcf(
+            context.ref,
+            context.truth,
+            os.path.join(outdir, "truth_vcf"),
+            flank_length,
+            debug=debug,
+            truth_mask=context.truth_mask,
+            max_ref_len=max_recall_ref_len,
+            threads=threads,
+            processes=processes,
+            index_cache_dir=index_cache_dir,
+            index_cache_max_size=index_cache_max_size,
+            bgzip_output=bgzip_output,
+            regions=regions,
+        )
+
+    callers_dir = os.path.join(outdir, "callers")
+    os.mkdir(callers_dir)
+    kwargs = {
+        "truth_vcf": truth_vcf,
+        "debug": debug,
+        "ref_mask_bed_file": ref_mask_bed_file,
+        "truth_mask_bed_file": truth_mask_bed_file,
+        "discard_ref_calls": discard_ref_calls,
+        "threads": threads,
+        "processes": processes,
+        "index_cache_dir": index_cache_dir,
+        "index_cache_max_size": index_cache_max_size,
+        "incremental_filt": incremental_filt,
+        "bgzip_output": bgzip_output,
+        "regions": regions,
     }
 
-    per_record_precision = vcf_stats.per_record_stats_from_vcf_file(vcf_for_precision)
-    precision_stats = vcf_stats.summary_stats_from_per_record_stats(
-        per_record_precision
-    )
+    if parallel > 1:
+        # Processes cannot share the loaded genomes, so give them filenames
+        with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as executor:
+            futures = [
+                executor.submit(
+                    evaluate_vcf,
+                    vcf_file,
+                    context.ref.fasta_file,
+                    context.truth.fasta_file,
+                    flank_length,
+                    os.path.join(callers_dir, name),
+                    **kwargs,
+                )
+                for name, vcf_file in zip(names, vcfs_to_eval)
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for name, vcf_file in zip(names, vcfs_to_eval):
+            logging.info(f"Evaluating {name}: {vcf_file}")
+            evaluate_vcf(
+                vcf_file,
+                context.ref,
+                context.truth,
+                flank_length,
+                os.path.join(callers_dir, name),
+                **kwargs,
+            )
 
-    summary_stats = {"Recall": recall_stats, "Precision": precision_stats}
-    _add_overall_precision_and_recall_to_summary_stats(summary_stats)
+    if remove_index_cache:
+        shutil.rmtree(index_cache_dir)
 
-    summary_stats_json = os.path.join(outdir, "summary_stats.json")
-    with open(summary_stats_json, "w") as f:
-        json.dump(summary_stats, f, indent=2, sort_keys=True)
+    summary_stats_list = []
+    for name in names:
+        with open(os.path.join(callers_dir, name, "summary_stats.json")) as f:
+            summary_stats_list.append(json.load(f))
+    write_summary_stats_table(
+        names,
+        vcfs_to_eval,
+        summary_stats_list,
+        os.path.join(outdir, "summary_stats.tsv"),
+    )
+    return summary_stats_list
@@ -1,4 +1,10 @@
-from cluster_vcf_records import vcf_file_read
+import heapq
+import itertools
+import operator
+
+from cluster_vcf_records import vcf_file_read, vcf_record
+
+from varifier import utils
 
 
 def _add_vfr_filter_to_record(record, want_ref_calls=False):
@@ -51,16 +57,25 @@ def _fix_cluster_filter_tag(records):
                 x.set_format_key_value("VFR_FILTER", "FAIL_CONFLICT")
 
 
-def _annotate_sorted_list_of_records(records, want_ref_calls=False):
-    """Annotated sorted list of VCF records. Assumes they all belong to
-    the same CHROM. Changes the records in place. No copying"""
+def _annotate_sorted_records(records, want_ref_calls=False):
+    """Generator that annotates sorted records, which all belong to the same
+    CHROM, and yields them in the same order. Only the records in the current
+    cluster are held in memory, because their tags cannot be finalised until
+    the end of the cluster is known. Changes the records in place"""
     wanted_filters = {"PASS", "FAIL_BUT_TEST"}
     cluster = []
     cluster_end = None
+    # Records from the start of the current cluster, including ones that
+    # are not in the cluster, which are held back to keep the input order
+    pending = []
 
     for record in records:
         _add_vfr_filter_to_record(record, want_ref_calls=want_ref_calls)
         if record.FORMAT["VFR_FILTER"] not in wanted_filters:
+            if len(pending) == 0:
+                yield record
+            else:
+                pending.append(record)
             continue
 
         if len(cluster) == 0:
@@ -68,31 +83,143 @@ def _annotate_sorted_list_of_records(records, want_ref_calls=False):
             cluster_end = record.ref_end_pos()
         elif record.POS > cluster_end:
             _fix_cluster_filter_tag(cluster)
+            yield from pending
+            pending = []
             cluster = [record]
             cluster_end = record.ref_end_pos()
         else:
             cluster.append(record)
             cluster_end = max(cluster_end, record.ref_end_pos())
+        pending.append(record)
 
     _fix_cluster_filter_tag(cluster)
+    yield from pending
 
 
-def add_qc_to_vcf(infile, outfile, want_ref_calls=False):
-    """Annotated VCF file with QC info needed for calculating precision and recall.
-    Adds various tags to each record."""
-    header_lines, vcf_records = vcf_file_read.vcf_file_to_dict(
-        infile, remove_useless_start_nucleotides=True
-    )
-    assert header_lines[-1].startswith("#CHROM")
+def _annotate_sorted_list_of_records(records, want_ref_calls=False):
+    """Annotated sorted list of VCF records. Assumes they all belong to
+    the same CHROM. Changes the records in place. No copying"""
+    for _ in _annotate_sorted_records(records, want_ref_calls=want_ref_calls):
+        pass
+
+
+def _vcf_is_sorted(infile):
+    """Returns True if the records in infile are grouped by CHROM, and
+    sorted by POS within each CHROM. Only reads the CHROM and POS columns,
+    so does not need to load the file into memory"""
+    chroms = set()
+    chrom = None
+    pos = None
+    with utils.open_vcf_file_for_reading(infile) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t", maxsplit=2)
+            if fields[0] != chrom:
+                if fields[0] in chroms:
+                    return False
+                chrom = fields[0]
+                chroms.add(chrom)
+            elif int(fields[1]) < pos:
+                return False
+            pos = int(fields[1])
+    return True
+
+
+def _read_vcf_file(infile):
+    """Generator that yields the list of header lines of infile, then each
+    record of infile that has at least one ALT"""
+    header_lines = []
+    with utils.open_vcf_file_for_reading(infile) as f:
+        for line in f:
+            if line.startswith("#"):
+                header_lines.append(line.rstrip())
+                continue
+            if header_lines is not None:
+                yield header_lines
+                header_lines = None
+            record = vcf_record.VcfRecord(line)
+            if len(record.ALT) > 0:
+                yield record
+
+    if header_lines is not None:
+        yield header_lines
+
+
+def _records_sorted_after_trimming(records):
+    """Removes useless start nucleotides from the records, which must be
+    grouped by CHROM and sorted by POS. Yields the records sorted by their
+    new POS, in the same order as a stable sort would give.
+    Removing nucleotides can only increase POS. This means that a record
+    can be yielded once a record with a larger POS (before trimming)
+    has been seen, so only a few records are held in memory at once"""
+    heap = []
+    chrom = None
+    for i, record in enumerate(records):
+        if record.CHROM != chrom:
+            while len(heap):
+                yield heapq.heappop(heap)[2]
+            chrom = record.CHROM
+
+        while len(heap) and heap[0][0] < record.POS:
+            yield heapq.heappop(heap)[2]
+        record.remove_useless_start_nucleotides()
+        heapq.heappush(heap, (record.POS, i, record))
+
+    while len(heap):
+        yield heapq.heappop(heap)[2]
+
+
+def qc_annotated_records(infile, want_ref_calls=False):
+    """Generator that yields the header lines for the QC annotated VCF file,
+    then each record of infile annotated with QC info needed for calculating
+    precision and recall. If infile is grouped by CHROM and sorted by POS,
+    then the records are streamed in the same order as infile, holding only
+    one cluster of records in memory. Otherwise, all the records are loaded
+    and sorted, with the CHROMs in alphabetical order"""
+    if _vcf_is_sorted(infile):
+        records = _read_vcf_file(infile)
+        header_lines = next(records)
+        records_by_chrom = itertools.groupby(
+            _records_sorted_after_trimming(records), key=operator.attrgetter("CHROM")
+        )
+    elif infile.endswith(".bcf"):
+        raise RuntimeError(f"BCF file {infile} must be sorted. Cannot continue")
+    else:
+        header_lines, vcf_records = vcf_file_read.vcf_file_to_dict(
+            infile, remove_useless_start_nucleotides=True
+        )
+        records_by_chrom = sorted(vcf_records.items())
 
+    assert header_lines[-1].startswith("#CHROM")
+    yield header_lines[:-1] + [
+        '##FORMAT=<ID=VFR_FILTER,Number=1,Type=String,Description="Initial filtering of VCF record. If PASS, then it is evaluated, otherwise is skipped">',
+        header_lines[-1],
+    ]
+
+    for chrom, records in records_by_chrom:
+        yield from _annotate_sorted_records(records, want_ref_calls=want_ref_calls)
+
+
+def write_vcf_file(records, outfile):
+    """Writes a VCF file from the output of a generator like
+    qc_annotated_records(), which yields the header lines then the records.
+    Yields everything that it writes, so that the records can be written to
+    a file on their way to the next step of a pipeline. Each record is
+    written before it is yielded, ie before the next step can change it"""
+    records = iter(records)
     with open(outfile, "w") as f:
-        print(*header_lines[:-1], sep="\n", file=f)
-        print(
-            '##FORMAT=<ID=VFR_FILTER,Number=1,Type=String,Description="Initial filtering of VCF record. If PASS, then it is evaluated, otherwise is skipped">',
-            file=f,
-        )
-        print(header_lines[-1], file=f)
+        header_lines = next(records)
+        print(*header_lines, sep="\n", file=f)
+        yield header_lines
+        for record in records:
+            print(record, file=f)
+            yield record
+
 
-        for chrom, records in sorted(vcf_records.items()):
-            _annotate_sorted_list_of_records(records, want_ref_calls=want_ref_calls)
-            print(*records, sep="\n", file=f)
+def add_qc_to_vcf(infile, outfile, want_ref_calls=False):
+    """Annotated VCF file with QC info needed for calculating precision and recall.
+    Adds various tags to each record."""
+    records = qc_annotated_records(infile, want_ref_calls=want_ref_calls)
+    for _ in write_vcf_file(records, outfile):
+        pass
@@ -0,0 +1,146 @@
+import heapq
+import operator
+import os
+import re
+
+from varifier import genome, utils
+
+
+def _vcf_line_chrom_and_pos(line):
+    chrom, pos, _ = line.split("\t", maxsplit=2)
+    return chrom, int(pos)
+
+
+def split_vcf_file(vcf_in, outdir, window_size=1000000):
+    """Splits vcf_in into shards, writing one VCF file per shard in outdir.
+    Each shard has a copy of the header lines. If the VCF file has records
+    from more than one CHROM, then there is one shard per CHROM. Otherwise,
+    the records are split into windows of window_size bases.
+    The records for each CHROM must be next to each other in vcf_in, and
+    sorted by position.
+    Returns list of shard filenames, in the same order as the records
+    in vcf_in"""
+    header_lines = []
+    chroms = set()
+    with utils.open_vcf_file_for_reading(vcf_in) as f:
+        for line in f:
+            if line.startswith("#"):
+                header_lines.append(line)
+            else:
+                chroms.add(line.split("\t", maxsplit=1)[0])
+
+    split_by_chrom = len(chroms) > 1
+    shard_files = []
+    shard_key = None
+    f_out = None
+
+    with utils.open_vcf_file_for_reading(vcf_in) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+
+            chrom, pos = _vcf_line_chrom_and_pos(line)
+            key = chrom if split_by_chrom else (pos - 1) // window_size
+            if key != shard_key:
+                if f_out is not None:
+                    f_out.close()
+                shard_files.append(
+                    os.path.join(outdir, f"shard.{len(shard_files)}.vcf")
+                )
+                f_out = open(shard_files[-1], "w")
+                print(*header_lines, sep="", end="", file=f_out)
+                shard_key = key
+
+            print(line, end="", file=f_out)
+
+    if f_out is not None:
+        f_out.close()
+
+    return shard_files
+
+
+def merge_vcf_files(shard_files, vcf_out):
+    """Merges VCF files made from the output of split_vcf_file() into one
+    file vcf_out, sorted by coordinate. The order of CHROMs is the order
+    that they first appear in shard_files. The records are streamed from
+    the shard files, so only one record per shard is held in memory.
+    Takes the header lines from the first shard"""
+    chrom_order = {}
+    shard_handles = [open(x) for x in shard_files]
+
+    def records_from_file(f):
+        for line in f:
+            if not line.startswith("#"):
+                chrom, pos = _vcf_line_chrom_and_pos(line)
+                yield chrom_order[chrom], pos, line
+
+    try:
+        with utils.open_vcf_file_for_writing(vcf_out) as f_out:
+            for i, f in enumerate(shard_handles):
+                for line in f:
+                    if line.startswith("#"):
+                        if i == 0:
+                            print(line, end="", file=f_out)
+                    else:
+                        chrom, _ = _vcf_line_chrom_and_pos(line)
+                        if chrom not in chrom_order:
+                            chrom_order[chrom] = len(chrom_order)
+                        break
+                f.seek(0)
+
+            shard_records = [records_from_file(f) for f in shard_handles]
+            for _, _, line in heapq.merge(
+                *shard_records, key=operator.itemgetter(0, 1)
+            ):
+                print(line, end="", file=f_out)
+    finally:
+        for f in shard_handles:
+            f.close()
+
+
+def parse_shard(shard):
+    """Returns (i, N) from a string like i/N, where 1 <= i <= N"""
+    match = re.fullmatch(r"([0-9]+)/([0-9]+)", shard.strip())
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise RuntimeError(
+            f"Shard must be like i/N, where i is 1 to N. Got: {shard}. Cannot continue"
+        )
+    return int(match.group(1)), int(match.group(2))
+
+
+class GenomeShard:
+    """Part shard_index (1 to shard_count) of ref_genome (a FASTA filename
+    or genome.Genome), when the sequences, in the order they are in the
+    genome, are cut into shard_count pieces of about the same length.
+    Every position is in exactly one shard, so assigning each VCF record to
+    the shard that has its POS puts it in exactly one shard. Records on
+    sequences that are not in the genome are put in the first shard.
+    Calling an instance with a VCF record returns True if it is in the shard"""
+
+    def __init__(self, ref_genome, shard_index, shard_count):
+        assert 1 <= shard_index <= shard_count
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        seqs = genome.load(ref_genome).seqs
+        lengths = {name: len(seqs[name]) for name in seqs}
+        total_length = sum(lengths.values())
+        start = (shard_index - 1) * total_length // shard_count
+        end = shard_index * total_length // shard_count
+        self.seq_names = set(lengths)
+        self.regions = {}
+        offset = 0
+        for name, length in lengths.items():
+            if start < offset + length and offset < end:
+                self.regions[name] = utils.IntervalMask(
+                    [(max(start, offset) - offset, min(end, offset + length) - offset)]
+                )
+            offset += length
+
+    def contains(self, chrom, pos):
+        """Returns True if the 0-based position pos of chrom is in the shard"""
+        if chrom not in self.seq_names:
+            return self.shard_index == 1
+        return chrom in self.regions and pos in self.regions[chrom]
+
+    def __call__(self, record):
+        return self.contains(record.CHROM, record.POS)
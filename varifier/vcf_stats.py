@@ -1,7 +1,12 @@
 import copy
+import itertools
 from operator import itemgetter
 
-from cluster_vcf_records import vcf_file_read
+import numpy as np
+import pandas as pd
+from cluster_vcf_records import vcf_record
+
+from varifier import utils
 
 
 def _frs_from_vcf_record(record, cov_key="COV"):
@@ -32,59 +37,174 @@ def _frs_from_vcf_record(record, cov_key="COV"):
         return coverages[allele_index] / total_cov
 
 
+_wanted_keys = [
+    "DP",
+    "DPF",
+    "FRS",
+    "GT_CONF",
+    "GT_CONF_PERCENTILE",
+    "VFR_IN_MASK",
+    "VFR_ED_RA",
+    "VFR_ED_TR",
+    "VFR_ED_TA",
+    "VFR_FILTER",
+    "VFR_ALLELE_LEN",
+    "VFR_ALLELE_MATCH_COUNT",
+    "VFR_ALLELE_MATCH_FRAC",
+    "VFR_RESULT",
+]
+
+_key_types = {
+    "DP": int,
+    "DPF": float,
+    "GT_CONF": float,
+    "GT_CONF_PERCENTILE": float,
+    "FRS": float,
+    "VFR_IN_MASK": int,
+    "VFR_ED_RA": int,
+    "VFR_ED_TR": int,
+    "VFR_ED_TA": int,
+    "VFR_ALLELE_MATCH_FRAC": float,
+    "VFR_ALLELE_LEN": int,
+    "VFR_ALLELE_MATCH_COUNT": int,
+}
+
+
+def _allele_lengths_from_vcf_record(record):
+    """Returns a tuple (length of REF, length of the called allele). The
+    length of the called allele is "NA" if there is no genotype, or the
+    genotype has more than one allele"""
+    genotypes = set(record.FORMAT.get("GT", ".").replace("|", "/").split("/"))
+    if "." in genotypes or len(genotypes) != 1:
+        return len(record.REF), "NA"
+    allele_index = int(genotypes.pop())
+    if allele_index == 0:
+        return len(record.REF), len(record.REF)
+    return len(record.REF), len(record.ALT[allele_index - 1])
+
+
+def _per_record_stats_from_vcf_record(record):
+    record_stats = {x: record.FORMAT.get(x, "NA") for x in _wanted_keys}
+    record_stats["FRS"] = _frs_from_vcf_record(record)
+    record_stats["CHROM"] = record.CHROM
+    record_stats["POS"] = record.POS + 1
+    ref_len, alt_len = _allele_lengths_from_vcf_record(record)
+    record_stats["REF_LEN"] = ref_len
+    record_stats["ALT_LEN"] = alt_len
+    for key, key_type in _key_types.items():
+        try:
+            record_stats[key] = key_type(record_stats[key])
+        except:
+            pass
+    return record_stats
+
+
+def iter_per_record_stats_from_vcf_file(infile):
+    """Generator that yields the stats of each record in a VCF file, in the
+    same order as the file. The records are read one at a time, instead of
+    loading the whole file. See per_record_stats_from_vcf_file()"""
+    with utils.open_vcf_file_for_reading(infile) as f:
+        for line in f:
+            if not line.startswith("#"):
+                record = vcf_record.VcfRecord(line)
+                yield _per_record_stats_from_vcf_record(record)
+
+
 def per_record_stats_from_vcf_file(infile):
     """Gathers stats for each record in a VCF file.
     Returns a list of dictionaries of stats. One dict per VCF line.
     List is sorted by ref seq name (CHROM), then position (POS)"""
-    stats = []
-    wanted_keys = [
-        "DP",
-        "DPF",
-        "FRS",
-        "GT_CONF",
-        "GT_CONF_PERCENTILE",
-        "VFR_IN_MASK",
-        "VFR_ED_RA",
-        "VFR_ED_TR",
-        "VFR_ED_TA",
-        "VFR_FILTER",
-        "VFR_ALLELE_LEN",
-        "VFR_ALLELE_MATCH_COUNT",
-        "VFR_ALLELE_MATCH_FRAC",
-        "VFR_RESULT",
-    ]
-    key_types = {
-        "DP": int,
-        "DPF": float,
-        "GT_CONF": float,
-        "GT_CONF_PERCENTILE": float,
-        "FRS": float,
-        "VFR_IN_MASK": int,
-        "VFR_ED_RA": int,
-        "VFR_ED_TR": int,
-        "VFR_ED_TA": int,
-        "VFR_ALLELE_MATCH_FRAC": float,
-        "VFR_ALLELE_LEN": int,
-        "VFR_ALLELE_MATCH_COUNT": int,
-    }
-    header_lines, vcf_records = vcf_file_read.vcf_file_to_list(infile)
-    for record in vcf_records:
-        record_stats = {x: record.FORMAT.get(x, "NA") for x in wanted_keys}
-        record_stats["FRS"] = _frs_from_vcf_record(record)
-        record_stats["CHROM"] = record.CHROM
-        record_stats["POS"] = record.POS + 1
-        for key, key_type in key_types.items():
-            try:
-                record_stats[key] = key_type(record_stats[key])
-            except:
-                pass
-
-        stats.append(record_stats)
-
+    stats = list(iter_per_record_stats_from_vcf_file(infile))
     stats.sort(key=itemgetter("CHROM", "POS"))
     return stats
 
 
+_table_columns = ["CHROM", "POS", "REF_LEN", "ALT_LEN"] + _wanted_keys
+_numeric_columns = ["POS", "REF_LEN", "ALT_LEN"] + list(_key_types)
+
+
+def _numeric_column(values):
+    values = [np.nan if x == "NA" else x for x in values]
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:  # values that are not numbers, eg "."
+        return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(float)
+
+
+def _string_column(values, codes):
+    """Returns a numpy array of the codes of values, where codes is a
+    dictionary of value -> code that is added to for new values"""
+    return np.array([codes.setdefault(x, len(codes)) for x in values], dtype=np.int32)
+
+
+def _concatenate(arrays, dtype):
+    return np.concatenate(arrays) if len(arrays) > 0 else np.array([], dtype=dtype)
+
+
+def per_record_stats_table(per_record_stats, chunk_size=10000):
+    """Returns a pandas DataFrame of the per-record stats from an iterable of
+    dictionaries made by per_record_stats_from_vcf_file(), with one row per
+    record and one column per stat. The numeric columns are floats, with NaN
+    where the value is missing or "NA". REF_LEN and ALT_LEN are the lengths
+    of the REF and called alleles. The other columns (CHROM, VFR_FILTER,
+    VFR_RESULT) are categoricals of strings, with "NA" where the value is
+    missing.
+    The records are taken chunk_size at a time, and each chunk is made into
+    numpy arrays before the next one, so that the table is made without
+    keeping a python object for each value of every record"""
+    per_record_stats = iter(per_record_stats)
+    # There are only a few different values in each string column, so these
+    # use much less memory, and are much faster to compare, as categoricals
+    codes = {x: {} for x in _table_columns if x not in _numeric_columns}
+    arrays = {x: [] for x in _table_columns}
+    while True:
+        chunk = list(itertools.islice(per_record_stats, chunk_size))
+        if len(chunk) == 0:
+            break
+        for key, key_arrays in arrays.items():
+            values = [d.get(key, "NA") for d in chunk]
+            if key in codes:
+                key_arrays.append(_string_column(values, codes[key]))
+            else:
+                key_arrays.append(_numeric_column(values))
+
+    columns = {}
+    for key in _table_columns:
+        # Each column's chunks are removed once joined, to save memory
+        if key not in codes:
+            columns[key] = _concatenate(arrays.pop(key), float)
+            continue
+        # Sort the categories, the same as pandas does when making them
+        categories = sorted(codes[key])
+        new_codes = np.empty(len(categories), dtype=np.int32)
+        for i, category in enumerate(categories):
+            new_codes[codes[key][category]] = i
+        columns[key] = pd.Categorical.from_codes(
+            new_codes[_concatenate(arrays.pop(key), np.int32)], categories=categories
+        )
+    # Not copied, so that there is only one copy of the arrays in memory
+    return pd.DataFrame(columns, columns=_table_columns, copy=False)
+
+
+def concat_per_record_stats_tables(tables):
+    """Returns one table made by joining the list of tables made by
+    per_record_stats_table(), one after the other"""
+    # Categoricals with different categories are joined as plain objects,
+    # so give every table the same categories first
+    string_columns = [x for x in _table_columns if x not in _numeric_columns]
+    categories = {
+        key: sorted({str(x) for table in tables for x in table[key].cat.categories})
+        for key in string_columns
+    }
+    tables = [
+        table.assign(
+            **{x: table[x].cat.set_categories(categories[x]) for x in categories}
+        )
+        for table in tables
+    ]
+    return pd.concat(tables, ignore_index=True)
+
+
 def format_dict_to_edit_dist_scores(stats):
     if stats["VFR_RESULT"] == "CANNOT_USE_GT":
         return None, None
@@ -119,57 +239,354 @@ def format_dict_to_edit_dist_scores(stats):
         return stats["VFR_ED_TR"] - stats["VFR_ED_TA"], stats["VFR_ED_TR"]
 
 
-def summary_stats_from_per_record_stats(per_record_stats, for_recall=False):
-    """Given a list of stats made by per_record_stats_from_vcf_file(),
-    returns a dictionary of summary stats. Set for_recall to True if the
-    VCF was made for getting recall"""
-    default_counts = {k: 0 for k in ("Count", "SUM_ALLELE_MATCH_FRAC", "SUM_EDIT_DIST")}
-    stats = {"UNUSED": {"CONFLICT": 0, "OTHER": 0, "MASKED": 0}}
-
-    # By default, this is for getting the precision. Which means counting up
-    # TPs and FPs. For recall, each call is an expected call from the truth.
-    # This means TP is the same as for precision, but a wrong call now means
-    # a FN. We expected to find the variant, but didn't.
-    fp_key = "FN" if for_recall else "FP"
+def edit_dist_scores_from_table(table):
+    """Same as format_dict_to_edit_dist_scores(), but for every row of a
+    table made by per_record_stats_table() in one go. Returns a tuple of
+    numpy arrays (numerators, denominators, numerator_is_frac). The scores
+    are NaN where format_dict_to_edit_dist_scores() returns (None, None).
+    numerator_is_frac is True where the numerator is VFR_ALLELE_MATCH_FRAC
+    instead of an edit distance"""
+    result = table["VFR_RESULT"]
+    ed_ra = table["VFR_ED_RA"].to_numpy()
+    ed_tr = table["VFR_ED_TR"].to_numpy()
+    ed_ta = table["VFR_ED_TA"].to_numpy()
+    if len(table) == 0:
+        is_fp = np.full(0, False)
+    else:
+        is_fp = result.str.startswith("FP").to_numpy(dtype=bool)
+    usable = (result != "CANNOT_USE_GT").to_numpy()
+    # The cases are in the same order as in format_dict_to_edit_dist_scores(),
+    # and np.select() uses the first one that is True for each row
+    cases = [
+        usable & is_fp & ((ed_tr == 0) | np.isnan(ed_tr)),
+        usable & ~is_fp & (ed_ta == 0),
+        usable & ~is_fp & (ed_tr == 0),
+        usable & np.isnan(ed_tr),
+        usable,
+    ]
+    match_frac = table["VFR_ALLELE_MATCH_FRAC"].to_numpy()
+    numerators = np.select(cases, [0, ed_ra, 0, match_frac, ed_tr - ed_ta], np.nan)
+    denominators = np.select(cases, [ed_ra, ed_ra, ed_ra, 1, ed_tr], np.nan)
+    numerator_is_frac = np.select(cases, [False, False, False, True, False], False)
+    return numerators, denominators, numerator_is_frac
+
+
+def _sum_in_order(values, is_float):
+    """Returns the sum of the numpy array values, adding them up in order.
+    This is the same as adding them one at a time to 0, which is what
+    SummaryStatsAccumulator does (numpy.sum() adds them in a different order,
+    which can change the last digits of the answer). The sum is an int,
+    unless is_float is True and there is at least one value"""
+    if len(values) == 0:
+        return 0
+    total = np.cumsum(values)[-1]
+    return float(total) if is_float else int(total)
 
-    for key in "ALL", "FILT":
-        stats[key] = {
-            "TP": copy.copy(default_counts),
-            fp_key: copy.copy(default_counts),
+
+def _add_counts(counts, other_counts):
+    """Adds the numbers in the nested dictionary other_counts to counts,
+    which must have the same keys"""
+    for key, value in other_counts.items():
+        if isinstance(value, dict):
+            _add_counts(counts[key], value)
+        else:
+            counts[key] += value
+
+
+class SummaryStatsAccumulator:
+    """Accumulates the summary stats of per-record stats (as made by
+    per_record_stats_from_vcf_file()) one record at a time, so that the
+    records do not need to be kept in memory. Accumulators of different
+    parts of a VCF file (eg shards) can be combined with merge().
+    Set for_recall to True if the VCF was made for getting recall. To carry
+    on from an earlier accumulator (eg one saved to a file), give its
+    summary_stats() as stats"""
+
+    def __init__(self, for_recall=False, stats=None):
+        self.for_recall = for_recall
+        # By default, this is for getting the precision. Which means counting up
+        # TPs and FPs. For recall, each call is an expected call from the truth.
+        # This means TP is the same as for precision, but a wrong call now means
+        # a FN. We expected to find the variant, but didn't.
+        self.fp_key = "FN" if for_recall else "FP"
+        default_counts = {
+            k: 0 for k in ("Count", "SUM_ALLELE_MATCH_FRAC", "SUM_EDIT_DIST")
         }
-        stats[key]["EDIT_DIST_COUNTS"] = {"numerator": 0, "denominator": 0}
+        self.stats = {"UNUSED": {"CONFLICT": 0, "OTHER": 0, "MASKED": 0}}
+        for key in "ALL", "FILT":
+            self.stats[key] = {
+                "TP": copy.copy(default_counts),
+                self.fp_key: copy.copy(default_counts),
+            }
+            self.stats[key]["EDIT_DIST_COUNTS"] = {"numerator": 0, "denominator": 0}
+        if stats is not None:
+            _add_counts(self.stats, stats)
 
-    for d in per_record_stats:
+    def add(self, d):
+        """Adds the stats d of one record"""
+        stats = self.stats
         if d["VFR_FILTER"] == "FAIL_CONFLICT":
             stats["UNUSED"]["CONFLICT"] += 1
+            return
         elif d.get("VFR_IN_MASK", 0) == 1:
             stats["UNUSED"]["MASKED"] += 1
+            return
         elif d["VFR_FILTER"] not in ["PASS", "FAIL_BUT_TEST"]:
             stats["UNUSED"]["OTHER"] += 1
+            return
+
+        if d["VFR_RESULT"] == "TP":
+            result = "TP"
         else:
-            if d["VFR_RESULT"] == "TP":
-                result = "TP"
-            else:
-                result = fp_key
-            keys_to_update = ["ALL"]
-            if d["VFR_FILTER"] == "PASS":
-                keys_to_update.append("FILT")
+            result = self.fp_key
+        keys_to_update = ["ALL"]
+        if d["VFR_FILTER"] == "PASS":
+            keys_to_update.append("FILT")
+
+        ed_num, ed_den = format_dict_to_edit_dist_scores(d)
+
+        for key in keys_to_update:
+            try:
+                stats[key][result]["SUM_ALLELE_MATCH_FRAC"] += d[
+                    "VFR_ALLELE_MATCH_FRAC"
+                ]
+            except TypeError:  # the value could be "NA"
+                pass
+
+            stats[key][result]["SUM_EDIT_DIST"] += d["VFR_ED_RA"]
+            stats[key][result]["Count"] += 1
+
+            if ed_num is not None:
+                stats[key]["EDIT_DIST_COUNTS"]["numerator"] += ed_num
+                stats[key]["EDIT_DIST_COUNTS"]["denominator"] += ed_den
+
+    def merge(self, other):
+        """Adds the stats accumulated by other, which must also be for
+        recall if this one is for recall, and vice versa"""
+        if other.for_recall != self.for_recall:
+            raise RuntimeError(
+                "Cannot merge precision and recall summary stats. Cannot continue"
+            )
+        _add_counts(self.stats, other.stats)
+
+    def summary_stats(self):
+        """Returns a dictionary of the summary stats, in the same format as
+        summary_stats_from_per_record_stats()"""
+        return copy.deepcopy(self.stats)
 
-            ed_num, ed_den = format_dict_to_edit_dist_scores(d)
 
-            for key in keys_to_update:
-                try:
-                    stats[key][result]["SUM_ALLELE_MATCH_FRAC"] += d[
-                        "VFR_ALLELE_MATCH_FRAC"
-                    ]
-                except TypeError:  # the value could be "NA"
-                    pass
+def _to_table(per_record_stats):
+    if isinstance(per_record_stats, pd.DataFrame):
+        return per_record_stats
+    return per_record_stats_table(per_record_stats)
 
-                stats[key][result]["SUM_EDIT_DIST"] += d["VFR_ED_RA"]
-                stats[key][result]["Count"] += 1
 
-                if ed_num is not None:
-                    stats[key]["EDIT_DIST_COUNTS"]["numerator"] += ed_num
-                    stats[key]["EDIT_DIST_COUNTS"]["denominator"] += ed_den
+def _table_filter_masks(table):
+    """Returns boolean arrays (conflict, masked, is_pass, used) of the rows
+    of the table, where used means that the row counts towards TP/FP/FN"""
+    vfr_filter = table["VFR_FILTER"]
+    conflict = (vfr_filter == "FAIL_CONFLICT").to_numpy()
+    masked = ~conflict & (table["VFR_IN_MASK"].to_numpy() == 1)
+    is_pass = (vfr_filter == "PASS").to_numpy()
+    is_fail_but_test = (vfr_filter == "FAIL_BUT_TEST").to_numpy()
+    used = ~conflict & ~masked & (is_pass | is_fail_but_test)
+    return conflict, masked, is_pass, used
+
+
+def summary_stats_from_per_record_stats(per_record_stats, for_recall=False):
+    """Given a list of stats made by per_record_stats_from_vcf_file(), or
+    a table of them from per_record_stats_table(), returns a dictionary of
+    summary stats. Set for_recall to True if the VCF was made for getting
+    recall. The stats are calculated for all the records at once, using
+    numpy, and are the same as from SummaryStatsAccumulator"""
+    table = _to_table(per_record_stats)
+    fp_key = "FN" if for_recall else "FP"
+    conflict, masked, is_pass, used = _table_filter_masks(table)
+    stats = {
+        "UNUSED": {
+            "CONFLICT": int(conflict.sum()),
+            "OTHER": int((~conflict & ~masked & ~used).sum()),
+            "MASKED": int(masked.sum()),
+        }
+    }
+
+    is_tp = (table["VFR_RESULT"] == "TP").to_numpy()
+    match_frac = table["VFR_ALLELE_MATCH_FRAC"].to_numpy()
+    ed_ra = table["VFR_ED_RA"].to_numpy()
+    ed_num, ed_den, ed_num_is_frac = edit_dist_scores_from_table(table)
+    for key, rows in ("ALL", used), ("FILT", used & is_pass):
+        stats[key] = {}
+        for result, result_rows in ("TP", rows & is_tp), (fp_key, rows & ~is_tp):
+            stats[key][result] = {
+                "Count": int(result_rows.sum()),
+                # The value could be "NA", which is NaN in the table
+                "SUM_ALLELE_MATCH_FRAC": _sum_in_order(
+                    match_frac[result_rows & ~np.isnan(match_frac)], True
+                ),
+                "SUM_EDIT_DIST": _sum_in_order(ed_ra[result_rows], False),
+            }
+        ed_rows = rows & ~np.isnan(ed_num)
+        stats[key]["EDIT_DIST_COUNTS"] = {
+            "numerator": _sum_in_order(ed_num[ed_rows], ed_num_is_frac[ed_rows].any()),
+            "denominator": _sum_in_order(ed_den[ed_rows], False),
+        }
 
     return stats
+
+
+def summary_stats_from_vcf_file(infile, for_recall=False):
+    """Same as summary_stats_from_per_record_stats(), but gets the stats
+    straight from a VCF file, one record at a time, so that memory use
+    does not depend on the size of the file"""
+    accumulator = SummaryStatsAccumulator(for_recall=for_recall)
+    for d in iter_per_record_stats_from_vcf_file(infile):
+        accumulator.add(d)
+    return accumulator.summary_stats()
+
+
+curve_score_keys = ["GT_CONF", "GT_CONF_PERCENTILE", "FRS", "DP"]
+
+
+def precision_recall_curve(per_record_precision, per_record_recall, score_key):
+    """Returns a pandas DataFrame of the precision and recall if only the calls
+    with score_key (eg GT_CONF) at least each threshold were kept, with one
+    row for each distinct score of the calls, sorted by threshold. The inputs
+    are the per-record stats (lists or tables, see per_record_stats_table())
+    of the VCF files for precision and for recall (of all the calls, not just
+    PASS ones). All the calls that are used for the ALL stats are
+    thresholded, whatever their FILTER, and calls with no score are never kept.
+    The calls are sorted once, and the counts at each threshold are
+    cumulative sums, so no probe mapping is redone. Recall would need the
+    truth to be mapped again for each threshold, so is estimated: the recall
+    of all the calls, times the fraction of the TP calls that are kept"""
+    if score_key not in curve_score_keys:
+        raise RuntimeError(
+            f"Cannot make curve using {score_key}. Must be one of: {','.join(curve_score_keys)}. Cannot continue"
+        )
+    precision = _to_table(per_record_precision)
+    _, _, _, used = _table_filter_masks(precision)
+    scores = precision[score_key].to_numpy()
+    rows = used & ~np.isnan(scores)
+    # Highest scores first, so that the first n rows are the calls kept by
+    # the threshold of row n
+    order = np.argsort(-scores[rows], kind="stable")
+    scores = scores[rows][order]
+    is_tp = (precision["VFR_RESULT"] == "TP").to_numpy()[rows][order]
+    match_frac = np.nan_to_num(precision["VFR_ALLELE_MATCH_FRAC"].to_numpy())
+    ed_num, ed_den, _ = edit_dist_scores_from_table(precision)
+    tp = np.cumsum(is_tp)
+    calls = np.arange(1, len(scores) + 1)
+    tp_frac = np.cumsum(match_frac[rows][order])
+    ed_num = np.cumsum(np.nan_to_num(ed_num[rows][order]))
+    ed_den = np.cumsum(np.nan_to_num(ed_den[rows][order]))
+
+    recall_stats = summary_stats_from_per_record_stats(
+        per_record_recall, for_recall=True
+    )["ALL"]
+    truth_count = recall_stats["TP"]["Count"] + recall_stats["FN"]["Count"]
+    recall = recall_stats["TP"]["Count"] / truth_count if truth_count > 0 else 0
+    tp_fraction = tp / tp[-1] if len(tp) > 0 and tp[-1] > 0 else np.zeros(len(tp))
+
+    # The last row of each run of equal scores has all the calls with at
+    # least that score
+    last_of_score = np.append(scores[1:] != scores[:-1], True)[: len(scores)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        curve = pd.DataFrame(
+            {
+                "Threshold": scores,
+                "Calls": calls,
+                "TP": tp,
+                "FP": calls - tp,
+                "Precision": np.round(tp / calls, 8),
+                "Precision_frac": np.round(tp_frac / calls, 8),
+                "Precision_edit_dist": np.round(
+                    np.where(ed_den > 0, ed_num / ed_den, 0), 8
+                ),
+                "Recall_estimate": np.round(recall * tp_fraction, 8),
+            }
+        )[last_of_score]
+    return curve.iloc[::-1].reset_index(drop=True)
+
+
+def save_per_record_stats_tables(tables, outfile):
+    """Saves a dictionary of name -> table made by per_record_stats_table()
+    to a numpy .npz file, with one array per column of each table.
+    Categorical columns are saved as their integer codes and the list of
+    categories, so that no python objects are pickled. Use
+    load_per_record_stats_tables() to get the tables back"""
+    arrays = {}
+    for name, table in tables.items():
+        for column in _table_columns:
+            key = f"{name}.{column}"
+            if column in _numeric_columns:
+                arrays[key] = table[column].to_numpy(dtype=float)
+            else:
+                values = table[column].astype("category")
+                arrays[key] = values.cat.codes.to_numpy()
+                arrays[f"{key}.categories"] = np.array(
+                    [str(x) for x in values.cat.categories], dtype=str
+                )
+    # Not compressed, because decompressing takes longer than everything
+    # else that summarise_evaluation() does
+    with open(outfile, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_per_record_stats_tables(infile):
+    """Loads tables saved by save_per_record_stats_tables(). Returns a
+    dictionary of name -> table, the same as was saved"""
+    with np.load(infile, allow_pickle=False) as arrays:
+        names = sorted({x.split(".")[0] for x in arrays.files})
+        tables = {}
+        for name in names:
+            columns = {}
+            for column in _table_columns:
+                key = f"{name}.{column}"
+                if column in _numeric_columns:
+                    columns[column] = arrays[key]
+                else:
+                    columns[column] = pd.Categorical.from_codes(
+                        arrays[key], categories=arrays[f"{key}.categories"]
+                    )
+            tables[name] = pd.DataFrame(columns, columns=_table_columns)
+    return tables
+
+
+def rows_overlapping_intervals(table, intervals):
+    """Returns a numpy boolean array of whether the REF allele of each row
+    of the table overlaps intervals, which is a dictionary of ref seq name
+    -> utils.IntervalMask (eg from utils.load_regions()). This is the same
+    overlap as used by utils.vcf_lines_in_regions()"""
+    overlaps = np.full(len(table), False)
+    chroms = table["CHROM"].to_numpy()
+    starts = table["POS"].to_numpy() - 1
+    ends = starts + np.nan_to_num(table["REF_LEN"].to_numpy(), nan=1)
+    for chrom, mask in intervals.items():
+        rows = chroms == chrom
+        if len(mask) == 0 or not rows.any():
+            continue
+        mask_starts = np.array(mask.starts)
+        mask_ends = np.array(mask.ends)
+        i = np.searchsorted(mask_starts, ends[rows], side="left") - 1
+        overlaps[rows] = (i >= 0) & (mask_ends[np.maximum(i, 0)] > starts[rows])
+    return overlaps
+
+
+def filter_per_record_stats_table(table, expression=None, regions=None, mask=None):
+    """Returns the rows of a table made by per_record_stats_table() that
+    match the pandas query expression (eg 'GT_CONF >= 10 and ALT_LEN == 1'),
+    overlap regions, and do not overlap mask. regions and mask are
+    dictionaries of ref seq name -> utils.IntervalMask. Any of them can be
+    None, to not filter on it"""
+    if expression is not None:
+        try:
+            table = table.query(expression)
+        except Exception as e:
+            raise RuntimeError(
+                f"Error using filter expression '{expression}': {e}. Cannot continue"
+            )
+    if regions is not None:
+        table = table[rows_overlapping_intervals(table, regions)]
+    if mask is not None:
+        table = table[~rows_overlapping_intervals(table, mask)]
+    return table